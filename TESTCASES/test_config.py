@@ -66,7 +66,7 @@ def get_project_path(relative_path=""):
 
 def load_service_config():
     """加载实际服务配置"""
-    config_path = get_project_path("services/config.json")
+    config_path = os.getenv("ATM_CONFIG_PATH") or get_project_path("services/config.json")
     try:
         with open(config_path, "r", encoding="utf-8") as f:
             return json.load(f)
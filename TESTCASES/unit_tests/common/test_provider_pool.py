@@ -0,0 +1,163 @@
+"""多节点RPC连接池和共享HTTP连接池的单元测试"""
+
+import sys
+import os
+import pytest
+
+# 添加项目根目录到Python路径，以便能够导入服务代码
+sys.path.append(os.path.join(os.path.dirname(__file__), '..', '..', '..'))
+
+# 导入待测试的模块
+from services.common.provider_pool import ProviderPool
+from services.common.http_pool import SessionPool
+
+
+class FakeProvider:
+    """按地址模拟节点：responses 为每次调用依次返回的响应（异常实例会被抛出）"""
+
+    def __init__(self, url, responses):
+        self.endpoint_uri = url
+        self.responses = responses
+        self.calls = []
+
+    def make_request(self, method, params):
+        self.calls.append(method)
+        response = self.responses[min(len(self.calls), len(self.responses)) - 1]
+        if isinstance(response, Exception):
+            raise response
+        return response
+
+
+class TestProviderPool:
+    """测试多节点RPC连接池的路由、熔断和交易广播"""
+
+    def make_pool(self, responses, **kwargs):
+        providers = {url: FakeProvider(url, items) for url, items in responses.items()}
+        pool = ProviderPool(list(responses), provider_factory=lambda url: providers[url], **kwargs)
+        return pool, providers
+
+    def test_failover_and_circuit_breaker(self):
+        """故障节点切换到下一个节点，连续失败后熔断，冷却后试探恢复"""
+        ok = {"jsonrpc": "2.0", "id": 1, "result": "0x1"}
+        pool, providers = self.make_pool({"http://a": [ConnectionError("down")], "http://b": [ok]},
+                                         failure_threshold=2, cooldown=3600)
+        for _ in range(3):
+            assert pool.make_request("eth_blockNumber", []) == ok
+        # 第 2 次失败后节点 a 熔断，第 3 次请求不再发给它
+        assert len(providers["http://a"].calls) == 2
+        assert pool.status()[0]["open"] is True
+        pool.endpoints[0].open_until = 0
+        providers["http://a"].responses = [ok]
+        pool.make_request("eth_blockNumber", [])
+        assert pool.status()[0]["open"] is False
+
+    def test_recovered_endpoint_probed_despite_healthy_peer(self):
+        """熔断到期的节点与健康节点竞争时仍会收到试探请求，成功后恢复"""
+        ok = {"jsonrpc": "2.0", "id": 1, "result": "0x1"}
+        pool, providers = self.make_pool({"http://a": [ConnectionError("down")], "http://b": [ok]},
+                                         failure_threshold=1, cooldown=3600)
+        pool.make_request("eth_blockNumber", [])
+        # 节点 a 的历史耗时比 b 慢，按得分排序会排在后面
+        pool.endpoints[0].latency = 1.0
+        pool.endpoints[1].latency = 0.01
+        pool.endpoints[0].open_until = 0
+        providers["http://a"].responses = [ok]
+        for _ in range(3):
+            assert pool.make_request("eth_blockNumber", []) == ok
+        assert pool.endpoints[0].probing is False
+        assert pool.status()[0]["open"] is False
+        assert len(providers["http://a"].calls) == 2
+        # 恢复后按得分排序，读请求回到更快的节点 b
+        assert len(providers["http://b"].calls) == 3
+
+    def test_filter_requests_pinned_to_creating_endpoint(self):
+        """过滤器只在创建它的节点上存在，轮询不随得分切换节点，节点故障时不切换"""
+        created = {"jsonrpc": "2.0", "id": 1, "result": "0xf1"}
+        changes = {"jsonrpc": "2.0", "id": 1, "result": []}
+        pool, providers = self.make_pool({"http://a": [created, changes, ConnectionError("down")],
+                                          "http://b": [changes]})
+        pool.endpoints[0].latency = 0.01
+        pool.endpoints[1].latency = 0.5
+        assert pool.make_request("eth_newBlockFilter", []) == created
+        # 节点 b 变得更快，过滤器轮询仍然发往 a
+        pool.endpoints[0].latency = 0.5
+        pool.endpoints[1].latency = 0.01
+        assert pool.make_request("eth_getFilterChanges", ["0xf1"]) == changes
+        with pytest.raises(ConnectionError):
+            pool.make_request("eth_getFilterChanges", ["0xf1"])
+        assert providers["http://a"].calls == ["eth_newBlockFilter", "eth_getFilterChanges", "eth_getFilterChanges"]
+        assert providers["http://b"].calls == []
+        assert pool._filters == {}
+
+    def test_reads_prefer_fastest_endpoint(self):
+        ok = {"jsonrpc": "2.0", "id": 1, "result": "0x1"}
+        pool, providers = self.make_pool({"http://slow": [ok], "http://fast": [ok]})
+        pool.endpoints[0].latency = 0.5
+        pool.endpoints[1].latency = 0.05
+        pool.make_request("eth_chainId", [])
+        assert providers["http://fast"].calls == ["eth_chainId"]
+        assert providers["http://slow"].calls == []
+
+    def test_rate_limited_response_fails_over(self):
+        limited = {"jsonrpc": "2.0", "id": 1, "error": {"code": -32005, "message": "limit exceeded"}}
+        reverted = {"jsonrpc": "2.0", "id": 1, "error": {"code": 3, "message": "execution reverted"}}
+        pool, providers = self.make_pool({"http://a": [limited], "http://b": [reverted]})
+        # 普通的 JSON-RPC 错误属于正常响应，直接返回
+        assert pool.make_request("eth_call", []) == reverted
+        assert pool.endpoints[0].failures == 1
+        assert pool.endpoints[1].failures == 0
+
+    def test_send_raw_transaction_broadcasts(self):
+        """交易广播到多个节点，任一节点接受即成功"""
+        raw = "0x" + "ab" * 20
+        accepted = {"jsonrpc": "2.0", "id": 1, "result": "0x" + "11" * 32}
+        pool, providers = self.make_pool({"http://a": [ConnectionError("down")], "http://b": [accepted],
+                                          "http://c": [accepted]}, broadcast=3)
+        assert pool.make_request("eth_sendRawTransaction", [raw]) == accepted
+        assert all(p.calls == ["eth_sendRawTransaction"] for p in providers.values())
+
+    def test_already_known_counts_as_accepted(self):
+        from web3 import Web3
+        raw = "0x" + "ab" * 20
+        known = {"jsonrpc": "2.0", "id": 1, "error": {"code": -32000, "message": "already known"}}
+        pool, _ = self.make_pool({"http://a": [known], "http://b": [ConnectionError("down")]})
+        response = pool.make_request("eth_sendRawTransaction", [raw])
+        assert response["result"] == Web3.to_hex(Web3.keccak(hexstr=raw))
+
+    def test_batch_unsupported_not_counted_as_failure(self, monkeypatch):
+        """节点不支持批量请求时不计入节点故障，传输错误才触发熔断"""
+        from services.common import provider_pool
+        from services.common.rpc_batch import RPCBatchError, RPCBatchUnsupported
+        errors = {"http://a": RPCBatchUnsupported("rejected", {"code": -32600, "message": "batch not supported"}),
+                  "http://b": RPCBatchError("timed out")}
+
+        def fake_batch(url, calls, timeout=10):
+            raise errors[url]
+        monkeypatch.setattr(provider_pool, "batch_request", fake_batch)
+        pool, _ = self.make_pool({"http://a": [], "http://b": []}, failure_threshold=1, cooldown=3600)
+        with pytest.raises(RPCBatchUnsupported):
+            pool.batch_request([("eth_blockNumber", [])])
+        assert pool.endpoints[0].failures == 0
+        assert pool.status()[0]["open"] is False
+        assert pool.status()[1]["open"] is True
+        # 限流同样返回单个错误对象，仍按节点故障处理
+        errors["http://a"] = RPCBatchUnsupported("rejected", {"code": -32005, "message": "limit exceeded"})
+        with pytest.raises(RPCBatchError) as exc_info:
+            pool.batch_request([("eth_blockNumber", [])])
+        assert not isinstance(exc_info.value, RPCBatchUnsupported)
+        assert pool.endpoints[0].failures == 1
+
+
+class TestSessionPool:
+    """测试RPC共享连接池"""
+
+    def test_session_shared_per_origin(self):
+        pool = SessionPool({"pool_maxsize": 4})
+        session = pool.session_for("https://rpc.example/v3/key-a")
+        assert pool.session_for("https://rpc.example/v3/key-b") is session
+        assert pool.session_for("https://other.example") is not session
+        adapter = session.get_adapter("https://rpc.example")
+        assert adapter._pool_maxsize == 4
+        pool.configure({"pool_maxsize": 16})
+        assert session.get_adapter("https://rpc.example")._pool_maxsize == 16
+        pool.close()
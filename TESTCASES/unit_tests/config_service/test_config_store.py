@@ -0,0 +1,136 @@
+"""配置服务快照和配置客户端的单元测试"""
+
+import sys
+import os
+import json
+import asyncio
+import httpx
+
+# 添加项目根目录到Python路径，以便能够导入服务代码
+sys.path.append(os.path.join(os.path.dirname(__file__), '..', '..', '..'))
+
+# 导入待测试的模块
+from services.config_service.logic.config_store import ConfigStore
+from services.common.config_client import ConfigClient
+from services.common.config_file import ConfigFile
+
+
+def write_config(path, data):
+    with open(path, "w") as f:
+        json.dump(data, f)
+    # 保证 mtime 变化可被察觉
+    stat = os.stat(path)
+    os.utime(path, ns=(stat.st_atime_ns, stat.st_mtime_ns + 1_000_000))
+
+
+class TestConfigStore:
+    """带版本号的配置快照测试"""
+
+    def test_refresh_publishes_new_version(self, tmp_path):
+        path = str(tmp_path / "config.json")
+        write_config(path, {"network_mode": "testnet", "wallet": {"private_key": "secret"}})
+        store = ConfigStore(path)
+        assert store.version == 1
+        assert "wallet" not in store.snapshot()["config"]
+        # 文件未变化时只做一次 stat
+        assert store.refresh() is False
+        write_config(path, {"network_mode": "mainnet"})
+        assert store.refresh() is True
+        assert store.version == 2
+        assert store.snapshot()["config"]["network_mode"] == "mainnet"
+
+    def test_invalid_file_keeps_previous_snapshot(self, tmp_path):
+        path = str(tmp_path / "config.json")
+        write_config(path, {"network_mode": "testnet"})
+        store = ConfigStore(path)
+        with open(path, "w") as f:
+            f.write("{broken")
+        assert store.refresh() is False
+        assert store.config == {"network_mode": "testnet"}
+
+    def test_defaults_without_file(self):
+        store = ConfigStore(None, defaults={"network_mode": "testnet"})
+        assert store.version == 1
+        assert store.config["network_mode"] == "testnet"
+
+    def test_long_poll_wakes_on_change(self, tmp_path):
+        path = str(tmp_path / "config.json")
+        write_config(path, {"network_mode": "testnet"})
+
+        async def scenario():
+            store = ConfigStore(path)
+            # 版本号不同时立即返回
+            assert (await store.wait(0, 5))["version"] == 1
+            waiter = asyncio.ensure_future(store.wait(1, 5))
+            await asyncio.sleep(0)
+            assert not waiter.done()
+            write_config(path, {"network_mode": "mainnet"})
+            store.refresh()
+            return await asyncio.wait_for(waiter, 1)
+
+        snapshot = asyncio.run(scenario())
+        assert snapshot["version"] == 2
+        assert snapshot["config"]["network_mode"] == "mainnet"
+
+    def test_long_poll_times_out_with_current_snapshot(self):
+        store = ConfigStore(None, defaults={"network_mode": "testnet"})
+        snapshot = asyncio.run(store.wait(1, 0.01))
+        assert snapshot["version"] == 1
+
+
+class TestConfigFile:
+    """按 mtime 失效的配置文件缓存测试"""
+
+    def test_reload_only_after_interval_and_change(self, tmp_path):
+        path = str(tmp_path / "config.json")
+        write_config(path, {"network_mode": "testnet"})
+        config_file = ConfigFile(path, check_interval=3600)
+        first = config_file.load()
+        assert first == {"network_mode": "testnet"}
+        # 检查间隔内不 stat 文件，直接返回同一个字典
+        write_config(path, {"network_mode": "mainnet"})
+        assert config_file.load() is first
+        config_file.check_interval = 0
+        assert config_file.load() == {"network_mode": "mainnet"}
+        # 文件未变化时不重新解析
+        assert config_file.load() is config_file.load()
+
+    def test_missing_and_invalid_file(self, tmp_path):
+        path = str(tmp_path / "config.json")
+        config_file = ConfigFile(path, check_interval=0)
+        assert config_file.load() == {}
+        write_config(path, {"network_mode": "testnet"})
+        assert config_file.load() == {"network_mode": "testnet"}
+        with open(path, "w") as f:
+            f.write("{broken")
+        assert config_file.load() == {"network_mode": "testnet"}
+
+
+class TestConfigClient:
+    """服务内配置快照缓存测试"""
+
+    def test_poll_applies_snapshot_and_keeps_local_secrets(self, tmp_path):
+        path = str(tmp_path / "config.json")
+        write_config(path, {"network_mode": "testnet", "wallet": {"private_key": "secret"}})
+        requests = []
+
+        def handler(request):
+            requests.append(dict(request.url.params))
+            return httpx.Response(200, json={"version": 3, "config": {"network_mode": "mainnet"}})
+
+        client = ConfigClient(base_url="http://config", path=path)
+        client._http = httpx.Client(base_url="http://config", transport=httpx.MockTransport(handler))
+        updates = []
+        client.subscribe(updates.append)
+        assert client.get("network_mode") == "testnet"
+
+        assert client.poll_once() is True
+        assert client.get("network_mode") == "mainnet"
+        assert client.get("wallet") == {"private_key": "secret"}
+        assert client.version == 3
+        assert len(updates) == 1
+        # 之后的请求带上当前版本号进行长轮询，内容未变化时不通知订阅者
+        assert client.poll_once() is False
+        assert requests[0].get("since") is None
+        assert requests[1]["since"] == "3"
+        assert len(updates) == 1
@@ -0,0 +1,6 @@
+"""单元测试公共配置：服务模块导入时读取的配置文件固定为仓库中的 config.example.json"""
+
+import os
+
+os.environ.setdefault("ATM_CONFIG_PATH", os.path.join(
+    os.path.dirname(__file__), "..", "..", "services", "config.example.json"))
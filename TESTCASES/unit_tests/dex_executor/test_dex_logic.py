@@ -5,8 +5,10 @@ u6d4bu8bd5u4ea4u6613u5bf9u89e3u6790u3001u7f51u7edcu914du7f6eu52a0u8f7du53cau4ea4
 
 import sys
 import os
-import json
+import time
+import threading
 import pytest
+from collections import OrderedDict
 from unittest.mock import patch, MagicMock, PropertyMock
 
 # u6dfbu52a0u9879u76eeu6839u76eeu5f55u5230Pythonu8defu5f84uff0cu4ee5u4fbfu80fdu591fu5bfcu5165u670du52a1u4ee3u7801
@@ -14,6 +16,9 @@ sys.path.append(os.path.join(os.path.dirname(__file__), '..', '..', '..'))
 
 # u5bfcu5165u5f85u6d4bu8bd5u7684u6a21u5757
 from services.dex_executor.logic import dex_logic
+from services.common.nonce_manager import NonceManager
+from services.common.gas_oracle import GasOracle
+from services.dex_executor.logic.allowance_ledger import AllowanceLedger
 from TESTCASES.test_config import TEST_SIGNALS, TEST_CONFIG
 
 # u6d4bu8bd5u6570u636e
@@ -28,6 +33,22 @@ TESTCASE_VALUES = {
     "DEFAULT_PRIVATE_KEY": TEST_CONFIG["wallet"]["private_key"]
 }
 
+# Router 的 swapExactTokensForTokens ABI，用于校验预计算选择器编码的调用数据
+ROUTER_ABI = [
+    {
+        "name": "swapExactTokensForTokens",
+        "type": "function",
+        "inputs": [
+            {"name": "amountIn", "type": "uint256"},
+            {"name": "amountOutMin", "type": "uint256"},
+            {"name": "path", "type": "address[]"},
+            {"name": "to", "type": "address"},
+            {"name": "deadline", "type": "uint256"}
+        ],
+        "outputs": [{"name": "amounts", "type": "uint256[]"}]
+    }
+]
+
 class TestDexLogic:
     """u6d4bu8bd5DEXu6267u884cu5668u903bu8f91"""
     
@@ -129,5 +150,589 @@ class TestDexLogic:
         assert "amount" in str(excinfo.value).lower(), "u5e94u629bu51fau5173u4e8eu7f3au5c11u91d1u989du7684u5f02u5e38"
 
 
+class TestDexCaches:
+    """测试地址、选择器和链ID缓存"""
+
+    def setup_method(self):
+        dex_logic._chain_id_cache.clear()
+
+    def test_encode_call_matches_contract_abi(self):
+        """预计算选择器编码的调用数据应与合约ABI编码一致"""
+        router_address = TEST_CONFIG["testnet"]["router_address"]
+        token_in = TEST_CONFIG["token_addresses"]["USDT"]
+        token_out = TEST_CONFIG["token_addresses"]["WBTC"]
+        wallet = TEST_WALLET["address"]
+        args = (10 ** 18, 99 * 10 ** 16, [token_in, token_out], wallet, 1700000000)
+        web3 = dex_logic.get_network_config("testnet")["web3"]
+        router = web3.eth.contract(address=router_address, abi=ROUTER_ABI)
+        expected = router.functions.swapExactTokensForTokens(*args)._encode_transaction_data()
+        assert dex_logic.encode_call("swapExactTokensForTokens", *args) == expected
+
+    def test_chain_id_cached(self):
+        """未配置链ID时只向节点查询一次"""
+        web3 = MagicMock()
+        chain_id = PropertyMock(return_value=11155111)
+        type(web3.eth).chain_id = chain_id
+        assert dex_logic.get_chain_id(web3, "http://rpc") == 11155111
+        assert dex_logic.get_chain_id(web3, "http://rpc") == 11155111
+        assert dex_logic.get_chain_id(web3, "http://rpc", 5) == 5
+        assert chain_id.call_count == 1
+
+    def test_network_contexts_are_immutable(self):
+        """网络上下文启动时构建一次，查找时不修改全局变量，交替请求不同网络时复用同一上下文"""
+        testnet = dex_logic.get_network_config("testnet")
+        mainnet = dex_logic.get_network_config("mainnet")
+        assert dex_logic.get_network_config("testnet") is testnet
+        assert mainnet["chain_id"] == dex_logic.config_data.get("mainnet", {}).get("chain_id")
+        assert dex_logic.get_network_config("mainnet") is mainnet
+        with pytest.raises(TypeError):
+            testnet["web3"] = None
+
+    def test_network_token_map(self):
+        """按网络的代币映射表解析代币符号"""
+        tokens = {"USDT": "0x" + "01" * 20}
+        assert dex_logic.resolve_token_address("usdt", tokens) == tokens["USDT"]
+        assert "token_addresses" in dex_logic.get_network_config("testnet")
+
+
+def make_mock_web3(tx_hash=b"\x12" * 32):
+    """构造发送交易用的Web3模拟对象，保留单位换算等纯函数"""
+    from web3 import Web3
+    web3 = MagicMock()
+    web3.to_wei = Web3.to_wei
+    web3.from_wei = Web3.from_wei
+    web3.is_address = Web3.is_address
+    web3.eth.send_raw_transaction.return_value = MagicMock(hex=MagicMock(return_value="0x" + tx_hash.hex()))
+    web3.eth.get_transaction_count.return_value = 0
+    web3.eth.estimate_gas.return_value = 150000
+    return web3
+
+
+class SwapTestBase:
+    """使用模拟网络配置执行 execute_swap 的公共准备"""
+
+    def setup_method(self):
+        dex_logic._chain_id_cache.clear()
+        self.ledger_patch = patch.object(dex_logic, "ALLOWANCES", AllowanceLedger())
+        self.ledger = self.ledger_patch.start()
+        self.web3 = make_mock_web3()
+        self.net_config = {
+            "chain_id": 11155111,
+            "rpc_url": "http://rpc",
+            "router_address": TEST_CONFIG["testnet"]["router_address"],
+            "web3": self.web3,
+            "nonce_manager": NonceManager(self.web3),
+            "gas_oracle": GasOracle(self.web3)
+        }
+
+    def run_swap(self, batch_results):
+        trade = WITH_WALLET_SIGNAL.copy()
+        with patch.object(dex_logic, "get_network_config", return_value=self.net_config), \
+             patch.object(dex_logic, "AUTO_APPROVE", True), \
+             patch.object(dex_logic, "batch_request", return_value=batch_results) as mock_batch:
+            result = dex_logic.execute_swap(trade)
+        return result, mock_batch
+
+    def teardown_method(self):
+        self.ledger_patch.stop()
+
+
+class TestPreTradeChecks(SwapTestBase):
+    """测试交易前检查合并为一次批量RPC请求"""
+
+    def test_single_round_trip(self):
+        """余额、代币余额和授权额度在一次批量请求中获取"""
+        amount = 10 * 10 ** 18
+        result, mock_batch = self.run_swap([hex(10 ** 18), hex(amount), hex(amount), hex(0)])
+        assert result == {"tx_hash": "0x" + "12" * 32, "nonce": 0, "wallet_address": TEST_WALLET["address"]}
+        assert mock_batch.call_count == 1
+        methods = [call[0] for call in mock_batch.call_args[0][1]]
+        assert methods == ["eth_getBalance", "eth_call", "eth_call", "eth_getTransactionCount"]
+        self.web3.eth.get_balance.assert_not_called()
+        self.web3.eth.contract.assert_not_called()
+        assert self.web3.eth.send_raw_transaction.call_count == 1
+
+    def test_insufficient_token_balance(self):
+        """代币余额不足时拒绝交易"""
+        result, _ = self.run_swap([hex(10 ** 18), hex(1), hex(0)])
+        assert "Insufficient token balance" in result["error"]
+        self.web3.eth.send_raw_transaction.assert_not_called()
+
+    def test_fallback_when_batch_unsupported(self):
+        """节点不支持批量请求时逐个查询"""
+        amount = 10 * 10 ** 18
+        self.web3.manager.request_blocking.side_effect = [hex(10 ** 18), hex(amount), hex(amount), hex(3)]
+        with patch.object(dex_logic, "batch_request", side_effect=dex_logic.RPCBatchError("unsupported")):
+            checks = dex_logic.pre_trade_checks(self.web3, "http://rpc", TEST_WALLET["address"],
+                                                TEST_CONFIG["token_addresses"]["USDT"],
+                                                self.net_config["router_address"], check_allowance=True)
+        assert checks == {"eth_balance": 10 ** 18, "token_balance": amount, "allowance": amount, "confirmed_nonce": 3}
+
+
+class TestApprovalPipeline(SwapTestBase):
+    """测试授权交易与swap流水线发送"""
+
+    def test_pipeline_sends_approve_and_swap_back_to_back(self):
+        """授权不足时 approve 与 swap 使用连续nonce发送，不等待收据"""
+        result, _ = self.run_swap([hex(10 ** 18), hex(10 * 10 ** 18), hex(0)])
+        assert "approve_tx_hash" in result
+        self.web3.eth.wait_for_transaction_receipt.assert_not_called()
+        signed = [call[0][0] for call in self.web3.eth.account.sign_transaction.call_args_list]
+        assert [tx["nonce"] for tx in signed] == [0, 1]
+        # 默认只授权本次交易所需的数量
+        amount_in = int(float(WITH_WALLET_SIGNAL["amount"]) * 10 ** 18)
+        assert signed[0]["data"] == dex_logic.encode_call(
+            "approve", self.net_config["router_address"], amount_in)
+
+    def test_concurrent_swaps_serialize_approve(self):
+        """同一代币的并发交易不会交错发送 approve，每笔 swap 紧跟在自己的 approve 之后"""
+        def slow_batch(rpc_url, calls, **kwargs):
+            time.sleep(0.05)
+            return [hex(10 ** 18), hex(100 * 10 ** 18), hex(0)]
+
+        trade = WITH_WALLET_SIGNAL.copy()
+        results = []
+        with patch.object(dex_logic, "get_network_config", return_value=self.net_config), \
+             patch.object(dex_logic, "AUTO_APPROVE", True), \
+             patch.object(dex_logic, "batch_request", side_effect=slow_batch):
+            threads = [threading.Thread(target=lambda: results.append(dex_logic.execute_swap(trade)))
+                       for _ in range(2)]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+
+        assert all("approve_tx_hash" in result for result in results)
+        signed = [call[0][0] for call in self.web3.eth.account.sign_transaction.call_args_list]
+        signed.sort(key=lambda tx: tx["nonce"])
+        approve_selector = dex_logic.encode_call("approve", self.net_config["router_address"], 0)[:10]
+        assert [tx["data"].startswith(approve_selector) for tx in signed] == [True, False, True, False]
+
+    def test_unlimited_approve_is_opt_in(self):
+        """unlimited_approve 开启时才授权最大额度"""
+        with patch.object(dex_logic, "UNLIMITED_APPROVE", True):
+            result, _ = self.run_swap([hex(10 ** 18), hex(10 * 10 ** 18), hex(0)])
+        assert "approve_tx_hash" in result
+        signed = self.web3.eth.account.sign_transaction.call_args_list[0][0][0]
+        assert signed["data"] == dex_logic.encode_call(
+            "approve", self.net_config["router_address"], dex_logic.MAX_UINT256)
+
+    def test_wait_mode_blocks_on_receipt(self):
+        """wait 模式保持等待授权收据的行为"""
+        self.web3.eth.wait_for_transaction_receipt.return_value = MagicMock(status=1)
+        with patch.object(dex_logic, "APPROVE_MODE", "wait"):
+            result, _ = self.run_swap([hex(10 ** 18), hex(10 * 10 ** 18), hex(0)])
+        assert "tx_hash" in result
+        self.web3.eth.wait_for_transaction_receipt.assert_called_once()
+
+    def test_pre_approve_tokens(self):
+        """预授权只为额度不足的代币发送 approve"""
+        tokens = {"ETH": dex_logic.NATIVE_TOKEN_ADDRESS, "USDT": TEST_CONFIG["token_addresses"]["USDT"],
+                  "WBTC": TEST_CONFIG["token_addresses"]["WBTC"]}
+        with patch.object(dex_logic, "get_network_config", return_value=self.net_config), \
+             patch.object(dex_logic, "TOKEN_ADDRESSES", tokens), \
+             patch.object(dex_logic, "DEFAULT_WALLET_ADDRESS", TEST_WALLET["address"]), \
+             patch.object(dex_logic, "DEFAULT_PRIVATE_KEY", TEST_WALLET["private_key"]), \
+             patch.object(dex_logic, "batch_request", return_value=[hex(dex_logic.MAX_UINT256), "0x0"]) as mock_batch:
+            approved = dex_logic.pre_approve_tokens()
+        assert len(mock_batch.call_args[0][1]) == 2
+        assert list(approved) == ["WBTC"]
+        assert self.web3.eth.send_raw_transaction.call_count == 1
+
+    def test_pre_approve_holds_allowance_lock(self):
+        """预授权在授权条目锁内发送 approve，并跳过锁内已被并发swap授权的代币"""
+        chain_id = self.net_config["chain_id"]
+        router = self.net_config["router_address"]
+        usdt, wbtc = TEST_CONFIG["token_addresses"]["USDT"], TEST_CONFIG["token_addresses"]["WBTC"]
+        self.ledger.set(chain_id, TEST_WALLET["address"], usdt, router, dex_logic.MAX_UINT256)
+        locked = []
+
+        def fake_approve(web3, nonce_manager, gas_oracle, wallet, key, token, spender, chain, amount):
+            locked.append(self.ledger.lock(chain, wallet, token, spender).locked())
+            return bytes(32), 1
+        with patch.object(dex_logic, "get_network_config", return_value=self.net_config), \
+             patch.object(dex_logic, "TOKEN_ADDRESSES", {"USDT": usdt, "WBTC": wbtc}), \
+             patch.object(dex_logic, "DEFAULT_WALLET_ADDRESS", TEST_WALLET["address"]), \
+             patch.object(dex_logic, "DEFAULT_PRIVATE_KEY", TEST_WALLET["private_key"]), \
+             patch.object(dex_logic, "send_approve", side_effect=fake_approve), \
+             patch.object(dex_logic, "batch_request", return_value=["0x0", "0x0"]):
+            approved = dex_logic.pre_approve_tokens()
+        assert list(approved) == ["WBTC"]
+        assert locked == [True]
+        assert self.ledger.get(chain_id, TEST_WALLET["address"], usdt, router) == dex_logic.MAX_UINT256
+
+
+class TestAllowanceLedger(SwapTestBase):
+    """测试授权额度账本"""
+
+    def test_cached_allowance_skips_chain_read(self):
+        """缓存额度足够时不再读取链上授权，并在提交后本地扣减"""
+        amount = 10 * 10 ** 18
+        chain_id = self.net_config["chain_id"]
+        token = dex_logic.resolve_token_address(WITH_WALLET_SIGNAL["token_in"])
+        router = self.net_config["router_address"]
+        self.ledger.set(chain_id, TEST_WALLET["address"], token, router, 3 * amount)
+
+        _, mock_batch = self.run_swap([hex(10 ** 18), hex(amount)])
+        assert len(mock_batch.call_args[0][1]) == 2
+        assert self.ledger.get(chain_id, TEST_WALLET["address"], token, router) == 2 * amount
+
+    def test_insufficient_cache_refreshes_from_chain(self):
+        """缓存额度不足时从链上刷新"""
+        amount = 10 * 10 ** 18
+        chain_id = self.net_config["chain_id"]
+        token = dex_logic.resolve_token_address(WITH_WALLET_SIGNAL["token_in"])
+        router = self.net_config["router_address"]
+        self.ledger.set(chain_id, TEST_WALLET["address"], token, router, amount // 2)
+
+        _, mock_batch = self.run_swap([hex(10 ** 18), hex(amount), hex(5 * amount), hex(0)])
+        assert len(mock_batch.call_args[0][1]) == 4
+        assert self.ledger.get(chain_id, TEST_WALLET["address"], token, router) == 4 * amount
+        self.web3.eth.wait_for_transaction_receipt.assert_not_called()
+
+    def test_reseed_keeps_pending_swaps(self):
+        """重新从链上读取额度时仍扣除尚未上链的swap，已上链的swap不再扣除"""
+        amount = 10 * 10 ** 18
+        chain_id = self.net_config["chain_id"]
+        token = dex_logic.resolve_token_address(WITH_WALLET_SIGNAL["token_in"])
+        router = self.net_config["router_address"]
+        wallet = TEST_WALLET["address"]
+        amount_in = int(float(WITH_WALLET_SIGNAL["amount"]) * 10 ** 18)
+        # 第一笔swap（nonce 0）已提交未上链，之后自己的 Approval 事件使缓存失效
+        self.run_swap([hex(10 ** 18), hex(amount), hex(amount_in), hex(0)])
+        self.ledger.invalidate(chain_id, wallet, token, router)
+        self.web3.eth.account.sign_transaction.reset_mock()
+
+        # 链上额度仍是 amount_in，但已被待上链的swap占用，需要重新授权
+        result, _ = self.run_swap([hex(10 ** 18), hex(amount), hex(amount_in), hex(0)])
+        assert "approve_tx_hash" in result
+        assert self.ledger.seed(chain_id, wallet, token, router, amount_in) == 0
+
+        # 链上nonce越过这些swap后，链上额度即为余量
+        assert self.ledger.seed(chain_id, wallet, token, router, amount_in, confirmed_nonce=3) == amount_in
+
+    def test_approval_event_invalidates(self):
+        """观察到 Approval 事件后缓存失效"""
+        from services.dex_executor.logic.allowance_ledger import ApprovalWatcher, APPROVAL_TOPIC
+        wallet = TEST_WALLET["address"]
+        token = TEST_CONFIG["token_addresses"]["USDT"]
+        router = self.net_config["router_address"]
+        self.ledger.set(1, wallet, token, router, 100)
+        web3 = MagicMock()
+        web3.eth.block_number = 10
+        watcher = ApprovalWatcher(web3, 1, self.ledger)
+        assert watcher.poll() == 0
+
+        web3.eth.block_number = 12
+        # 拉取日志失败时不跳过这段区块
+        web3.eth.get_logs.side_effect = ConnectionError("down")
+        with pytest.raises(ConnectionError):
+            watcher.poll()
+        assert watcher.last_block == 10
+        web3.eth.get_logs.side_effect = None
+        web3.eth.get_logs.return_value = [{
+            "address": token,
+            "topics": [APPROVAL_TOPIC, "0x" + "0" * 24 + wallet[2:].lower(), "0x" + "0" * 24 + router[2:].lower()]
+        }]
+        assert watcher.poll() == 1
+        assert self.ledger.get(1, wallet, token, router) is None
+        log_filter = web3.eth.get_logs.call_args[0][0]
+        assert (log_filter["fromBlock"], log_filter["toBlock"]) == (11, 12)
+
+    def test_approval_watcher_per_network(self):
+        """开启 auto_approve 时每个网络各启动一个 Approval 事件监听，关闭时不启动"""
+        with patch.object(dex_logic, "ApprovalWatcher") as watcher_cls, \
+             patch.dict(dex_logic.APPROVAL_WATCHERS, clear=True):
+            with patch.object(dex_logic, "AUTO_APPROVE", False):
+                assert dex_logic.start_approval_watchers() == {}
+            with patch.object(dex_logic, "AUTO_APPROVE", True):
+                watchers = dex_logic.start_approval_watchers()
+                assert set(watchers) == set(dex_logic.SUPPORTED_NETWORKS)
+                # 已在运行的监听不重复启动
+                dex_logic.start_approval_watchers()
+        chain_ids = [call.args[1] for call in watcher_cls.call_args_list]
+        assert chain_ids == [dex_logic.get_network_config(network)["chain_id"]
+                             for network in dex_logic.SUPPORTED_NETWORKS]
+
+
+class TestGasOracle(SwapTestBase):
+    """测试EIP-1559手续费预言机"""
+
+    def set_fee_history(self):
+        gwei = 10 ** 9
+        self.web3.eth.fee_history.return_value = {
+            "oldestBlock": 100,
+            "baseFeePerGas": [20 * gwei, 22 * gwei, 24 * gwei],
+            "reward": [[1 * gwei, 2 * gwei, 5 * gwei], [1 * gwei, 3 * gwei, 6 * gwei]]
+        }
+
+    def test_fee_params_from_history(self):
+        """根据缓存的fee history生成type-2手续费字段"""
+        gwei = 10 ** 9
+        self.set_fee_history()
+        oracle = GasOracle(self.web3, base_fee_multiplier=2)
+        assert oracle.fee_params() == {"gasPrice": 5 * gwei}
+        oracle.refresh()
+        assert oracle.fee_params() == {"type": 2, "maxPriorityFeePerGas": 3 * gwei, "maxFeePerGas": 51 * gwei}
+        assert oracle.fee_params("fast")["maxPriorityFeePerGas"] == 6 * gwei
+
+    def test_fractional_base_fee_multiplier(self):
+        """小数倍数下maxFeePerGas仍为整数"""
+        gwei = 10 ** 9
+        self.set_fee_history()
+        self.web3.eth.fee_history.return_value["baseFeePerGas"][-1] = 24 * gwei + 1
+        oracle = GasOracle(self.web3, base_fee_multiplier=1.5)
+        oracle.refresh()
+        max_fee = oracle.fee_params()["maxFeePerGas"]
+        assert isinstance(max_fee, int)
+        assert max_fee == 36 * gwei + 1 + 3 * gwei
+
+    def test_apply_config_reconfigures_oracles(self):
+        """配置变化时更新授权策略和已有预言机的参数，无需重建"""
+        oracle = GasOracle(self.web3)
+        with patch.dict(dex_logic.GAS_ORACLES, {"http://rpc": oracle}), \
+             patch.object(dex_logic, "start_approval_watchers") as start_watchers, \
+             patch.multiple(dex_logic, AUTO_APPROVE=False, UNLIMITED_APPROVE=False, APPROVE_MODE="pipeline",
+                            REPLACEMENT_FEE_BUMP=dex_logic.REPLACEMENT_FEE_BUMP):
+            dex_logic.apply_config({"auto_approve": True, "gas": {"priority": "fast", "fallback_gas_price_gwei": 7}})
+            assert dex_logic.AUTO_APPROVE is True
+            assert dex_logic.UNLIMITED_APPROVE is False
+        start_watchers.assert_called_once()
+        assert oracle.priority == "fast"
+        assert oracle.fee_params() == {"gasPrice": 7 * 10 ** 9}
+
+    def test_legacy_fallback(self):
+        """节点不支持eth_feeHistory时退回gasPrice"""
+        self.web3.eth.fee_history.side_effect = ValueError("method not found")
+        self.web3.eth.gas_price = 7
+        oracle = GasOracle(self.web3)
+        oracle.refresh()
+        assert oracle.fee_params() == {"gasPrice": 7}
+
+    def test_gas_limit_cached(self):
+        """gas limit按调用形态缓存，估算失败时使用默认值且不缓存"""
+        oracle = GasOracle(self.web3, gas_limit_margin=1.5)
+        estimate = MagicMock(return_value=100000)
+        assert oracle.gas_limit(("swap", "router", 2), estimate, 250000) == 150000
+        assert oracle.gas_limit(("swap", "router", 2), estimate, 250000) == 150000
+        assert estimate.call_count == 1
+        assert oracle.gas_limit(("swap", "router", 3), MagicMock(side_effect=ValueError), 250000) == 250000
+
+    def test_swap_uses_cached_fees(self):
+        """swap交易使用缓存手续费，且不额外请求gas价格"""
+        self.set_fee_history()
+        self.net_config["gas_oracle"].refresh()
+        self.web3.eth.fee_history.reset_mock()
+        amount = 10 * 10 ** 18
+        self.run_swap([hex(10 ** 18), hex(amount), hex(amount)])
+        self.run_swap([hex(10 ** 18), hex(amount)])
+        signed = [call[0][0] for call in self.web3.eth.account.sign_transaction.call_args_list]
+        assert all(tx["type"] == 2 and "gasPrice" not in tx for tx in signed)
+        assert all(tx["gas"] == 180000 for tx in signed)
+        assert self.web3.eth.estimate_gas.call_count == 1
+        self.web3.eth.fee_history.assert_not_called()
+
+    def test_gas_error_forgets_cached_limit(self):
+        """gas limit 不足导致发送失败时丢弃缓存，下一笔交易重新估算"""
+        amount = 10 * 10 ** 18
+        # 链上nonce表明之前的swap均已上链，授权额度足够，不发送 approve
+        checks = [hex(10 ** 18), hex(amount), hex(amount), hex(100)]
+        self.run_swap(checks)
+        self.web3.eth.send_raw_transaction.side_effect = ValueError("intrinsic gas too low")
+        assert "gas" in self.run_swap(checks)[0]["error"].lower()
+        self.web3.eth.send_raw_transaction.side_effect = None
+        self.run_swap(checks)
+        assert self.web3.eth.estimate_gas.call_count == 2
+        # 与 gas 无关的错误不影响缓存
+        assert self.net_config["gas_oracle"].forget_on_error(("swap",), ValueError("nonce too low")) is False
+
+
+class TestSendErrors(SwapTestBase):
+    """测试swap发送失败时的结果"""
+
+    def test_ambiguous_send_error_marked_unknown(self):
+        """节点未明确拒收时标记交易可能已发出，明确拒收时不标记"""
+        amount = 10 * 10 ** 18
+        checks = [hex(10 ** 18), hex(amount), hex(amount), hex(0)]
+        self.web3.eth.send_raw_transaction.side_effect = ConnectionError("connection reset by peer")
+        result, _ = self.run_swap(checks)
+        assert result["sent"] == "unknown"
+        self.web3.eth.send_raw_transaction.side_effect = ValueError("insufficient funds for gas * price + value")
+        result, _ = self.run_swap(checks)
+        assert "Insufficient ETH" in result["error"]
+        assert "sent" not in result
+        # nonce已被其它交易占用，节点未接受这笔swap
+        self.web3.eth.send_raw_transaction.side_effect = ValueError("nonce too low")
+        result, _ = self.run_swap(checks)
+        assert "Nonce too low" in result["error"]
+        assert "sent" not in result
+
+    def test_signing_failure_not_marked_sent(self):
+        """签名失败时交易没有发往节点，不标记可能已发出，并归还nonce"""
+        amount = 10 * 10 ** 18
+        checks = [hex(10 ** 18), hex(amount), hex(amount), hex(0)]
+        self.web3.eth.account.sign_transaction.side_effect = ValueError("invalid private key")
+        result, _ = self.run_swap(checks)
+        assert "Failed to sign" in result["error"]
+        assert "sent" not in result
+        self.web3.eth.send_raw_transaction.assert_not_called()
+        assert self.net_config["nonce_manager"].allocate(TEST_WALLET["address"]) == 0
+
+
+class TestTransactionReplacement(SwapTestBase):
+    """测试以相同nonce提价替换卡住的交易"""
+
+    def setup_method(self):
+        super().setup_method()
+        self.pending_patch = patch.object(dex_logic, "PENDING_TXS", OrderedDict())
+        self.pending_patch.start()
+        self.wallet_patch = patch.multiple(dex_logic, DEFAULT_WALLET_ADDRESS=TEST_WALLET["address"],
+                                           DEFAULT_PRIVATE_KEY=TEST_WALLET["private_key"])
+        self.wallet_patch.start()
+
+    def teardown_method(self):
+        self.wallet_patch.stop()
+        self.pending_patch.stop()
+        super().teardown_method()
+
+    def test_bump_fees(self):
+        """按比例提价，不低于节点最低替换幅度和当前报价"""
+        tx = {"nonce": 3, "maxPriorityFeePerGas": 100, "maxFeePerGas": 1000}
+        bumped = dex_logic.bump_fees(tx, {"maxPriorityFeePerGas": 50, "maxFeePerGas": 2000}, 1.0)
+        assert bumped["nonce"] == 3
+        assert bumped["maxPriorityFeePerGas"] == 111
+        assert bumped["maxFeePerGas"] == 2000
+        assert dex_logic.bump_fees({"gasPrice": 100}, {}, 1.5)["gasPrice"] == 151
+
+    def test_replace_reuses_nonce(self):
+        """替换交易使用原nonce并提高手续费"""
+        amount = 10 * 10 ** 18
+        result, _ = self.run_swap([hex(10 ** 18), hex(amount), hex(amount)])
+        original = self.web3.eth.account.sign_transaction.call_args[0][0]
+        self.web3.eth.send_raw_transaction.return_value = MagicMock(hex=MagicMock(return_value="0x" + "34" * 32))
+
+        replaced = dex_logic.replace_transaction(result["tx_hash"], 1.2)
+
+        assert replaced["tx_hash"] == "0x" + "34" * 32
+        assert replaced["nonce"] == original["nonce"]
+        resent = self.web3.eth.account.sign_transaction.call_args[0][0]
+        assert resent["nonce"] == original["nonce"]
+        assert resent["gasPrice"] > original["gasPrice"]
+        # 替换交易本身也可以再次替换；记录中不保存私钥
+        assert "0x" + "34" * 32 in dex_logic.PENDING_TXS
+        assert all("private_key" not in record for record in dex_logic.PENDING_TXS.values())
+        assert self.web3.eth.account.sign_transaction.call_args[1]["private_key"] == TEST_WALLET["private_key"]
+
+    def test_replace_signs_real_transaction(self):
+        """使用真实的 eth-account 签名替换交易，广播签名后的原始交易字节"""
+        from eth_account import Account
+        web3 = MagicMock()
+        web3.eth.account = Account
+        web3.eth.send_raw_transaction.side_effect = lambda raw: dex_logic.Web3.keccak(raw)
+        gas_oracle = MagicMock(fee_params=MagicMock(return_value={}))
+        tx = {"from": TEST_WALLET["address"], "to": TEST_WALLET["address"], "value": 0, "gas": 21000,
+              "maxPriorityFeePerGas": 10 ** 9, "maxFeePerGas": 2 * 10 ** 9, "nonce": 7, "chainId": 11155111}
+        dex_logic.record_sent_transaction("0x" + "12" * 32, tx, TEST_WALLET["address"], web3, gas_oracle)
+
+        replaced = dex_logic.replace_transaction("0x" + "12" * 32)
+
+        assert "error" not in replaced
+        raw = web3.eth.send_raw_transaction.call_args[0][0]
+        assert isinstance(raw, bytes)
+        resent = Account.recover_transaction(raw)
+        assert resent == TEST_WALLET["address"]
+        new_hash = dex_logic.Web3.to_hex(dex_logic.Web3.keccak(raw))
+        assert dex_logic._normalize_tx_hash(replaced["tx_hash"]) == new_hash
+        assert new_hash in dex_logic.PENDING_TXS
+        assert replaced["nonce"] == 7
+
+    def test_replace_requires_configured_wallet_key(self):
+        """请求中临时传入私钥的交易不能替换"""
+        amount = 10 * 10 ** 18
+        result, _ = self.run_swap([hex(10 ** 18), hex(amount), hex(amount)])
+        with patch.object(dex_logic, "DEFAULT_WALLET_ADDRESS", "0x" + "00" * 20):
+            replaced = dex_logic.replace_transaction(result["tx_hash"])
+        assert "cannot be replaced" in replaced["error"]
+
+    def test_replace_unknown_or_mined(self):
+        """未知交易返回错误，nonce已被使用时标记为已上链"""
+        assert "error" in dex_logic.replace_transaction("0xdead")
+        amount = 10 * 10 ** 18
+        result, _ = self.run_swap([hex(10 ** 18), hex(amount), hex(amount)])
+        self.web3.eth.send_raw_transaction.side_effect = ValueError("nonce too low")
+        assert dex_logic.replace_transaction(result["tx_hash"])["mined"] is True
+
+    def test_replace_endpoint_requires_internal_token(self):
+        """/dex/replace 只接受携带正确内部令牌的请求，未配置令牌时全部拒绝"""
+        from fastapi import FastAPI
+        from fastapi.testclient import TestClient
+        from services.dex_executor import router as dex_router
+        app = FastAPI()
+        app.include_router(dex_router.router)
+        client = TestClient(app)
+        with patch.object(dex_router, "INTERNAL_API_TOKEN", ""):
+            assert client.post("/dex/replace", json={"tx_hash": "0xdead"}).status_code == 403
+        with patch.object(dex_router, "INTERNAL_API_TOKEN", "secret"):
+            denied = client.post("/dex/replace", json={"tx_hash": "0xdead"}, headers={"X-Internal-Token": "wrong"})
+            allowed = client.post("/dex/replace", json={"tx_hash": "0xdead"}, headers={"X-Internal-Token": "secret"})
+        assert denied.status_code == 403
+        assert "Unknown transaction" in allowed.json()["error"]
+
+
+class TestNonceManager:
+    """测试按钱包在内存中分配nonce"""
+
+    def setup_method(self):
+        self.w3 = MagicMock()
+        self.w3.eth.get_transaction_count.return_value = 7
+        self.manager = NonceManager(self.w3)
+        self.wallet = TEST_WALLET["address"]
+
+    def test_allocate_syncs_once(self):
+        """首次分配时从链上同步，之后从内存递增"""
+        assert [self.manager.allocate(self.wallet) for _ in range(3)] == [7, 8, 9]
+        assert self.w3.eth.get_transaction_count.call_count == 1
+
+    def test_concurrent_allocation_unique(self):
+        """并发分配不会产生重复nonce"""
+        from concurrent.futures import ThreadPoolExecutor
+        with ThreadPoolExecutor(max_workers=8) as pool:
+            nonces = list(pool.map(lambda _: self.manager.allocate(self.wallet), range(200)))
+        assert sorted(nonces) == list(range(7, 207))
+
+    def test_release_fills_gap(self):
+        """发送失败归还的nonce优先被复用"""
+        first = self.manager.allocate(self.wallet)
+        second = self.manager.allocate(self.wallet)
+        self.manager.allocate(self.wallet)
+        self.manager.handle_send_error(self.wallet, second, ValueError("insufficient funds for gas * price + value"))
+        assert self.manager.allocate(self.wallet) == second
+        assert self.manager.allocate(self.wallet) == first + 3
+
+    def test_ambiguous_error_resyncs(self):
+        """超时等无法确定交易是否已发出的错误不回收nonce，而是重新同步"""
+        nonce = self.manager.allocate(self.wallet)
+        self.manager.allocate(self.wallet)
+        self.w3.eth.get_transaction_count.return_value = 9
+        self.manager.handle_send_error(self.wallet, nonce, TimeoutError("read timed out"))
+        assert self.manager.allocate(self.wallet) == 9
+        assert self.w3.eth.get_transaction_count.call_count == 2
+
+    def test_release_tail_rewinds(self):
+        """末尾的nonce归还后直接回退计数器"""
+        self.manager.allocate(self.wallet)
+        last = self.manager.allocate(self.wallet)
+        self.manager.release(self.wallet, last)
+        assert self.manager.allocate(self.wallet) == last
+
+    def test_nonce_error_resyncs(self):
+        """nonce冲突时重新从链上同步"""
+        nonce = self.manager.allocate(self.wallet)
+        self.w3.eth.get_transaction_count.return_value = 20
+        self.manager.handle_send_error(self.wallet, nonce, ValueError("nonce too low"))
+        assert self.manager.allocate(self.wallet) == 20
+        assert self.w3.eth.get_transaction_count.call_count == 2
+
+
 if __name__ == "__main__":
     pytest.main(['-xvs', __file__])
@@ -5,8 +5,8 @@ u7531u4e8eu6267u884cu76d1u63a7u670du52a1u4e3bu8981u8d1fu8d23u94feu4e0au4ea4u6613
 
 import sys
 import os
-import json
 import time
+import threading
 import pytest
 from unittest.mock import patch, MagicMock
 
@@ -124,5 +124,353 @@ class TestMonitorLogic:
         assert status["tx_hash"] == unknown_tx, "u5e94u8fd4u56deu6b63u786eu7684u672au77e5u4ea4u6613u54c8u5e0c"
 
 
+class TestReceiptScheduler:
+    """测试非阻塞监控登记与批量收据轮询"""
+
+    def setup_method(self):
+        from services.execution_monitor.logic import monitor_logic
+        self.logic = monitor_logic
+        self.clear()
+        # 不向真实的 DEX Executor 发起替换请求
+        self.replace_patcher = patch.object(monitor_logic, "request_replacement",
+                                            return_value={"error": "not available"})
+        self.mock_replace = self.replace_patcher.start()
+
+    def teardown_method(self):
+        self.replace_patcher.stop()
+        self.clear()
+
+    def clear(self):
+        self.logic.TRACKED_TXS.clear()
+        self.logic.ALIASES.clear()
+        self.logic.WATCHED.clear()
+        self.logic.UNCHECKED.clear()
+        self.logic.FINALIZED.clear()
+        self.logic.BLOCK_TICKS.clear()
+
+    def advance(self, ticks, network=None):
+        """把网络（默认为默认网络）的区块计数设置为 ticks"""
+        self.logic.BLOCK_TICKS[network or self.logic.network_mode] = ticks
+
+    def test_register_returns_immediately(self):
+        """登记交易应立即返回 pending 状态"""
+        entry = self.logic.register_tx("0xAAA", network="testnet")
+        assert entry["status"] == "pending"
+        assert self.logic.get_tx_status("0xaaa")["tx_hash"] == "0xaaa"
+        assert self.logic.get_tx_status("0xbbb") is None
+
+    def test_poll_receipts_in_batches(self):
+        """未确认交易应按批次通过一次批量请求查询"""
+        hashes = [f"0x{i:064x}" for i in range(5)]
+        for tx_hash in hashes:
+            self.logic.register_tx(tx_hash)
+
+        def fake_batch(rpc_url, calls, **kwargs):
+            results = []
+            for method, params in calls:
+                assert method == "eth_getTransactionReceipt"
+                tx_hash = params[0]
+                if tx_hash == hashes[0]:
+                    results.append({"status": "0x1", "blockNumber": "0x64", "gasUsed": "0x5208"})
+                elif tx_hash == hashes[1]:
+                    results.append({"status": "0x0", "blockNumber": "0x64", "gasUsed": "0x5208"})
+                else:
+                    results.append(None)
+            return results
+
+        with patch.object(self.logic, "BATCH_SIZE", 2), \
+             patch.object(self.logic, "batch_request", side_effect=fake_batch) as mock_batch:
+            resolved = self.logic.poll_receipts()
+
+        assert mock_batch.call_count == 3
+        assert resolved == 2
+        assert self.logic.get_tx_status(hashes[0])["status"] == "confirmed"
+        assert self.logic.get_tx_status(hashes[0])["block"] == 100
+        assert self.logic.get_tx_status(hashes[1])["status"] == "failed"
+        assert self.logic.pending_hashes() == hashes[2:]
+
+    def test_poll_receipts_per_network(self):
+        """交易应通过其登记网络的连接池查询收据"""
+        default_hash = "0x" + "aa" * 32
+        other_hash = "0x" + "bb" * 32
+        self.logic.register_tx(default_hash)
+        self.logic.register_tx(other_hash, network="othernet")
+        other_pool = MagicMock()
+        targets = {}
+
+        def fake_batch(rpc_url, calls, **kwargs):
+            targets[calls[0][1][0]] = rpc_url
+            return [None] * len(calls)
+
+        with patch.dict(self.logic.RPC_POOLS, {"othernet": other_pool}), \
+             patch.object(self.logic, "batch_request", side_effect=fake_batch):
+            self.logic.poll_receipts()
+
+        assert targets[default_hash] is self.logic.RPC_POOL
+        assert targets[other_hash] is other_pool
+        # 未配置的网络回退到默认连接池
+        assert self.logic.get_rpc_pool("unknown-net") is self.logic.RPC_POOL
+
+    def test_evict_final_transactions(self):
+        """最终状态的交易超过保留期或数量上限后应从缓存中移除"""
+        hashes = [f"0x{i:064x}" for i in range(3)]
+        for tx_hash in hashes:
+            self.logic.register_tx(tx_hash)
+        self.logic.ALIASES["0xreplacement"] = hashes[0]
+        self.logic.TRACKED_TXS[hashes[0]]["tx_hashes"].append("0xreplacement")
+        self.logic.apply_receipt(hashes[0], {"status": "0x1", "blockNumber": "0x1", "gasUsed": "0x1"})
+        self.logic.apply_receipt(hashes[1], {"status": "0x1", "blockNumber": "0x1", "gasUsed": "0x1"})
+        now = time.time()
+
+        with patch.object(self.logic, "FINAL_RETENTION", 100), patch.object(self.logic, "MAX_FINAL", 1):
+            # 数量超出上限时先移除最早的
+            assert self.logic.evict_final(now) == 1
+            assert self.logic.get_tx_status(hashes[0]) is None
+            assert "0xreplacement" not in self.logic.ALIASES
+            assert self.logic.get_tx_status(hashes[1])["status"] == "confirmed"
+            # 保留期过后全部移除，未确认的交易不受影响
+            assert self.logic.evict_final(now + 101) == 1
+        assert list(self.logic.TRACKED_TXS) == [hashes[2]]
+
+        # 超时的交易同样进入淘汰队列
+        with patch.object(self.logic, "PENDING_TIMEOUT", 0):
+            self.logic.expire_stale(now + 10)
+        assert self.logic.get_tx_status(hashes[2])["status"] == "timeout"
+        with patch.object(self.logic, "FINAL_RETENTION", 0):
+            assert self.logic.evict_final(now + 20) == 1
+        assert self.logic.TRACKED_TXS == {}
+
+    def test_follower_matches_block_transactions(self):
+        """只对新区块中出现的已登记交易查询收据"""
+        watched = "0x" + "aa" * 32
+        other = "0x" + "bb" * 32
+        self.logic.register_tx(watched)
+        self.logic.register_tx(other)
+        self.logic.take_unchecked()
+
+        follower = self.logic.BlockFollower(interval=0)
+        block_filter = MagicMock()
+        block_filter.get_new_entries.return_value = [b"block-hash"]
+        mock_w3 = MagicMock()
+        mock_w3.eth.filter.return_value = block_filter
+        mock_w3.eth.get_block.return_value = {
+            "transactions": [bytes.fromhex("aa" * 32), bytes.fromhex("cc" * 32)]
+        }
+        with patch.object(self.logic, "w3", mock_w3), \
+             patch.object(self.logic, "poll_receipts") as mock_poll:
+            follower.tick()
+
+        mock_w3.eth.get_block.assert_called_once_with(b"block-hash")
+        mock_poll.assert_called_once_with([watched])
+
+    def test_follower_per_network(self):
+        """每个网络的跟踪线程只检查本网络的交易，区块推进时才查询收据，出块只计入本网络"""
+        testnet_hash = "0x" + "aa" * 32
+        mainnet_hash = "0x" + "bb" * 32
+        self.logic.register_tx(testnet_hash, network="testnet")
+        self.logic.register_tx(mainnet_hash, network="mainnet")
+
+        follower = self.logic.BlockFollower("mainnet", interval=0)
+        follower.polling_only = True
+        mock_w3 = MagicMock()
+        mock_w3.eth.block_number = 7
+        mock_w3.eth.get_block.return_value = {"transactions": [bytes.fromhex("bb" * 32)]}
+        with patch.dict(self.logic.WEB3_CLIENTS, {"mainnet": mock_w3}), \
+             patch.object(self.logic, "poll_receipts") as mock_poll:
+            follower.tick()
+            # 区块没有推进时不查询收据
+            follower.tick()
+        assert [c.args[0] for c in mock_poll.call_args_list] == [[mainnet_hash]]
+        assert self.logic.BLOCK_TICKS == {"mainnet": 1}
+        # 默认网络的首次收据检查留给默认网络的跟踪线程
+        assert self.logic.take_unchecked("testnet") == [testnet_hash]
+
+    def test_scheduler_starts_follower_per_network(self):
+        """为每个配置了节点的网络各启动一个区块跟踪线程"""
+        with patch.object(self.logic, "BlockFollower") as follower_cls, \
+             patch.dict(self.logic.FOLLOWERS, clear=True):
+            followers = self.logic.start_scheduler()
+            assert set(followers) == {"testnet", "mainnet"}
+            self.logic.stop_scheduler()
+            assert self.logic.FOLLOWERS == {}
+        assert sorted(c.args[0] for c in follower_cls.call_args_list) == ["mainnet", "testnet"]
+
+    def test_follower_falls_back_to_block_number_polling(self):
+        """节点不支持区块过滤器时退回 eth_blockNumber 轮询，且每个区块只拉取一次"""
+        self.logic.register_tx("0x01")
+        self.logic.take_unchecked()
+        follower = self.logic.BlockFollower(interval=0)
+        mock_w3 = MagicMock()
+        mock_w3.eth.filter.side_effect = ValueError("method not found")
+        mock_w3.eth.block_number = 10
+        mock_w3.eth.get_block.return_value = {"transactions": []}
+        with patch.object(self.logic, "w3", mock_w3), \
+             patch.object(self.logic, "poll_receipts") as mock_poll:
+            follower.tick()
+            follower.tick()
+            mock_w3.eth.block_number = 12
+            follower.tick()
+
+        assert follower.polling_only is True
+        fetched = [c.args[0] for c in mock_w3.eth.get_block.call_args_list]
+        assert fetched == [10, 11, 12]
+        mock_poll.assert_not_called()
+
+    def test_follower_error_does_not_drop_blocks(self):
+        """拉取区块失败时不前移 last_block，已取出的交易下一轮重新检查"""
+        self.logic.register_tx("0x04")
+        follower = self.logic.BlockFollower(interval=0)
+        follower.polling_only = True
+        follower.last_block = 10
+        mock_w3 = MagicMock()
+        mock_w3.eth.block_number = 12
+        mock_w3.eth.get_block.side_effect = [ConnectionError("down"), {"transactions": []}, {"transactions": []}]
+        with patch.object(self.logic, "w3", mock_w3), \
+             patch.object(self.logic, "poll_receipts") as mock_poll:
+            with pytest.raises(ConnectionError):
+                follower.tick()
+            assert follower.last_block == 10
+            assert self.logic.UNCHECKED == {"0x04"}
+            follower.tick()
+        assert follower.last_block == 12
+        fetched = [c.args[0] for c in mock_w3.eth.get_block.call_args_list]
+        assert fetched == [11, 11, 12]
+        mock_poll.assert_called_once_with(["0x04"])
+
+    def test_new_registration_checked_once(self):
+        """新登记的交易做一次首次收据检查，之后仅依靠区块匹配"""
+        self.logic.register_tx("0x03")
+        follower = self.logic.BlockFollower(interval=0)
+        follower.polling_only = True
+        mock_w3 = MagicMock()
+        mock_w3.eth.block_number = 5
+        mock_w3.eth.get_block.return_value = {"transactions": []}
+        with patch.object(self.logic, "w3", mock_w3), \
+             patch.object(self.logic, "poll_receipts") as mock_poll:
+            follower.tick()
+            follower.tick()
+        mock_poll.assert_called_once_with(["0x03"])
+
+    def test_expire_stale(self):
+        """超时未上链的交易标记为 timeout"""
+        self.logic.register_tx("0x02")
+        self.logic.expire_stale(now=time.time() + self.logic.PENDING_TIMEOUT + 1)
+        assert self.logic.get_tx_status("0x02")["status"] == "timeout"
+
+    def test_stuck_transaction_replaced_after_blocks(self):
+        """连续若干区块未上链的交易按策略提价替换，替换交易参与收据匹配"""
+        original = "0x" + "11" * 32
+        replacement = "0x" + "22" * 32
+        self.logic.register_tx(original, replacement_policy={"after_blocks": 2, "fee_bump": 1.2})
+        self.mock_replace.return_value = {"tx_hash": replacement, "replaced_tx_hash": original}
+
+        self.advance(1)
+        assert self.logic.replace_stuck_transactions() == 0
+        self.advance(2)
+        assert self.logic.replace_stuck_transactions() == 1
+        self.mock_replace.assert_called_once_with(original, 1.2)
+
+        status = self.logic.get_tx_status(replacement)
+        assert status["tx_hash"] == original
+        assert status["replacements"] == 1
+        assert status["tx_hashes"] == [original, replacement]
+        assert replacement in self.logic.WATCHED
+        assert "_policy" not in status
+
+        # 替换交易上链后记录最终哈希，原交易不再匹配
+        self.logic.apply_receipt(replacement, {"status": "0x1", "blockNumber": "0x10", "gasUsed": "0x5208"})
+        status = self.logic.get_tx_status(original)
+        assert status["status"] == "confirmed"
+        assert status["final_tx_hash"] == replacement
+        assert not self.logic.WATCHED
+
+    def test_replacement_counts_blocks_of_own_network(self):
+        """替换时机按交易所在网络的出块数计算，不受其它网络出块影响"""
+        self.logic.register_tx("0x08", network="mainnet", replacement_policy={"after_blocks": 2})
+        self.advance(5, network="testnet")
+        assert self.logic.stuck_transactions() == []
+        self.advance(2, network="mainnet")
+        assert [stuck[0] for stuck in self.logic.stuck_transactions("mainnet")] == ["0x08"]
+        assert self.logic.stuck_transactions("testnet") == []
+
+    def test_replacement_limits(self):
+        """达到最大替换次数或无法替换时停止提价"""
+        self.logic.register_tx("0x04", replacement_policy={"after_blocks": 1, "max_replacements": 1})
+        self.logic.register_tx("0x05", replacement_policy={"after_blocks": 1})
+        self.advance(1)
+
+        def fake_replace(tx_hash, fee_bump):
+            if tx_hash == "0x04":
+                return {"tx_hash": "0x0a"}
+            return {"error": "Unknown transaction"}
+        self.mock_replace.side_effect = fake_replace
+
+        assert self.logic.replace_stuck_transactions() == 1
+        self.advance(5)
+        assert self.logic.replace_stuck_transactions() == 0
+        assert self.mock_replace.call_count == 2
+        assert self.logic.get_tx_status("0x05")["replacement_error"] == "Unknown transaction"
+
+    def test_lowest_nonce_replaced_first(self):
+        """同一钱包卡住的交易先替换nonce最小的 approve，swap 等它上链后才替换"""
+        wallet = "0x" + "ab" * 20
+        self.logic.register_tx("0x0c", replacement_policy={"after_blocks": 1}, wallet_address=wallet, nonce=6)
+        self.logic.register_tx("0x0b", replacement_policy={"after_blocks": 1}, wallet_address=wallet, nonce=5)
+        self.logic.register_tx("0x0d", replacement_policy={"after_blocks": 1}, wallet_address="0x" + "cd" * 20, nonce=1)
+        self.advance(1)
+        assert [stuck[0] for stuck in self.logic.stuck_transactions()] == ["0x0b", "0x0d"]
+
+        self.logic.apply_receipt("0x0b", {"status": "0x1", "blockNumber": "0x1", "gasUsed": "0x1"})
+        assert [stuck[0] for stuck in self.logic.stuck_transactions()] == ["0x0c", "0x0d"]
+
+    def test_replacement_runs_outside_follower(self):
+        """替换请求在单独线程中执行，慢的 DEX Executor 不阻塞区块跟踪"""
+        self.logic.register_tx("0x0e", replacement_policy={"after_blocks": 1})
+        self.logic.take_unchecked()
+        release = threading.Event()
+        self.mock_replace.side_effect = lambda tx_hash, fee_bump: release.wait(5) and {"error": "not available"}
+
+        follower = self.logic.BlockFollower(interval=0)
+        block_filter = MagicMock()
+        block_filter.get_new_entries.return_value = [b"block-hash"]
+        mock_w3 = MagicMock()
+        mock_w3.eth.filter.return_value = block_filter
+        mock_w3.eth.get_block.return_value = {"transactions": []}
+        try:
+            with patch.object(self.logic, "w3", mock_w3):
+                started = time.monotonic()
+                follower.tick()
+                follower.tick()
+                assert time.monotonic() - started < 1
+        finally:
+            release.set()
+            follower._replacing.result(timeout=5)
+            follower.stop()
+        # 上一轮替换仍在进行时不重复提交
+        assert self.mock_replace.call_count == 1
+
+    def test_apply_config_updates_new_registrations(self):
+        """配置服务推送的新替换策略只作用于之后登记的交易"""
+        self.logic.register_tx("0x06")
+        original = self.logic.DEFAULT_REPLACEMENT_POLICY
+        try:
+            self.logic.apply_config({"replacement": {"after_blocks": 7}, "monitor": {"pending_timeout": 60}})
+            self.logic.register_tx("0x07")
+            assert self.logic.PENDING_TIMEOUT == 60
+            assert self.logic.TRACKED_TXS["0x06"]["_policy"]["after_blocks"] == original["after_blocks"]
+            assert self.logic.TRACKED_TXS["0x07"]["_policy"]["after_blocks"] == 7
+        finally:
+            self.logic.apply_config(self.logic.config_data)
+
+    def test_replacement_mined_triggers_receipt_check(self):
+        """nonce 已被使用时不再替换，立即复查收据"""
+        self.logic.register_tx("0x06", replacement_policy={"after_blocks": 1})
+        self.logic.take_unchecked()
+        self.advance(1)
+        self.mock_replace.return_value = {"error": "nonce too low", "mined": True}
+        assert self.logic.replace_stuck_transactions() == 0
+        assert self.logic.take_unchecked() == ["0x06"]
+
+
 if __name__ == "__main__":
     pytest.main(['-xvs', __file__])
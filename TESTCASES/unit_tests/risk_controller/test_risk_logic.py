@@ -5,7 +5,6 @@ u6d4bu8bd5u98ceu63a7u89c4u5219u68c0u67e5u548cu4ea4u6613u8bb0u5f55u529fu80fd
 
 import sys
 import os
-import json
 import time
 import pytest
 from unittest.mock import patch, MagicMock
@@ -27,22 +26,30 @@ class TestRiskLogic:
     def setup_method(self):
         """u6bcfu4e2au6d4bu8bd5u65b9u6cd5u524du7684u8bbeu7f6e"""
         # u91cdu7f6eu98ceu63a7u76f8u5173u7684u5168u5c40u53d8u91cf
-        risk_logic.LAST_TRADE_TIME = 0
-        risk_logic.DAILY_VOLUME = 0
-        risk_logic.DAILY_RESET = time.time() - 100  # u8bbeu7f6eu4e3a100u79d2u524du7684u503c
-        
-        # u4fddu5b58u539fu59cb RISK_PARAMS u5e76u8bbeu7f6eu6d4bu8bd5u503c
-        self.original_params = risk_logic.RISK_PARAMS.copy()
-        risk_logic.RISK_PARAMS = {
+        # 保存原始风控引擎，使用测试参数创建新的引擎
+        self.original_engine = risk_logic.ENGINE
+        risk_logic.ENGINE = risk_logic.RiskEngine({
             "max_trade_amount": 1000,
             "daily_limit": 5000,
             "cooldown": 60
-        }
+        })
     
     def teardown_method(self):
         """u6bcfu4e2au6d4bu8bd5u65b9u6cd5u540eu7684u6e05u7406"""
-        # u6062u590du539fu59cb RISK_PARAMS
-        risk_logic.RISK_PARAMS = self.original_params
+        risk_logic.ENGINE = self.original_engine
+
+    def wallet(self, address=None):
+        """默认钱包的每日交易量分片"""
+        return risk_logic.ENGINE.wallet_shard(address)
+
+    def pair(self, address=None, pair=("", "")):
+        """默认钱包在指定交易对上的冷却分片"""
+        return risk_logic.ENGINE.pair_shard(address, pair)
+
+    def add_trade(self, shard, ago, amount):
+        """在分片的所有窗口中补记一笔 ago 秒前的交易"""
+        for limit in shard.limits:
+            limit.window.add(time.time() - ago, 1, amount)
     
     def test_check_risk_normal(self):
         """u6d4bu8bd5u6b63u5e38u60c5u51b5u4e0bu7684u98ceu63a7u68c0u67e5"""
@@ -62,7 +69,7 @@ class TestRiskLogic:
     def test_check_risk_daily_limit(self):
         """u6d4bu8bd5u6bcfu65e5u4ea4u6613u9650u989du7684u68c0u67e5"""
         # u9996u5148u8bb0u5f55u4e00u4e9bu4ea4u6613u4ee5u8fbeu5230u65e5u9650u989du7684u4e34u754cu503c
-        risk_logic.DAILY_VOLUME = 4600  # u5df2u7ecfu4f7fu7528u4e864600uff0cu8fd8u5269400u7684u7a7au95f4
+        self.add_trade(self.wallet(), 100, 4600)  # u5df2u7ecfu4f7fu7528u4e864600uff0cu8fd8u5269400u7684u7a7au95f4
         
         # u5728u65e5u9650u989du8303u56f4u5185u7684u4ea4u6613
         signal1 = {"amount": "300"}  # u52a0u4e0au5df2u6709u76844600uff0cu603bu8ba14900uff0cu5c0fu4e8e daily_limit (5000)
@@ -78,7 +85,7 @@ class TestRiskLogic:
     def test_check_risk_cooldown(self):
         """u6d4bu8bd5u4ea4u6613u51b7u5374u671fu9650u5236"""
         # u5148u8bb0u5f55u4e00u6b21u4ea4u6613u65f6u95f4
-        risk_logic.LAST_TRADE_TIME = time.time() - 30  # 30u79d2u524du4ea4u6613uff0cu51b7u5374u671fu4e3a60u79d2
+        self.add_trade(self.pair(), 30, 100)  # 30u79d2u524du4ea4u6613uff0cu51b7u5374u671fu4e3a60u79d2
         
         # u5728u51b7u5374u671fu5185u7684u4ea4u6613
         signal = {"amount": "100"}
@@ -87,28 +94,27 @@ class TestRiskLogic:
         assert "cooldown period" in result["reason"].lower(), "u5e94u6307u51fau4ea4u6613u5728u51b7u5374u671fu5185u7684u539fu56e0"
         
         # u5bf9u4e8eu8d85u8fc7u51b7u5374u671fu7684u60c5u51b5u8fdbu884cu6d4bu8bd5
-        risk_logic.LAST_TRADE_TIME = time.time() - 70  # 70u79d2u524du4ea4u6613uff0cu8d85u8fc7u51b7u5374u671f
-        result = risk_logic.check_risk(signal)
+        self.add_trade(self.pair(pair=("", "X")), 70, 100)  # 70u79d2u524du4ea4u6613uff0cu8d85u8fc7u51b7u5374u671f
+        result = risk_logic.check_risk({**signal, "token_out": "X"})
         assert result["allowed"] is True, "u8d85u8fc7u51b7u5374u671fu7684u4ea4u6613u5e94u8be5u88abu5141u8bb8"
     
     def test_daily_reset(self):
         """u6d4bu8bd5u6bcfu65e5u91cdu7f6eu529fu80fd"""
         # u6a21u62dfu524du4e00u5929u7684u6570u636e
-        risk_logic.DAILY_VOLUME = 3000
-        risk_logic.DAILY_RESET = time.time() - 86500  # u8d85u8fc724u5c0fu65f6(86400u79d2)
+        self.add_trade(self.wallet(), 86500, 3000)  # u8d85u8fc724u5c0fu65f6(86400u79d2)
         
         # u6267u884cu98ceu63a7u68c0u67e5uff0cu5e94u8be5u89e6u53d1u6bcfu65e5u91cdu7f6e
         signal = {"amount": "100"}
         result = risk_logic.check_risk(signal)
         
         # u9a8cu8bc1u662fu5426u91cdu7f6eu4e86u6bcfu65e5u91cf
-        assert risk_logic.DAILY_VOLUME == 0, "u8d85u8fc724u5c0fu65f6u540eu5e94u91cdu7f6eu6bcfu65e5u4ea4u6613u91cf"
+        assert risk_logic.ENGINE.wallet_volume() == 100, "u8d85u8fc724u5c0fu65f6u540eu5e94u91cdu7f6eu6bcfu65e5u4ea4u6613u91cf"
         assert result["allowed"] is True, "u91cdu7f6eu540eu7684u4ea4u6613u5e94u8be5u88abu5141u8bb8"
     
     def test_record_trade(self):
         """u6d4bu8bd5u4ea4u6613u8bb0u5f55u529fu80fd"""
         # u8bb0u5f55u524du7684u521du59cbu91cf
-        initial_volume = risk_logic.DAILY_VOLUME
+        initial_volume = risk_logic.ENGINE.wallet_volume()
         
         # u8bb0u5f55u4e00u6b21u4ea4u6613
         trade = {"amount": "200"}
@@ -116,8 +122,230 @@ class TestRiskLogic:
         
         # u9a8cu8bc1u7ed3u679c
         assert result["recorded"] is True, "u4ea4u6613u8bb0u5f55u5e94u8fd4u56deu6210u529f"
-        assert risk_logic.DAILY_VOLUME == initial_volume + 200, "u6bcfu65e5u4ea4u6613u91cfu5e94u589eu52a0u4ea4u6613u91d1u989d"
-        assert result["current_daily_volume"] == risk_logic.DAILY_VOLUME, "u8fd4u56deu7684u5f53u524du6bcfu65e5u91cfu5e94u4e0eu5185u90e8u8bb0u5f55u4e00u81f4"
+        assert risk_logic.ENGINE.wallet_volume() == initial_volume + 200, "u6bcfu65e5u4ea4u6613u91cfu5e94u589eu52a0u4ea4u6613u91d1u989d"
+        assert result["current_daily_volume"] == risk_logic.ENGINE.wallet_volume(), "u8fd4u56deu7684u5f53u524du6bcfu65e5u91cfu5e94u4e0eu5185u90e8u8bb0u5f55u4e00u81f4"
+
+
+    def test_check_reserves_daily_volume(self):
+        """通过风控即预占额度，带预占编号的记录不重复计入"""
+        result = risk_logic.check_risk({"amount": "800", "token_in": "USDT", "token_out": "WBTC"})
+        assert result["allowed"] and result["reservation_id"]
+        assert self.wallet().reserved == 800
+        risk_logic.record_trade({"amount": "800", "reservation_id": result["reservation_id"]})
+        assert self.wallet().reserved == 0
+        assert risk_logic.ENGINE.wallet_volume() == 800
+        assert risk_logic.ENGINE.status()["reservations"] == 0
+
+    def test_shards_are_independent(self):
+        """冷却按钱包和交易对分片，互不影响；买卖方向共用同一交易对"""
+        buy = {"amount": "10", "token_in": "USDT", "token_out": "WBTC"}
+        assert risk_logic.check_risk(buy)["allowed"] is True
+        assert risk_logic.check_risk({**buy, "token_in": "WBTC", "token_out": "USDT"})["allowed"] is False
+        assert risk_logic.check_risk({**buy, "token_out": "WETH"})["allowed"] is True
+        assert risk_logic.check_risk({**buy, "wallet_address": "0xABC"})["allowed"] is True
+        assert self.wallet("0xabc").reserved == 10
+
+    def test_concurrent_checks_respect_limits(self):
+        """并发检查不会同时通过冷却期，也不会超出每日限额"""
+        import threading
+        barrier = threading.Barrier(20)
+        results = []
+
+        def worker(signal):
+            barrier.wait()
+            results.append(risk_logic.check_risk(signal)["allowed"])
+
+        # 同一交易对的并发信号只有一个能通过冷却期
+        threads = [threading.Thread(target=worker, args=({"amount": "1", "token_in": "A", "token_out": "B"},))
+                   for _ in range(20)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        assert results.count(True) == 1
+
+        # 不同交易对的并发信号共享每日限额：5000 / 1000 = 5 笔
+        results.clear()
+        risk_logic.ENGINE = risk_logic.RiskEngine(risk_logic.ENGINE.params)
+        threads = [threading.Thread(target=worker, args=({"amount": "1000", "token_in": f"T{i}", "token_out": "B"},))
+                   for i in range(20)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        assert results.count(True) == 5
+        assert self.wallet().reserved == 5000
+
+    def test_release_restores_limits(self):
+        """释放预占后额度和冷却立即恢复，重复释放无效"""
+        signal = {"amount": "1000", "token_in": "USDT", "token_out": "WBTC"}
+        reservation_id = risk_logic.check_risk(signal)["reservation_id"]
+        assert risk_logic.check_risk(signal)["allowed"] is False
+        assert risk_logic.release_reservation({"reservation_id": reservation_id})["released"] is True
+        assert risk_logic.ENGINE.wallet_volume() == 0
+        assert risk_logic.release_reservation({"reservation_id": reservation_id})["released"] is False
+        assert risk_logic.check_risk(signal)["allowed"] is True
+
+    def test_reservation_expires(self):
+        """超过有效期未提交的预占自动释放；过期后提交按交易数据补记"""
+        clock = MagicMock(return_value=1000.0)
+        engine = risk_logic.RiskEngine({**risk_logic.ENGINE.params, "reservation_ttl": 30}, clock=clock)
+        first = engine.check_risk({"amount": "700", "token_in": "A", "token_out": "B"})
+        second = engine.check_risk({"amount": "300", "token_in": "A", "token_out": "C"})
+        clock.return_value = 1031.0
+        assert engine.expire_reservations() == 2
+        assert engine.wallet_volume() == 0
+        assert engine.commit(first["reservation_id"])["committed"] is False
+        result = engine.commit(second["reservation_id"], {"amount": "300", "token_in": "C", "token_out": "A"})
+        assert result["recorded"] is True
+        assert engine.wallet_volume() == 300
+        # 补记同样计入交易对窗口
+        assert engine.check_risk({"amount": "1", "token_in": "A", "token_out": "C"})["reason"] == \
+            "Cooldown period not elapsed"
+        assert engine.check_risk({"amount": "1", "token_in": "A", "token_out": "B"})["allowed"] is True
+
+    def test_check_risk_batch(self):
+        """批量检查逐条预占，批内靠前的信号先占用额度"""
+        signals = [{"amount": "1000", "token_in": f"T{i}", "token_out": "B"} for i in range(6)]
+        results = risk_logic.check_risk_batch(signals)["results"]
+        assert [r["allowed"] for r in results] == [True] * 5 + [False]
+        assert results[5]["reason"] == "Daily volume limit exceeded"
+
+    def test_check_risk_batch_invalid_item(self):
+        """批内格式错误的信号单独拒绝，其余信号正常预占"""
+        signals = [{"amount": "100", "token_in": "A", "token_out": "B"},
+                   {"amount": "abc", "token_in": "C", "token_out": "D"},
+                   "not a signal",
+                   {"amount": "200", "token_in": "E", "token_out": "F"}]
+        results = risk_logic.check_risk_batch(signals)["results"]
+        assert [r["allowed"] for r in results] == [True, False, False, True]
+        assert results[1]["reason"].startswith("Invalid signal")
+        assert risk_logic.ENGINE.wallet_volume() == 300
+        # 拒绝的信号没有占用交易对的冷却
+        assert risk_logic.check_risk({"amount": "100", "token_in": "C", "token_out": "D"})["allowed"] is True
+
+    def test_configured_windows(self):
+        """按配置的窗口限制交易笔数和交易量，窗口滑动后额度恢复"""
+        clock = MagicMock(return_value=1000.0)
+        engine = risk_logic.RiskEngine({
+            "max_trade_amount": 1000,
+            "windows": [
+                {"scope": "wallet", "seconds": 10, "max_trades": 3},
+                {"scope": "pair", "seconds": 60, "max_volume": 150}
+            ]
+        }, clock=clock)
+        signal = {"amount": "50", "token_in": "A", "token_out": "B"}
+        assert [engine.check_risk(signal)["allowed"] for _ in range(4)] == [True, True, True, False]
+        assert "Trade rate limit" in engine.check_risk({**signal, "token_out": "C"})["reason"]
+
+        clock.return_value = 1011.0
+        assert engine.check_risk({**signal, "token_out": "C"})["allowed"] is True
+        assert "Volume limit" in engine.check_risk(signal)["reason"]
+
+        clock.return_value = 1061.0
+        assert engine.check_risk(signal)["allowed"] is True
+
+    def test_sliding_window_memory_is_fixed(self):
+        """窗口内存固定，过期的桶在时间前进时清空"""
+        window = risk_logic.SlidingWindow(60, buckets=6)
+        for second in range(0, 600, 5):
+            window.add(float(second), 1, 1.0)
+        assert len(window.counts) == 6
+        assert window.totals(595.0) == (12, 12.0)
+        assert window.totals(10000.0) == (0, 0.0)
+
+
+
+class TestRiskJournal:
+    """测试风控状态日志的持久化与重放"""
+
+    def make_engine(self, clock):
+        return risk_logic.RiskEngine({"max_trade_amount": 1000, "daily_limit": 5000, "cooldown": 60,
+                                      "reservation_ttl": 300}, clock=clock)
+
+    def open_journal(self, directory, engine, segment_events=10000):
+        journal = risk_logic.RiskJournal(str(directory), lambda: self.make_engine(engine.clock),
+                                         segment_events=segment_events)
+        stats = journal.load(engine)
+        engine.journal = journal
+        return journal, stats
+
+    def test_restart_restores_state(self, tmp_path):
+        """重启后额度、冷却和未提交的预占都从日志恢复"""
+        clock = MagicMock(return_value=1000.0)
+        engine = self.make_engine(clock)
+        journal, _ = self.open_journal(tmp_path, engine)
+        committed = engine.check_risk({"amount": "1000", "token_in": "A", "token_out": "B"})
+        released = engine.check_risk({"amount": "1000", "token_in": "A", "token_out": "C"})
+        pending = engine.check_risk({"amount": "1000", "token_in": "A", "token_out": "D"})
+        engine.commit(committed["reservation_id"])
+        engine.release(released["reservation_id"])
+        engine.record_trade({"amount": "500"})
+        journal.close()
+
+        restored = self.make_engine(clock)
+        _, stats = self.open_journal(tmp_path, restored)
+        assert stats["events"] == 6
+        assert restored.wallet_volume() == 2500
+        assert restored.check_risk({"amount": "1", "token_in": "B", "token_out": "A"})["reason"] == \
+            "Cooldown period not elapsed"
+        assert restored.check_risk({"amount": "1", "token_in": "A", "token_out": "C"})["allowed"] is True
+        assert restored.commit(pending["reservation_id"])["committed"] is True
+
+    def test_compaction_snapshot(self, tmp_path):
+        """日志段写满后压缩为快照，重启结果与压缩前一致"""
+        clock = MagicMock(return_value=1000.0)
+        engine = self.make_engine(clock)
+        journal, _ = self.open_journal(tmp_path, engine, segment_events=4)
+        reservations = []
+        for i in range(5):
+            reservations.append(engine.check_risk({"amount": "100", "token_in": f"T{i}", "token_out": "B"}))
+            journal.flush()
+        engine.release(reservations[0]["reservation_id"])
+        journal.close()
+        assert (tmp_path / "snapshot.json").exists()
+
+        restored = self.make_engine(clock)
+        _, stats = self.open_journal(tmp_path, restored)
+        assert stats["snapshot"] is True
+        assert restored.wallet_volume() == 400
+        assert restored.release(reservations[4]["reservation_id"])["released"] is True
+        assert restored.release(reservations[0]["reservation_id"])["released"] is False
+
+    def test_crash_after_snapshot_removes_compacted_segments(self, tmp_path):
+        """快照写入后、删除旧日志段前崩溃，重启时删除已合并进快照的日志段"""
+        clock = MagicMock(return_value=1000.0)
+        engine = self.make_engine(clock)
+        journal, _ = self.open_journal(tmp_path, engine, segment_events=4)
+        for i in range(4):
+            engine.check_risk({"amount": "100", "token_in": f"T{i}", "token_out": "B"})
+        with patch("os.remove"):
+            journal.flush()
+        journal.close()
+        assert (tmp_path / "snapshot.json").exists()
+        assert (tmp_path / "journal-00000001.log").exists()
+
+        restored = self.make_engine(clock)
+        _, stats = self.open_journal(tmp_path, restored)
+        assert stats["events"] == 0
+        assert restored.wallet_volume() == 400
+        assert not (tmp_path / "journal-00000001.log").exists()
+
+    def test_torn_tail_ignored(self, tmp_path):
+        """崩溃时写了一半的最后一行被忽略"""
+        clock = MagicMock(return_value=1000.0)
+        engine = self.make_engine(clock)
+        journal, _ = self.open_journal(tmp_path, engine)
+        engine.record_trade({"amount": "100"})
+        journal.flush()
+        with open(journal._segment_path(journal._segment), "a") as f:
+            f.write('{"op":"record","wal')
+        journal.close()
+
+        restored = self.make_engine(clock)
+        _, stats = self.open_journal(tmp_path, restored)
+        assert stats["events"] == 1
+        assert restored.wallet_volume() == 100
 
 
 if __name__ == "__main__":
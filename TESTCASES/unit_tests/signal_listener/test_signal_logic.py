@@ -3,9 +3,11 @@
 import sys
 import os
 import json
+import asyncio
+import time
 import pytest
-import requests
-import requests_mock
+from collections import defaultdict
+import httpx
 from unittest.mock import patch, MagicMock
 
 # 添加项目根目录到Python路径，以便能够导入服务代码
@@ -13,6 +15,11 @@ sys.path.append(os.path.join(os.path.dirname(__file__), '..', '..', '..'))
 
 # 导入待测试的模块
 from services.signal_listener.logic import signal_logic
+from services.signal_listener.logic.dispatch_queue import DispatchQueue
+from services.signal_listener.logic.idempotency import IdempotencyCache
+from services.signal_listener.logic.admission import AdmissionQueue, AdmissionRejected, classify
+from services.signal_listener.logic.signal_history import SignalHistory
+from services.risk_controller.logic import risk_logic
 from TESTCASES.test_config import TEST_SIGNALS
 
 # 设置测试信号
@@ -21,11 +28,44 @@ TOKEN_SIGNAL = TEST_SIGNALS["token_format"]
 ADDRESS_SIGNAL = TEST_SIGNALS["address_format"]
 
 
+class MockDownstream:
+    """基于 httpx.MockTransport 模拟下游服务，按 URL 注册响应"""
+
+    def __init__(self):
+        self.routes = {}
+        self.calls = []
+
+    def post(self, url, json=None):
+        self.routes[url] = json
+
+    def handler(self, request):
+        url = str(request.url)
+        self.calls.append(url)
+        if url not in self.routes:
+            raise httpx.ConnectError(f"No mock registered for {url}", request=request)
+        if isinstance(self.routes[url], Exception):
+            raise self.routes[url]
+        return httpx.Response(200, json=self.routes[url])
+
+
 @pytest.fixture
 def mock_requests():
-    """使用requests_mock模拟HTTP请求"""
-    with requests_mock.Mocker() as m:
-        yield m
+    """为每个下游服务注入使用 MockTransport 的 AsyncClient"""
+    downstream = MockDownstream()
+    transport = httpx.MockTransport(downstream.handler)
+    for name, base_url in signal_logic.SERVICE_URLS.items():
+        signal_logic._clients[name] = httpx.AsyncClient(base_url=base_url, transport=transport)
+    # 各测试使用相同的信号，清空幂等缓存
+    with patch.object(signal_logic, "IDEMPOTENCY", IdempotencyCache()), \
+         patch.object(signal_logic, "ADMISSION", AdmissionQueue()), \
+         patch.object(signal_logic, "HISTORY", SignalHistory()):
+        yield downstream
+    signal_logic._clients.clear()
+
+
+def run(coro):
+    """在新的事件循环中运行协程"""
+    return asyncio.run(coro)
 
 
 class TestSignalLogic:
@@ -113,7 +153,7 @@ class TestSignalLogic:
         )
         
         # 执行测试 - 使用代币符号格式
-        result = signal_logic.handle_signal(TOKEN_SIGNAL.copy())
+        result = run(signal_logic.handle_signal(TOKEN_SIGNAL.copy()))
         
         # 验证结果
         assert result.get("status") == "success"
@@ -121,6 +161,314 @@ class TestSignalLogic:
         assert result.get("token_in") == TOKEN_SIGNAL.get("token_in")
         assert result.get("token_out") == TOKEN_SIGNAL.get("token_out")
 
+    def test_handle_signal_reuses_pooled_clients(self, mock_requests):
+        """测试并发信号复用同一组连接池客户端"""
+        mock_requests.post("http://risk_controller:52120/risk/check", json={"allowed": True})
+        mock_requests.post("http://dex_executor:52130/dex/execute", json={"tx_hash": "0xabc"})
+        mock_requests.post("http://execution_monitor:52140/monitor/tx", json={"status": "pending"})
+        mock_requests.post("http://risk_controller:52120/risk/record", json={"recorded": True})
+        clients_before = dict(signal_logic._clients)
+
+        async def burst():
+            return await asyncio.gather(*[signal_logic.handle_signal(dict(TOKEN_SIGNAL, wallet_address=f"0x{i:040x}"))
+                                          for i in range(10)])
+
+        results = run(burst())
+
+        assert all(r.get("status") == "success" for r in results)
+        assert signal_logic._clients == clients_before
+        # 每个信号只同步调用风控检查和DEX执行，监控和记录进入后台队列
+        assert len(mock_requests.calls) == 20
+        assert signal_logic.DISPATCHER.depth() >= 20
+
+    def test_reservation_committed_or_released(self, mock_requests):
+        """交易发出时随记录提交预占编号，DEX执行失败时释放预占"""
+        mock_requests.post("http://risk_controller:52120/risk/check",
+                           json={"allowed": True, "reservation_id": "r1"})
+        mock_requests.post("http://dex_executor:52130/dex/execute", json={"error": "Insufficient balance"})
+        mock_requests.post("http://risk_controller:52120/risk/release", json={"released": True})
+        submitted = []
+
+        async def fake_submit(name, job, **kwargs):
+            submitted.append((name, await job()))
+
+        with patch.object(signal_logic.DISPATCHER, "submit", side_effect=fake_submit), \
+             patch.object(signal_logic, "post_json", side_effect=lambda service, path, payload: (path, payload)):
+            result = run(signal_logic.handle_signal(TOKEN_SIGNAL.copy()))
+            assert result["status"] == "failed"
+            assert submitted == [("release", ("/risk/release", {"reservation_id": "r1"}))]
+
+            submitted.clear()
+            mock_requests.post("http://dex_executor:52130/dex/execute", json={"tx_hash": "0xabc"})
+            result = run(signal_logic.handle_signal(TOKEN_SIGNAL.copy()))
+        assert result["status"] == "success"
+        record = dict(submitted)["record"]
+        assert record[0] == "/risk/record"
+        assert record[1]["reservation_id"] == "r1"
+
+    @pytest.mark.parametrize("error", [httpx.ReadTimeout("timed out"), httpx.ReadError("connection reset"),
+                                       httpx.RemoteProtocolError("server disconnected")])
+    def test_reservation_committed_on_dex_timeout(self, mock_requests, error):
+        """DEX请求超时或发出后连接出错时交易可能已发出，提交预占而不是等待其过期释放"""
+        mock_requests.post("http://risk_controller:52120/risk/check",
+                           json={"allowed": True, "reservation_id": "r1"})
+        mock_requests.post("http://dex_executor:52130/dex/execute", json=error)
+        submitted = []
+
+        async def fake_submit(name, job, **kwargs):
+            submitted.append((name, await job()))
+
+        with patch.object(signal_logic.DISPATCHER, "submit", side_effect=fake_submit), \
+             patch.object(signal_logic, "post_json", side_effect=lambda service, path, payload: (path, payload)):
+            result = run(signal_logic.handle_signal(TOKEN_SIGNAL.copy()))
+        assert result["status"] == "unknown"
+        assert submitted == [("commit", ("/risk/commit", signal_logic.trade_data(TOKEN_SIGNAL, "r1")))]
+
+    def test_reservation_released_on_dex_connect_error(self, mock_requests):
+        """无法连接DEX时请求没有送达，释放预占"""
+        mock_requests.post("http://risk_controller:52120/risk/check",
+                           json={"allowed": True, "reservation_id": "r1"})
+        submitted = []
+
+        async def fake_submit(name, job, **kwargs):
+            submitted.append((name, await job()))
+
+        with patch.object(signal_logic.DISPATCHER, "submit", side_effect=fake_submit), \
+             patch.object(signal_logic, "post_json", side_effect=lambda service, path, payload: (path, payload)):
+            result = run(signal_logic.handle_signal(TOKEN_SIGNAL.copy()))
+        assert "DEX execution failed" in result["error"]
+        assert submitted == [("release", ("/risk/release", {"reservation_id": "r1"}))]
+
+    def test_expired_reservation_commit_records_trade(self, mock_requests):
+        """DEX超时后提交时预占已过期，风控按提交中的交易数据补记，交易仍计入限额"""
+        now = [1000.0]
+        engine = risk_logic.RiskEngine(clock=lambda: now[0])
+        signal = dict(TOKEN_SIGNAL, wallet_address="0xwallet")
+        mock_requests.post("http://risk_controller:52120/risk/check", json=engine.check_risk(signal))
+        mock_requests.post("http://dex_executor:52130/dex/execute", json=httpx.ReadTimeout("timed out"))
+
+        async def risk_controller(service, path, payload):
+            # 提交到达风控之前预占已过期并被释放
+            now[0] += risk_logic.RISK_PARAMS["reservation_ttl"] + 1
+            engine.expire_reservations()
+            assert path == "/risk/commit"
+            return risk_logic.commit_reservation(payload)
+
+        async def scenario():
+            dispatcher = DispatchQueue(base_delay=0.01)
+            await dispatcher.start()
+            with patch.object(signal_logic, "DISPATCHER", dispatcher):
+                result = await signal_logic.handle_signal(dict(signal))
+            await dispatcher.stop()
+            return result, dispatcher.stats()
+
+        with patch.object(risk_logic, "ENGINE", engine), \
+             patch.object(signal_logic, "post_json", side_effect=risk_controller):
+            result, stats = run(scenario())
+        assert result["status"] == "unknown"
+        assert stats["completed"] == 1 and stats["failed"] == 0
+        assert engine.wallet_volume("0xwallet") == 10.0
+
+    def test_pipelined_approve_registered_for_monitoring(self, mock_requests):
+        """流水线发送的 approve 与 swap 一起登记监控，并带上钱包和nonce"""
+        mock_requests.post("http://risk_controller:52120/risk/check", json={"allowed": True})
+        mock_requests.post("http://dex_executor:52130/dex/execute", json={
+            "tx_hash": "0xswap", "nonce": 8, "wallet_address": "0xwallet",
+            "approve_tx_hash": "0xapprove", "approve_nonce": 7})
+        submitted = []
+
+        async def fake_submit(name, job, **kwargs):
+            submitted.append((name, await job()))
+
+        with patch.object(signal_logic.DISPATCHER, "submit", side_effect=fake_submit), \
+             patch.object(signal_logic, "post_json", side_effect=lambda service, path, payload: (path, payload)):
+            result = run(signal_logic.handle_signal(TOKEN_SIGNAL.copy()))
+        assert result["status"] == "success"
+        registered = [payload for name, (path, payload) in submitted if name == "monitor"]
+        assert [(p["tx_hash"], p["wallet_address"], p["nonce"]) for p in registered] == \
+            [("0xapprove", "0xwallet", 7), ("0xswap", "0xwallet", 8)]
+
+    def test_ambiguous_send_error_commits_and_caches(self, mock_requests):
+        """DEX发送结果不确定时提交预占并缓存结果，重试的信号不会再次下单"""
+        mock_requests.post("http://risk_controller:52120/risk/check",
+                           json={"allowed": True, "reservation_id": "r1", "expires_at": 1234567890})
+        mock_requests.post("http://dex_executor:52130/dex/execute",
+                           json={"error": "Transaction submission failed: connection reset", "sent": "unknown"})
+        submitted = []
+
+        async def fake_submit(name, job, **kwargs):
+            submitted.append((name, await job(), kwargs.get("deadline")))
+
+        signal = dict(TOKEN_SIGNAL, signal_id="ambiguous-1")
+        with patch.object(signal_logic.DISPATCHER, "submit", side_effect=fake_submit), \
+             patch.object(signal_logic, "post_json", side_effect=lambda service, path, payload: (path, payload)):
+            result = run(signal_logic.handle_signal(dict(signal)))
+            retried = run(signal_logic.handle_signal(dict(signal)))
+        assert result["status"] == "unknown"
+        assert submitted == [("commit", ("/risk/commit", signal_logic.trade_data(signal, "r1")), 1234567890)]
+        assert retried["duplicate"] is True
+        assert mock_requests.calls.count("http://dex_executor:52130/dex/execute") == 1
+
+    def test_handle_signal_batch(self, mock_requests):
+        """批量信号一次风控请求，逐条返回结果"""
+        mock_requests.post("http://risk_controller:52120/risk/check/batch", json={"results": [
+            {"allowed": True, "reservation_id": "r1"},
+            {"allowed": False, "reason": "Cooldown period not elapsed"},
+            {"allowed": True, "reservation_id": "r3"}
+        ]})
+        mock_requests.post("http://dex_executor:52130/dex/execute", json={"tx_hash": "0xabc"})
+        signals = [TOKEN_SIGNAL.copy(), {"token_in": "USDT"}, SYMBOL_SIGNAL.copy(),
+                   ADDRESS_SIGNAL.copy()]
+
+        with patch.object(signal_logic.DISPATCHER, "submit") as mock_submit:
+            batch = run(signal_logic.handle_signal_batch(signals))
+
+        results = batch["results"]
+        assert [r.get("status") for r in results] == ["success", None, "rejected", "success"]
+        assert "Invalid signal format" in results[1]["error"]
+        assert batch["summary"] == {"total": 4, "success": 2, "rejected": 1, "throttled": 0, "unknown": 0,
+                                    "failed": 1}
+        # 1次批量风控 + 2次DEX执行
+        assert mock_requests.calls.count("http://risk_controller:52120/risk/check/batch") == 1
+        assert len(mock_requests.calls) == 3
+        assert [c.args[0] for c in mock_submit.call_args_list] == ["monitor", "record"] * 2
+
+    def test_batch_summary_counts_unknown(self, mock_requests):
+        """发送结果不确定的信号单独计数，不计为失败"""
+        mock_requests.post("http://risk_controller:52120/risk/check/batch", json={"results": [
+            {"allowed": True, "reservation_id": "r1"}]})
+        mock_requests.post("http://dex_executor:52130/dex/execute",
+                           json={"error": "Transaction submission failed: connection reset", "sent": "unknown"})
+        with patch.object(signal_logic.DISPATCHER, "submit"):
+            batch = run(signal_logic.handle_signal_batch([TOKEN_SIGNAL.copy()]))
+        assert batch["results"][0]["status"] == "unknown"
+        assert batch["summary"]["unknown"] == 1
+        assert batch["summary"]["failed"] == 0
+
+    def test_batch_endpoint_accepts_json_array(self, mock_requests):
+        """POST /signal/batch 以 JSON 数组作为请求体"""
+        from fastapi import FastAPI
+        from fastapi.testclient import TestClient
+        from services.signal_listener.router import router
+        app = FastAPI()
+        app.include_router(router)
+        mock_requests.post("http://risk_controller:52120/risk/check/batch",
+                           json={"results": [{"allowed": False, "reason": "Daily volume limit exceeded"}]})
+        with patch.object(signal_logic.DISPATCHER, "submit"):
+            response = TestClient(app).post("/signal/batch", json=[TOKEN_SIGNAL.copy()])
+        assert response.status_code == 200
+        assert response.json()["results"][0]["status"] == "rejected"
+        # 超过上限时返回 413
+        with patch.object(signal_logic, "MAX_BATCH_SIZE", 1):
+            response = TestClient(app).post("/signal/batch", json=[TOKEN_SIGNAL.copy()] * 2)
+        assert response.status_code == 413
+
+    def test_handle_signal_batch_risk_unreachable(self, mock_requests):
+        """批量风控失败时所有合法信号返回错误"""
+        batch = run(signal_logic.handle_signal_batch([TOKEN_SIGNAL.copy(), TOKEN_SIGNAL.copy()]))
+        assert all("Risk check failed" in r["error"] for r in batch["results"])
+        assert batch["summary"]["failed"] == 2
+
+    def test_duplicate_signal_not_executed_twice(self, mock_requests):
+        """重试的信号等待首个请求或返回缓存结果，只下单一次"""
+        mock_requests.post("http://risk_controller:52120/risk/check", json={"allowed": True})
+        mock_requests.post("http://dex_executor:52130/dex/execute", json={"tx_hash": "0xabc"})
+        signal = dict(TOKEN_SIGNAL, signal_id="retry-1")
+
+        async def retries():
+            concurrent = await asyncio.gather(*[signal_logic.handle_signal(dict(signal)) for _ in range(3)])
+            later = await signal_logic.handle_signal(dict(signal))
+            by_content = await signal_logic.handle_signal(TOKEN_SIGNAL.copy())
+            again_by_content = await signal_logic.handle_signal(TOKEN_SIGNAL.copy())
+            return concurrent + [later, by_content, again_by_content]
+
+        with patch.object(signal_logic.DISPATCHER, "submit"):
+            results = run(retries())
+
+        assert all(r["tx_hash"] == "0xabc" for r in results)
+        assert [r.get("duplicate", False) for r in results] == [False, True, True, True, False, True]
+        assert mock_requests.calls.count("http://dex_executor:52130/dex/execute") == 2
+
+    def test_in_flight_entries_survive_eviction(self):
+        """缓存超出容量时只淘汰已完成的条目，处理中的重复请求仍等待首个请求"""
+        cache = IdempotencyCache(maxsize=1)
+        calls = []
+
+        async def scenario():
+            gate = asyncio.Event()
+
+            async def slow():
+                calls.append("slow")
+                await gate.wait()
+                return {"status": "success"}
+
+            async def fast():
+                calls.append("fast")
+                return {"status": "success"}
+
+            first = asyncio.ensure_future(cache.run("a", 60, slow))
+            await asyncio.sleep(0)
+            # 容量已满时登记新键，不能挤掉处理中的 "a"
+            await cache.run("b", 60, fast)
+            await cache.run("c", 60, fast)
+            duplicate = asyncio.ensure_future(cache.run("a", 60, slow))
+            await asyncio.sleep(0)
+            gate.set()
+            return await first, await duplicate
+
+        (_, first_dup), (_, second_dup) = run(scenario())
+        assert (first_dup, second_dup) == (False, True)
+        assert calls == ["slow", "fast", "fast"]
+        assert cache.lookup("b") is None
+
+    def test_duplicates_of_throttled_signal_get_429(self):
+        """首个请求被限流时，等待中的重复请求收到同一个 AdmissionRejected，之后可以重试"""
+        cache = IdempotencyCache()
+
+        async def scenario():
+            gate = asyncio.Event()
+
+            async def throttled():
+                await gate.wait()
+                raise AdmissionRejected("entry", retry_after=3)
+
+            first = asyncio.ensure_future(cache.run("a", 60, throttled))
+            await asyncio.sleep(0)
+            duplicate = asyncio.ensure_future(cache.run("a", 60, throttled))
+            await asyncio.sleep(0)
+            gate.set()
+            return await asyncio.gather(first, duplicate, return_exceptions=True)
+
+        first, duplicate = run(scenario())
+        assert isinstance(first, AdmissionRejected)
+        assert duplicate is first and duplicate.retry_after == 3
+        assert cache.lookup("a") is None
+
+    def test_failed_signal_can_be_retried(self, mock_requests):
+        """未下单的结果不缓存，重试会重新处理"""
+        signal = dict(TOKEN_SIGNAL, signal_id="retry-2")
+        assert "Risk check failed" in run(signal_logic.handle_signal(dict(signal)))["error"]
+        mock_requests.post("http://risk_controller:52120/risk/check", json={"allowed": False, "reason": "Cooldown"})
+        result = run(signal_logic.handle_signal(dict(signal)))
+        assert result["status"] == "rejected" and "duplicate" not in result
+
+    def test_batch_deduplicates(self, mock_requests):
+        """批量请求中重复的信号只处理一次"""
+        mock_requests.post("http://risk_controller:52120/risk/check/batch",
+                           json={"results": [{"allowed": True}]})
+        mock_requests.post("http://dex_executor:52130/dex/execute", json={"tx_hash": "0xabc"})
+        signal = dict(TOKEN_SIGNAL, signal_id="batch-1")
+        with patch.object(signal_logic.DISPATCHER, "submit"):
+            batch = run(signal_logic.handle_signal_batch([dict(signal), dict(signal)]))
+        assert [r.get("duplicate", False) for r in batch["results"]] == [False, True]
+        assert batch["summary"]["success"] == 2
+        assert mock_requests.calls.count("http://dex_executor:52130/dex/execute") == 1
+
+    def test_handle_signal_downstream_unreachable(self, mock_requests):
+        """测试风控服务不可达时返回错误"""
+        result = run(signal_logic.handle_signal(TOKEN_SIGNAL.copy()))
+        assert "Risk check failed" in result.get("error", "")
+
     def test_handle_signal_risk_rejected(self, mock_requests):
         """测试风控拒绝的情况"""
         # 模拟风控拒绝
@@ -130,7 +478,7 @@ class TestSignalLogic:
         )
         
         # 执行测试
-        result = signal_logic.handle_signal(TOKEN_SIGNAL.copy())
+        result = run(signal_logic.handle_signal(TOKEN_SIGNAL.copy()))
         
         # 验证结果
         assert result.get("status") == "rejected"
@@ -151,7 +499,7 @@ class TestSignalLogic:
         )
         
         # 执行测试
-        result = signal_logic.handle_signal(TOKEN_SIGNAL.copy())
+        result = run(signal_logic.handle_signal(TOKEN_SIGNAL.copy()))
         
         # 验证结果
         assert result.get("status") == "failed"
@@ -161,12 +509,492 @@ class TestSignalLogic:
         """测试无效信号"""
         # 缺少必要字段的信号
         invalid_signal = {"token_in": "USDT"}
-        result = signal_logic.handle_signal(invalid_signal)
+        result = run(signal_logic.handle_signal(invalid_signal))
         
         # 验证结果
         assert "error" in result
         assert "Invalid signal format" in result.get("error", "")
 
 
+class FakeWebSocket:
+    """模拟 WebSocket：依次返回预置的消息，收到最终状态后断开"""
+
+    def __init__(self, frames):
+        self.frames = list(frames)
+        self.sent = []
+        self.closed = asyncio.Event()
+
+    async def receive_text(self):
+        if self.frames:
+            return self.frames.pop(0)
+        await self.closed.wait()
+        raise ConnectionError("disconnected")
+
+    async def send_text(self, text):
+        message = json.loads(text)
+        self.sent.append(message)
+        if message["type"] == "status" and message["status"] == "confirmed":
+            self.closed.set()
+
+
+class TestSignalStream:
+    """测试 WebSocket 信号流会话"""
+
+    def test_stream_acks_results_and_status(self, mock_requests):
+        """每条信号回复确认和结果，并推送交易状态直到确认"""
+        mock_requests.post("http://risk_controller:52120/risk/check", json={"allowed": True})
+        mock_requests.post("http://dex_executor:52130/dex/execute", json={"tx_hash": "0xabc"})
+        statuses = iter([{"tx_hash": "0xabc", "status": "unknown"},
+                         {"tx_hash": "0xabc", "status": "pending"},
+                         {"tx_hash": "0xabc", "status": "pending"},
+                         {"tx_hash": "0xabc", "status": "confirmed", "block": 100}])
+        monitor = MagicMock(is_closed=False)
+        monitor.get.side_effect = lambda path: asyncio.sleep(0, MagicMock(json=MagicMock(return_value=next(statuses))))
+        signal = dict(TOKEN_SIGNAL, client_id="c1")
+        socket = FakeWebSocket([json.dumps(signal) + "\nnot json\n"])
+
+        async def session():
+            stream = signal_logic.SignalStream(socket)
+            with pytest.raises(ConnectionError):
+                await stream.run()
+
+        with patch.object(signal_logic, "STREAM_STATUS_INTERVAL", 0), \
+             patch.object(signal_logic.DISPATCHER, "submit"), \
+             patch.dict(signal_logic._clients, {"execution_monitor": monitor}):
+            run(asyncio.wait_for(session(), 5))
+
+        kinds = [(m["type"], m["seq"]) for m in socket.sent]
+        assert kinds[:2] == [("ack", 1), ("error", 2)]
+        assert kinds[2:] == [("result", 1), ("status", 1), ("status", 1)]
+        assert socket.sent[0]["client_id"] == "c1"
+        assert socket.sent[2]["result"]["tx_hash"] == "0xabc"
+        assert [m["status"] for m in socket.sent[3:]] == ["pending", "confirmed"]
+        monitor.get.assert_called_with("/monitor/0xabc")
+
+    def test_disconnect_does_not_cancel_pipeline(self, mock_requests):
+        """客户端断开时已接收的信号继续完成风控和下单，只停止推送"""
+        mock_requests.post("http://risk_controller:52120/risk/check", json={"allowed": True})
+        mock_requests.post("http://dex_executor:52130/dex/execute", json={"tx_hash": "0xabc"})
+        socket = FakeWebSocket([json.dumps(TOKEN_SIGNAL)])
+        socket.closed.set()
+
+        async def session():
+            with patch.object(signal_logic, "handle_signal", side_effect=slow_handle):
+                stream = signal_logic.SignalStream(socket)
+                with pytest.raises(ConnectionError):
+                    await stream.run()
+                await asyncio.sleep(0.05)
+            return stream
+
+        handled = []
+        original = signal_logic.handle_signal
+
+        async def slow_handle(signal):
+            await asyncio.sleep(0.01)
+            result = await original(signal)
+            handled.append(result)
+            return result
+
+        with patch.object(signal_logic.DISPATCHER, "submit"):
+            stream = run(asyncio.wait_for(session(), 5))
+        assert handled[0]["status"] == "success"
+        assert [m["type"] for m in socket.sent] == ["ack"]
+        assert not stream._follows
+
+
+class TestAdmissionQueue:
+    """测试带优先级、按钱包限流和合并的信号准入队列"""
+
+    def test_classify(self):
+        assert classify({"action": "stop_loss"}) == "exit"
+        assert classify({"priority": "exit"}) == "exit"
+        assert classify({"side": "buy"}) == "entry"
+
+    def test_exits_run_before_queued_entries(self):
+        """平仓信号不排在开仓信号之后，同一钱包并发受限"""
+        order = []
+
+        async def job(signal, records):
+            order.append(signal["id"])
+            await asyncio.sleep(0)
+            return {"status": "success"}
+
+        async def scenario():
+            queue = AdmissionQueue(max_in_flight=1, per_wallet=1)
+            entries = [queue.submit({"id": f"e{i}", "token_in": f"T{i}", "amount": "1"}, job) for i in range(5)]
+            tasks = [asyncio.ensure_future(c) for c in entries]
+            await asyncio.sleep(0)
+            exit_task = asyncio.ensure_future(queue.submit({"id": "x", "action": "exit", "amount": "1"}, job))
+            await asyncio.gather(*tasks, exit_task)
+
+        run(scenario())
+        assert order[0] == "e0"
+        assert order[1] == "x"
+
+    def test_exit_reserve_kept_free_of_entries(self):
+        """开仓信号占满非预留名额后，平仓信号仍能立即开始处理"""
+        blocker = asyncio.Event()
+        started = []
+
+        async def job(signal, records):
+            started.append(signal["id"])
+            if signal["id"] != "x":
+                await blocker.wait()
+            return {"status": "success"}
+
+        async def scenario():
+            queue = AdmissionQueue(max_in_flight=4, per_wallet=10, exit_reserve=1)
+            entries = [asyncio.ensure_future(queue.submit({"id": f"e{i}", "token_in": f"T{i}", "amount": "1"}, job))
+                       for i in range(5)]
+            await asyncio.sleep(0.01)
+            running = list(started)
+            result = await asyncio.wait_for(queue.submit({"id": "x", "action": "exit", "amount": "1"}, job), 1)
+            blocker.set()
+            await asyncio.gather(*entries)
+            return running, result
+
+        running, result = run(scenario())
+        assert running == ["e0", "e1", "e2"]
+        assert result["status"] == "success"
+
+    def test_cancelled_job_resolves_submitters(self):
+        """处理任务被取消时，提交者（包括合并的信号）得到错误结果而不是一直等待"""
+        async def job(signal, records):
+            asyncio.current_task().cancel()
+            await asyncio.sleep(0)
+
+        async def scenario():
+            queue = AdmissionQueue(max_in_flight=1)
+            first = asyncio.ensure_future(queue.submit({"token_in": "A", "amount": "1"}, job))
+            return await asyncio.wait_for(first, 1), queue.stats()
+
+        result, stats = run(scenario())
+        assert result["error"] == "Signal processing cancelled"
+        assert stats["in_flight"] == 0
+
+    def test_per_wallet_limit(self):
+        """单个钱包的在途信号数不超过上限，其它钱包不受影响"""
+        peak = {}
+        running = defaultdict(int)
+
+        async def job(signal, records):
+            wallet = signal["wallet_address"]
+            running[wallet] += 1
+            peak[wallet] = max(peak.get(wallet, 0), running[wallet])
+            await asyncio.sleep(0.01)
+            running[wallet] -= 1
+            return {"status": "success"}
+
+        async def scenario():
+            queue = AdmissionQueue(max_in_flight=10, per_wallet=2)
+            signals = [{"wallet_address": w, "token_in": f"T{i}", "amount": "1"} for w in ("a", "b") for i in range(6)]
+            await asyncio.gather(*[queue.submit(s, job) for s in signals])
+
+        run(scenario())
+        assert peak == {"a": 2, "b": 2}
+
+    def test_full_queue_rejected_with_retry_after(self):
+        """队列已满时拒绝开仓信号，平仓信号仍可进入"""
+        async def scenario():
+            queue = AdmissionQueue(capacity={"exit": 1, "entry": 2}, max_in_flight=1)
+            blocker = asyncio.Event()
+
+            async def job(signal, records):
+                await blocker.wait()
+                return {"status": "success"}
+
+            tasks = [asyncio.ensure_future(queue.submit({"token_in": f"T{i}", "amount": "1"}, job)) for i in range(3)]
+            await asyncio.sleep(0)
+            with pytest.raises(AdmissionRejected) as excinfo:
+                await queue.submit({"token_in": "T9", "amount": "1"}, job)
+            exit_task = asyncio.ensure_future(queue.submit({"action": "exit", "amount": "1"}, job))
+            await asyncio.sleep(0)
+            blocker.set()
+            await asyncio.gather(*tasks, exit_task)
+            return excinfo.value, queue.stats()
+
+        error, stats = run(scenario())
+        assert error.retry_after >= 1
+        assert stats["rejected"] == 1 and stats["completed"] == 4
+
+    def test_queued_signals_coalesced(self):
+        """排队中的同一交易对同方向信号合并为一笔，数量相加"""
+        executed = []
+
+        async def job(signal, records):
+            executed.append(signal["amount"])
+            await asyncio.sleep(0)
+            return {"status": "success", "tx_hash": "0x1"}
+
+        async def scenario():
+            queue = AdmissionQueue(max_in_flight=1)
+            first = asyncio.ensure_future(queue.submit({"token_in": "A", "token_out": "B", "amount": "1"}, job))
+            await asyncio.sleep(0)
+            merged = [queue.submit({"token_in": "A", "token_out": "B", "amount": amount}, job)
+                      for amount in ("2", "3.5")]
+            other = queue.submit({"token_in": "B", "token_out": "A", "amount": "4"}, job)
+            return await asyncio.gather(first, *merged, other)
+
+        results = run(scenario())
+        assert executed == ["1", "5.5", "4"]
+        assert results[1] == results[2]
+        assert results[1]["coalesced"] == 2 and results[1]["amount"] == "5.5"
+        assert "coalesced" not in results[0]
+
+    def test_coalesce_respects_max_amount(self):
+        """合并后超过单笔上限时不合并，各信号分别执行"""
+        executed = []
+
+        async def job(signal, records):
+            executed.append(signal["amount"])
+            await asyncio.sleep(0)
+            return {"status": "success", "tx_hash": "0x1"}
+
+        async def scenario():
+            queue = AdmissionQueue(max_in_flight=1, max_amount=1000)
+            first = asyncio.ensure_future(queue.submit({"token_in": "A", "token_out": "B", "amount": "1"}, job))
+            await asyncio.sleep(0)
+            queued = [queue.submit({"token_in": "A", "token_out": "B", "amount": amount}, job)
+                      for amount in ("600", "600", "400")]
+            return await asyncio.gather(first, *queued)
+
+        run(scenario())
+        assert executed == ["1", "600", "1000"]
+
+    def test_handle_signal_rejected_when_full(self, mock_requests):
+        """准入队列已满时 handle_signal 抛出 AdmissionRejected，批量请求逐条返回 throttled"""
+        full = AdmissionQueue(capacity={"exit": 0, "entry": 0})
+        mock_requests.post("http://risk_controller:52120/risk/check/batch",
+                           json={"results": [{"allowed": True, "reservation_id": "r1"}]})
+        with patch.object(signal_logic, "ADMISSION", full), \
+             patch.object(signal_logic.DISPATCHER, "submit") as mock_submit:
+            with pytest.raises(AdmissionRejected):
+                run(signal_logic.handle_signal(TOKEN_SIGNAL.copy()))
+            batch = run(signal_logic.handle_signal_batch([dict(TOKEN_SIGNAL, signal_id="b")]))
+        assert batch["results"][0]["status"] == "throttled"
+        assert batch["summary"]["throttled"] == 1
+        assert mock_submit.call_args[0][0] == "release"
+
+
+class TestSignalHistory:
+    """测试信号历史环形缓冲区和查询"""
+
+    def test_ring_evicts_oldest(self):
+        history = SignalHistory(capacity=3)
+        for i in range(5):
+            record = history.begin({"token_in": "usdt", "token_out": f"T{i}"})
+            history.finish(record, {"status": "success"})
+        records = history.query(limit=10)
+        assert [r["pair"] for r in records] == ["USDT/T4", "USDT/T3", "USDT/T2"]
+        # 被覆盖的记录同时从索引中移除
+        assert history.query(pair="USDT/T0") == []
+        assert history.stats()["statuses"] == {"success": 3}
+        assert history.latest().pair == "USDT/T4"
+
+    def test_credentials_not_stored(self):
+        """历史记录不保存信号中的私钥，原信号不被修改"""
+        history = SignalHistory()
+        signal = {"token_in": "USDT", "token_out": "WBTC", "wallet_address": "0xabc", "private_key": "0xsecret"}
+        history.begin(signal)
+        stored = history.query()[0]["signal"]
+        assert "private_key" not in stored
+        assert stored["wallet_address"] == "0xabc"
+        assert signal["private_key"] == "0xsecret"
+
+    def test_query_by_pair_status_and_time(self):
+        history = SignalHistory()
+        outcomes = [("USDT", "WBTC", {"status": "success"}), ("USDT", "WETH", {"status": "rejected"}),
+                    ("USDT", "WBTC", {"error": "boom"}), ("USDT", "WBTC", {"status": "success"})]
+        records = []
+        for token_in, token_out, result in outcomes:
+            record = history.begin({"token_in": token_in, "token_out": token_out})
+            history.finish(record, result)
+            records.append(record)
+        assert [r["seq"] for r in history.query(pair="usdt/wbtc")] == [3, 2, 0]
+        assert [r["seq"] for r in history.query(pair="USDT/WBTC", status="success")] == [3, 0]
+        assert [r["seq"] for r in history.query(status="error")] == [2]
+        assert [r["seq"] for r in history.query(pair="USDT/WBTC", limit=1)] == [3]
+        # 时间范围为左闭右开区间
+        assert [r["seq"] for r in history.query(since=records[1].received_at, until=records[3].received_at)
+                if r["seq"] in (1, 2)] == [2, 1]
+
+    def test_handle_signal_records_outcome_and_timings(self, mock_requests):
+        mock_requests.post("http://risk_controller:52120/risk/check", json={"allowed": True})
+        mock_requests.post("http://dex_executor:52130/dex/execute",
+                           json={"status": "submitted", "tx_hash": "0xabc"})
+        with patch.object(signal_logic.DISPATCHER, "submit"):
+            run(signal_logic.handle_signal(TOKEN_SIGNAL.copy()))
+        run(signal_logic.handle_signal({"amount": "1"}))
+        records = signal_logic.HISTORY.query()
+        assert [r["status"] for r in records] == ["error", "success"]
+        timings = records[1]["timings_ms"]
+        assert all(timings[stage] is not None for stage in ("queue", "risk", "dex", "total"))
+        assert signal_logic.get_latest_signal() == {"amount": "1"}
+
+    def test_coalesced_signals_get_timings(self, mock_requests):
+        """合并处理的信号每条记录都有各阶段耗时"""
+        mock_requests.post("http://risk_controller:52120/risk/check", json={"allowed": True})
+        mock_requests.post("http://dex_executor:52130/dex/execute", json={"tx_hash": "0xabc"})
+
+        async def scenario():
+            with patch.object(signal_logic, "ADMISSION", AdmissionQueue(max_in_flight=1)):
+                signals = [dict(TOKEN_SIGNAL, signal_id=f"c{i}", amount=str(i + 1)) for i in range(3)]
+                return await asyncio.gather(*[signal_logic.handle_signal(s) for s in signals])
+
+        with patch.object(signal_logic.DISPATCHER, "submit"):
+            results = run(scenario())
+        assert results[1].get("coalesced") == 2
+        records = signal_logic.HISTORY.query()
+        assert len(records) == 3
+        for record in records:
+            assert record["status"] == "success"
+            assert all(record["timings_ms"][stage] is not None for stage in ("queue", "risk", "dex", "total"))
+
+    def test_cancelled_signal_record_finished(self, mock_requests):
+        """处理被取消时记录不会停留在 pending"""
+        async def scenario():
+            with patch.object(signal_logic, "process_signal", side_effect=asyncio.CancelledError):
+                with pytest.raises(asyncio.CancelledError):
+                    await signal_logic.handle_signal(TOKEN_SIGNAL.copy())
+
+        run(scenario())
+        record = signal_logic.HISTORY.query()[0]
+        assert record["status"] == "error"
+        assert record["timings_ms"]["total"] is not None
+
+
+class TestDispatchQueue:
+    """后台调用队列测试"""
+
+    def test_retry_with_backoff(self):
+        """测试失败任务按退避策略重试直至成功"""
+        attempts = []
+
+        async def flaky_job():
+            attempts.append(1)
+            if len(attempts) < 3:
+                raise RuntimeError("downstream unavailable")
+
+        async def scenario():
+            queue = DispatchQueue(maxsize=10, workers=2, max_retries=5, base_delay=0.01)
+            await queue.start()
+            await queue.submit("record", flaky_job)
+            await asyncio.sleep(0.2)
+            await queue.stop()
+            return queue.stats()
+
+        stats = run(scenario())
+        assert len(attempts) == 3
+        assert stats["retried"] == 2
+        assert stats["completed"] == 1
+        assert stats["depth"] == 0
+
+    def test_stop_drains_pending_retries(self):
+        """测试停止时退避中的重试立即重新入队执行，而不是随关闭丢失"""
+        attempts = []
+
+        async def flaky_job():
+            attempts.append(1)
+            if len(attempts) < 2:
+                raise RuntimeError("downstream unavailable")
+
+        async def scenario():
+            queue = DispatchQueue(maxsize=10, workers=1, max_retries=5, base_delay=30)
+            await queue.start()
+            await queue.submit("commit", flaky_job)
+            await asyncio.sleep(0.05)
+            assert queue.stats()["retrying"] == 1
+            await queue.stop(timeout=1)
+            return queue.stats()
+
+        stats = run(scenario())
+        assert len(attempts) == 2
+        assert stats["completed"] == 1
+        assert stats["retrying"] == 0
+        assert stats["failed"] == 0
+
+    def test_gives_up_after_max_retries(self):
+        """测试超过最大重试次数后放弃任务"""
+        async def broken_job():
+            raise RuntimeError("always fails")
+
+        async def scenario():
+            queue = DispatchQueue(maxsize=10, workers=1, max_retries=2, base_delay=0.01)
+            await queue.start()
+            await queue.submit("monitor", broken_job)
+            await asyncio.sleep(0.1)
+            await queue.stop()
+            return queue.stats()
+
+        stats = run(scenario())
+        assert stats["failed"] == 1
+        assert stats["completed"] == 0
+
+    def test_deadline_job_retries_past_max_retries(self):
+        """带截止时间的任务超过最大重试次数后仍继续重试，直到截止时间"""
+        attempts = []
+
+        async def flaky_commit():
+            attempts.append(1)
+            if len(attempts) < 4:
+                raise RuntimeError("risk controller restarting")
+
+        async def broken_commit():
+            raise RuntimeError("always fails")
+
+        async def scenario():
+            queue = DispatchQueue(maxsize=10, workers=1, max_retries=2, base_delay=0.01, max_delay=0.01)
+            await queue.start()
+            await queue.submit("commit", flaky_commit, deadline=time.time() + 5)
+            await queue.submit("commit", broken_commit, deadline=time.time() + 0.05)
+            await asyncio.sleep(0.2)
+            await queue.stop()
+            return queue.stats()
+
+        stats = run(scenario())
+        assert len(attempts) == 4
+        assert stats["completed"] == 1
+        assert stats["failed"] == 1
+        assert stats["retrying"] == 0
+
+    def test_rejected_result_retried(self):
+        """校验不通过的返回值（如风控返回 committed 为 false）与失败一样重试"""
+        responses = [{"committed": False, "reason": "Unknown or expired reservation"}, {"recorded": True}]
+
+        async def commit():
+            return responses.pop(0)
+
+        async def scenario():
+            queue = DispatchQueue(maxsize=10, workers=1, base_delay=0.01)
+            await queue.start()
+            await queue.submit("commit", commit, check=signal_logic.ensure_recorded)
+            await asyncio.sleep(0.1)
+            await queue.stop()
+            return queue.stats()
+
+        stats = run(scenario())
+        assert responses == []
+        assert stats["retried"] == 1
+        assert stats["completed"] == 1
+
+    def test_full_queue_runs_inline(self):
+        """测试队列已满时任务在调用方协程内执行"""
+        executed = []
+
+        async def job():
+            executed.append(1)
+
+        async def scenario():
+            queue = DispatchQueue(maxsize=1, workers=1)
+            await queue.submit("first", job)
+            await queue.submit("second", job)
+            return queue.stats()
+
+        stats = run(scenario())
+        assert stats["depth"] == 1
+        assert stats["inline"] == 1
+        assert len(executed) == 1
+
+
 if __name__ == "__main__":
     pytest.main(['-xvs', __file__])
@@ -1,21 +1,50 @@
 # ATM/services/asset_manager/logic/asset_manager_logic.py
-import os, secrets, json
+import os, secrets
 from eth_account import Account
-from web3 import Web3, HTTPProvider
+from web3 import Web3
+# 同时支持Docker环境和本地环境的导入
+try:
+    from services.common.nonce_manager import NonceManager
+    from services.common.gas_oracle import GasOracle
+    from services.common.config_file import load_config
+    from services.common.provider_pool import ProviderPool
+except ImportError:
+    from ...common.nonce_manager import NonceManager
+    from ...common.gas_oracle import GasOracle
+    from ...common.config_file import load_config
+    from ...common.provider_pool import ProviderPool
 
-def get_service_rpcurl(service_name: str) -> str:
-    config_path = os.path.join(os.path.dirname(os.path.dirname(os.path.dirname(__file__))), "config.json")
-    with open(config_path, "r") as f:
-        cfg = json.load(f)
+# ATM_CONFIG_PATH 可指定其它配置文件（如测试使用 config.example.json）
+CONFIG_PATH = os.getenv("ATM_CONFIG_PATH") or \
+    os.path.join(os.path.dirname(os.path.dirname(os.path.dirname(__file__))), "config.json")
+
+def get_network_cfg() -> dict:
+    # 按 mtime 缓存的配置，重复调用不会重新打开和解析文件
+    cfg = load_config(CONFIG_PATH)
     network_mode = cfg.get("network_mode","testnet")
     if network_mode == "mainnet":
-        return cfg.get("mainnet", {}).get("rpc_url")
+        return cfg.get("mainnet", {})
     else:
-        return cfg.get("testnet", {}).get("rpc_url")
+        return cfg.get("testnet", {})
+
+# 连接区块链节点（请修改为正确的RPC地址），配置多个节点时自动选择最快的可用节点
+w3 = Web3(ProviderPool.from_config(get_network_cfg(), load_config(CONFIG_PATH).get("rpc_pool")))
+# 按钱包在内存中分配nonce，与链上仅在首次使用和出错时同步
+nonce_manager = NonceManager(w3)
+# EIP-1559 手续费预言机（参数来自 config.json 的 gas 配置），由服务启动时开启后台刷新
+gas_oracle = GasOracle.from_config(w3, load_config(CONFIG_PATH).get("gas", {}))
+# 链ID：优先使用配置中的值，未配置时只在首次转账时向节点查询一次
+CHAIN_ID = get_network_cfg().get("chain_id")
+
+def get_chain_id():
+    global CHAIN_ID
+    if not CHAIN_ID:
+        CHAIN_ID = w3.eth.chain_id
+    return CHAIN_ID
 
-# 连接区块链节点（请修改为正确的RPC地址）
-RPC_URL = get_service_rpcurl("asset_manager")
-w3 = Web3(HTTPProvider(RPC_URL))
+def apply_config(config: dict):
+    """应用配置服务推送的新快照：手续费参数立即生效，RPC 节点修改后需重启服务"""
+    gas_oracle.configure(config.get("gas", {}))
 
 # 内存中存储钱包信息（生产环境请使用安全存储方案）
 accounts = {}
@@ -59,33 +88,48 @@ def transfer(from_address, to_address, amount, token_address=None):
     if from_address not in accounts:
         return None
     private_key = accounts[from_address]
+    sender = Web3.to_checksum_address(from_address)
+    nonce = None
+    gas_key = None
     try:
+        nonce = nonce_manager.allocate(sender)
         if token_address:
             erc20_abi = [
                 {"constant": False, "inputs": [{"name": "_to", "type": "address"}, {"name": "_value", "type": "uint256"}],
                  "name": "transfer", "outputs": [{"name": "success", "type": "bool"}], "type": "function"}
             ]
             token = w3.eth.contract(address=Web3.to_checksum_address(token_address), abi=erc20_abi)
-            tx = token.functions.transfer(Web3.to_checksum_address(to_address), int(amount)).build_transaction({
-                'from': Web3.to_checksum_address(from_address),
-                'nonce': w3.eth.get_transaction_count(Web3.to_checksum_address(from_address)),
-                'chainId': w3.eth.chain_id,
-                'gas': 100000,
-                'gasPrice': w3.to_wei('5', 'gwei')
+            transfer_call = token.functions.transfer(Web3.to_checksum_address(to_address), int(amount))
+            gas_key = ("transfer", token_address.lower())
+            gas_limit = gas_oracle.gas_limit(
+                gas_key,
+                lambda: transfer_call.estimate_gas({'from': sender}),
+                100000
+            )
+            tx = transfer_call.build_transaction({
+                'from': sender,
+                'nonce': nonce,
+                'chainId': get_chain_id(),
+                'gas': gas_limit,
+                **gas_oracle.fee_params()
             })
         else:
             tx = {
                 'to': Web3.to_checksum_address(to_address),
                 'value': w3.to_wei(amount, 'ether'),
                 'gas': 21000,
-                'gasPrice': w3.to_wei('5', 'gwei'),
-                'nonce': w3.eth.get_transaction_count(Web3.to_checksum_address(from_address)),
-                'chainId': w3.eth.chain_id
+                'nonce': nonce,
+                'chainId': get_chain_id(),
+                **gas_oracle.fee_params()
             }
         signed_tx = w3.eth.account.sign_transaction(tx, private_key=private_key)
         tx_hash = w3.eth.send_raw_transaction(signed_tx.rawTransaction)
         return tx_hash.hex()
     except Exception as e:
+        if nonce is not None:
+            nonce_manager.handle_send_error(sender, nonce, e)
+        if gas_key is not None:
+            gas_oracle.forget_on_error(gas_key, e)
         return None
 
 def switch_account(address):
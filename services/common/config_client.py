@@ -0,0 +1,109 @@
+# ATM/services/common/config_client.py
+import os
+import threading
+import httpx
+# 同时支持Docker环境和本地环境的导入
+try:
+    from services.common.config_file import load_config, default_config_path
+except ImportError:
+    from .config_file import load_config, default_config_path
+
+CONFIG_SERVICE_URL = os.getenv("CONFIG_SERVICE_URL", "http://config_service:52100")
+
+# 不通过配置服务下发的敏感配置段（钱包私钥等），各服务只从本地配置文件读取
+REDACTED_SECTIONS = ("wallet",)
+
+
+class ConfigClient:
+    """
+    各服务内的配置快照缓存。
+
+    取得配置服务的快照之前使用本地配置文件（按 mtime 缓存），之后后台线程对配置服务的
+    GET /config?since=<版本> 长轮询，收到新版本时整体替换快照并通知订阅者。快照一经发布
+    不再修改，读取方只做一次属性访问，热路径上没有文件 I/O；配置服务不可达时继续使用
+    已有快照并定期重试。
+    """
+
+    def __init__(self, base_url=CONFIG_SERVICE_URL, path=None, poll_timeout=30, retry_interval=5):
+        self.base_url = base_url
+        self.path = path or default_config_path()
+        self.poll_timeout = poll_timeout
+        self.retry_interval = retry_interval
+        self.version = None  # 尚未从配置服务取得快照
+        self._config = None
+        self._subscribers = []
+        self._http = None
+        self._thread = None
+        self._stop_event = threading.Event()
+
+    @property
+    def config(self) -> dict:
+        """当前快照（只读）"""
+        if self._config is None:
+            return load_config(self.path)
+        return self._config
+
+    def get(self, key: str, default=None):
+        return self.config.get(key, default)
+
+    def subscribe(self, callback):
+        """注册配置变化回调，参数为新的快照"""
+        self._subscribers.append(callback)
+
+    def apply(self, snapshot: dict) -> bool:
+        """应用配置服务返回的快照，内容有变化时返回 True"""
+        config = dict(snapshot.get("config") or {})
+        local = load_config(self.path)
+        for section in REDACTED_SECTIONS:
+            if section in local:
+                config[section] = local[section]
+        self.version = snapshot.get("version")
+        changed = config != self.config
+        self._config = config
+        if not changed:
+            return False
+        for callback in self._subscribers:
+            try:
+                callback(config)
+            except Exception as e:
+                print(f"Warning: Config subscriber failed: {str(e)}")
+        return True
+
+    def poll_once(self) -> bool:
+        """向配置服务发起一次（长）轮询"""
+        if self._http is None:
+            self._http = httpx.Client(base_url=self.base_url, timeout=self.poll_timeout + 10)
+        params = {"timeout": self.poll_timeout}
+        if self.version is not None:
+            params["since"] = self.version
+        response = self._http.get("/config", params=params)
+        response.raise_for_status()
+        return self.apply(response.json())
+
+    def _run(self):
+        while not self._stop_event.is_set():
+            try:
+                self.poll_once()
+            except Exception as e:
+                print(f"Warning: Config poll failed: {str(e)}")
+                self._stop_event.wait(self.retry_interval)
+
+    def start(self):
+        """启动后台长轮询线程"""
+        if self._thread is not None and self._thread.is_alive():
+            return self
+        self._stop_event.clear()
+        self._thread = threading.Thread(target=self._run, name="config-client", daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        """停止长轮询；正在进行的请求最多在 poll_timeout 后返回，线程为守护线程不阻塞退出"""
+        self._stop_event.set()
+        if self._http is not None:
+            self._http.close()
+            self._http = None
+
+
+# 进程内共享的配置快照
+CONFIG = ConfigClient()
@@ -0,0 +1,82 @@
+# ATM/services/common/config_file.py
+import os
+import json
+import time
+import functools
+import threading
+
+# 两次检查配置文件 mtime 的最小间隔（秒）
+CHECK_INTERVAL = 1.0
+
+
+@functools.lru_cache(maxsize=None)
+def default_config_path() -> str:
+    """
+    环境变量 ATM_CONFIG_PATH 指定的文件优先，其次为Docker容器中的配置文件，
+    否则使用本地开发环境的 services/config.json
+    """
+    if os.getenv("ATM_CONFIG_PATH"):
+        return os.getenv("ATM_CONFIG_PATH")
+    if os.path.isfile("/app/config.json"):
+        return "/app/config.json"
+    return os.path.join(os.path.dirname(os.path.dirname(__file__)), "config.json")
+
+
+class ConfigFile:
+    """
+    按 mtime 失效的配置文件缓存。
+
+    每隔 check_interval 秒最多 stat 一次文件，mtime 或大小变化时才重新解析；
+    其余调用直接返回内存中的字典。文件不存在时返回空字典，解析失败时保留上一次的内容。
+    返回的字典由所有调用方共享，不得修改。
+    """
+
+    def __init__(self, path: str, check_interval=CHECK_INTERVAL):
+        self.path = path
+        self.check_interval = check_interval
+        self._data = {}
+        self._file_state = None
+        self._checked_at = None
+        self._lock = threading.Lock()
+
+    def load(self) -> dict:
+        now = time.monotonic()
+        if self._checked_at is not None and now - self._checked_at < self.check_interval:
+            return self._data
+        with self._lock:
+            if self._checked_at is None or now - self._checked_at >= self.check_interval:
+                self._refresh()
+                self._checked_at = now
+        return self._data
+
+    def _refresh(self):
+        try:
+            st = os.stat(self.path)
+        except OSError:
+            self._data, self._file_state = {}, None
+            return
+        file_state = (st.st_mtime_ns, st.st_size)
+        if file_state == self._file_state:
+            return
+        try:
+            with open(self.path, "r", encoding="utf-8") as f:
+                data = json.load(f)
+        except Exception as e:
+            print(f"Warning: Failed to load config file {self.path}: {str(e)}")
+            return
+        self._data = data if isinstance(data, dict) else {}
+        self._file_state = file_state
+
+
+_files = {}
+_files_lock = threading.Lock()
+
+
+def load_config(path=None) -> dict:
+    """读取配置文件（默认为 default_config_path()），同一路径在进程内共享一份缓存"""
+    path = path or default_config_path()
+    config_file = _files.get(path)
+    if config_file is None:
+        with _files_lock:
+            config_file = _files.setdefault(path, ConfigFile(path))
+    return config_file.load()
@@ -0,0 +1,152 @@
+# ATM/services/common/gas_oracle.py
+import threading
+import time
+from web3 import Web3
+
+# 交易速度档位对应的小费分位数
+SPEED_PERCENTILES = {
+    "slow": 10,
+    "medium": 50,
+    "fast": 90
+}
+# 说明缓存的 gas limit 不够用的错误信息，出现时丢弃该调用形态的估算值
+GAS_LIMIT_ERRORS = ("out of gas", "gas too low", "gas required exceeds")
+
+
+class GasOracle:
+    """
+    EIP-1559 手续费预言机。
+
+    后台线程定期调用 eth_feeHistory，缓存下一块的 base fee 以及各分位数的小费；
+    交易构建时直接从缓存取价，不额外发起 RPC。节点不支持 eth_feeHistory 时
+    退回缓存 eth_gasPrice 并使用 legacy 交易。Gas limit 按调用形态缓存 estimate_gas 结果。
+    """
+
+    def __init__(self, w3, block_count=10, refresh_interval=6, priority="medium",
+                 base_fee_multiplier=2, fallback_gas_price_gwei=5, gas_limit_margin=1.2):
+        self.w3 = w3
+        self.block_count = block_count
+        self.refresh_interval = refresh_interval
+        self.priority = priority
+        self.base_fee_multiplier = base_fee_multiplier
+        self.fallback_gas_price = Web3.to_wei(fallback_gas_price_gwei, "gwei")
+        self.gas_limit_margin = gas_limit_margin
+        self._snapshot = None
+        self._gas_limits = {}
+        self._lock = threading.Lock()
+        self._thread = None
+        self._stop_event = threading.Event()
+
+    @classmethod
+    def from_config(cls, w3, gas_cfg=None):
+        """根据 config.json 中的 gas 配置创建预言机"""
+        return cls(w3).configure(gas_cfg)
+
+    def configure(self, gas_cfg=None):
+        """按 gas 配置更新参数（配置变化时直接调用，不需要重建预言机）"""
+        gas_cfg = gas_cfg or {}
+        self.block_count = gas_cfg.get("fee_history_blocks", 10)
+        self.refresh_interval = gas_cfg.get("refresh_interval", 6)
+        self.priority = gas_cfg.get("priority", "medium")
+        self.base_fee_multiplier = gas_cfg.get("base_fee_multiplier", 2)
+        self.fallback_gas_price = Web3.to_wei(gas_cfg.get("fallback_gas_price_gwei", 5), "gwei")
+        self.gas_limit_margin = gas_cfg.get("gas_limit_margin", 1.2)
+        return self
+
+    def refresh(self) -> dict:
+        """从节点拉取最新的手续费数据并更新缓存"""
+        percentiles = sorted(SPEED_PERCENTILES.values())
+        try:
+            history = self.w3.eth.fee_history(self.block_count, "latest", percentiles)
+            rewards = history.get("reward") or []
+            tips = {}
+            for index, percentile in enumerate(percentiles):
+                samples = sorted(block_rewards[index] for block_rewards in rewards if len(block_rewards) > index)
+                tips[percentile] = samples[len(samples) // 2] if samples else 0
+            snapshot = {
+                "type": 2,
+                "block": history.get("oldestBlock", 0) + len(rewards),
+                # baseFeePerGas 的最后一项是下一块的 base fee
+                "base_fee": history["baseFeePerGas"][-1],
+                "tips": tips,
+                "updated_at": time.time()
+            }
+        except Exception:
+            snapshot = {
+                "type": 0,
+                "gas_price": self.w3.eth.gas_price,
+                "updated_at": time.time()
+            }
+        with self._lock:
+            self._snapshot = snapshot
+        return snapshot
+
+    def fee_params(self, speed=None) -> dict:
+        """返回可直接合并进交易字典的手续费字段"""
+        with self._lock:
+            snapshot = self._snapshot
+        if snapshot is None:
+            return {"gasPrice": self.fallback_gas_price}
+        if snapshot["type"] == 0:
+            return {"gasPrice": snapshot["gas_price"]}
+        tip = snapshot["tips"][SPEED_PERCENTILES.get(speed or self.priority, 50)]
+        return {
+            "type": 2,
+            "maxPriorityFeePerGas": tip,
+            # 倍数可以是小数，交易字段必须为整数
+            "maxFeePerGas": int(snapshot["base_fee"] * self.base_fee_multiplier) + tip
+        }
+
+    def gas_limit(self, key, estimate, default: int) -> int:
+        """
+        返回按 key 缓存的 gas limit。首次调用 estimate() 估算并加上安全余量，
+        估算失败时返回 default 且不缓存。
+        """
+        with self._lock:
+            cached = self._gas_limits.get(key)
+        if cached is not None:
+            return cached
+        try:
+            limit = int(estimate() * self.gas_limit_margin)
+        except Exception:
+            return default
+        with self._lock:
+            self._gas_limits[key] = limit
+        return limit
+
+    def forget_gas_limit(self, key):
+        """估算值失效（如交易因 out of gas 失败）时丢弃缓存"""
+        with self._lock:
+            self._gas_limits.pop(key, None)
+
+    def forget_on_error(self, key, error) -> bool:
+        """发送或执行错误说明 gas limit 不足时丢弃缓存，下次重新估算"""
+        message = str(error).lower()
+        if any(pattern in message for pattern in GAS_LIMIT_ERRORS):
+            self.forget_gas_limit(key)
+            return True
+        return False
+
+    def snapshot(self):
+        with self._lock:
+            return dict(self._snapshot) if self._snapshot else None
+
+    def start(self):
+        """启动后台刷新线程"""
+        if self._thread is not None and self._thread.is_alive():
+            return self
+        self._stop_event.clear()
+        self._thread = threading.Thread(target=self._run, name="gas-oracle", daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._stop_event.set()
+
+    def _run(self):
+        while not self._stop_event.is_set():
+            try:
+                self.refresh()
+            except Exception as e:
+                print(f"Warning: Gas oracle refresh failed: {str(e)}")
+            self._stop_event.wait(self.refresh_interval)
@@ -0,0 +1,98 @@
+# ATM/services/common/http_pool.py
+import socket
+import threading
+from urllib.parse import urlsplit
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.connection import HTTPConnection
+
+# 连接池默认参数，可通过 config.json 的 rpc_pool.connection_pool 覆盖
+DEFAULT_POOL_CFG = {
+    "pool_connections": 8,  # 每个 Session 缓存连接池的主机数
+    "pool_maxsize": 32,  # 每个主机保持的最大连接数
+    "keepalive_idle": 30,  # TCP keep-alive：空闲多少秒后开始探测
+    "keepalive_interval": 10,
+    "keepalive_count": 3
+}
+
+
+def _keepalive_options(cfg: dict) -> list:
+    """开启 TCP keep-alive，避免空闲的长连接被 NAT 或负载均衡悄悄断开后再付一次 TLS 握手"""
+    options = list(HTTPConnection.default_socket_options) + [(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)]
+    for name, key in (("TCP_KEEPIDLE", "keepalive_idle"), ("TCP_KEEPINTVL", "keepalive_interval"),
+                      ("TCP_KEEPCNT", "keepalive_count")):
+        # 部分平台（如 macOS）没有这些选项
+        if hasattr(socket, name) and cfg.get(key):
+            options.append((socket.IPPROTO_TCP, getattr(socket, name), int(cfg[key])))
+    return options
+
+
+class _KeepAliveAdapter(HTTPAdapter):
+    def __init__(self, socket_options, **kwargs):
+        self.socket_options = socket_options
+        super().__init__(**kwargs)
+
+    def init_poolmanager(self, *args, **kwargs):
+        kwargs["socket_options"] = self.socket_options
+        super().init_poolmanager(*args, **kwargs)
+
+
+class SessionPool:
+    """
+    进程内共享的 RPC HTTP 连接池。
+
+    每个源（scheme://host:port）一个 requests.Session，所有 Web3 provider 和批量 JSON-RPC
+    请求共用，连接保持长连接并开启 TCP keep-alive；切换网络或重建 Web3 时直接复用已建立的
+    连接，不再重新握手。
+    """
+
+    def __init__(self, cfg=None):
+        self.cfg = {**DEFAULT_POOL_CFG, **(cfg or {})}
+        self._sessions = {}
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _origin(url: str) -> str:
+        parts = urlsplit(url)
+        return f"{parts.scheme}://{parts.netloc}"
+
+    def _mount(self, session: requests.Session):
+        adapter = _KeepAliveAdapter(_keepalive_options(self.cfg), pool_connections=self.cfg["pool_connections"],
+                                    pool_maxsize=self.cfg["pool_maxsize"], max_retries=0)
+        session.mount("http://", adapter)
+        session.mount("https://", adapter)
+
+    def configure(self, cfg=None):
+        """更新连接池参数，已有的 Session 重新挂载适配器"""
+        with self._lock:
+            cfg = {**DEFAULT_POOL_CFG, **(cfg or {})}
+            if cfg == self.cfg:
+                return
+            self.cfg = cfg
+            for session in self._sessions.values():
+                self._mount(session)
+
+    def session_for(self, url: str) -> requests.Session:
+        origin = self._origin(url)
+        session = self._sessions.get(origin)
+        if session is None:
+            with self._lock:
+                session = self._sessions.get(origin)
+                if session is None:
+                    session = requests.Session()
+                    self._mount(session)
+                    self._sessions[origin] = session
+        return session
+
+    def close(self):
+        with self._lock:
+            for session in self._sessions.values():
+                session.close()
+            self._sessions.clear()
+
+    def stats(self) -> dict:
+        return {"sessions": len(self._sessions), **self.cfg}
+
+
+# 进程内共享的连接池
+SESSIONS = SessionPool()
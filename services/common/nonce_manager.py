@@ -0,0 +1,114 @@
+# ATM/services/common/nonce_manager.py
+import heapq
+import threading
+from web3 import Web3
+
+# 发送失败信息中出现以下内容时，说明本地 nonce 与链上不一致，需要重新同步
+NONCE_SYNC_ERRORS = (
+    "nonce too low",
+    "nonce too high",
+    "already known",
+    "replacement transaction underpriced"
+)
+# 节点明确拒收交易的错误：交易未进入交易池，nonce 可以直接回收。
+# 其它错误（超时、连接断开等）无法确定交易是否已发出，回收会导致下一笔交易复用同一 nonce，改为重新同步
+NONCE_REJECTED_ERRORS = (
+    "insufficient funds",
+    "intrinsic gas too low",
+    "gas too low",
+    "exceeds block gas limit",
+    "transaction underpriced",
+    "gas price too low",
+    "max fee per gas less than block base fee",
+    "invalid sender",
+    "execution reverted"
+)
+
+
+class _WalletNonces:
+    """单个钱包的 nonce 状态"""
+
+    __slots__ = ("lock", "next_nonce", "released")
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.next_nonce = None  # None 表示尚未与链上同步
+        self.released = []      # 发送失败后回收的 nonce（最小堆），优先复用以填补空洞
+
+
+class NonceManager:
+    """
+    按钱包在内存中分配 nonce。
+
+    每个钱包只在首次使用和出错时通过 RPC 同步一次 pending nonce，之后在锁内
+    从内存递增分配，同一钱包的并发交易不会拿到相同的 nonce。
+    """
+
+    def __init__(self, w3):
+        self.w3 = w3
+        self._wallets = {}
+        self._wallets_lock = threading.Lock()
+
+    def _wallet(self, address: str) -> _WalletNonces:
+        key = address.lower()
+        with self._wallets_lock:
+            state = self._wallets.get(key)
+            if state is None:
+                state = self._wallets[key] = _WalletNonces()
+            return state
+
+    def _sync_locked(self, address: str, state: _WalletNonces):
+        state.next_nonce = self.w3.eth.get_transaction_count(Web3.to_checksum_address(address), "pending")
+        state.released = []
+
+    def sync(self, address: str) -> int:
+        """从链上同步钱包的 pending nonce，返回下一个可用 nonce"""
+        state = self._wallet(address)
+        with state.lock:
+            self._sync_locked(address, state)
+            return state.next_nonce
+
+    def allocate(self, address: str) -> int:
+        """分配下一个 nonce，优先复用发送失败回收的 nonce"""
+        state = self._wallet(address)
+        with state.lock:
+            if state.next_nonce is None:
+                self._sync_locked(address, state)
+            if state.released:
+                return heapq.heappop(state.released)
+            nonce = state.next_nonce
+            state.next_nonce += 1
+            return nonce
+
+    def release(self, address: str, nonce: int):
+        """交易未能进入交易池时归还 nonce，避免后续交易因空洞卡住"""
+        state = self._wallet(address)
+        with state.lock:
+            if state.next_nonce is None or nonce >= state.next_nonce:
+                return
+            if nonce == state.next_nonce - 1:
+                state.next_nonce = nonce
+                # 归还的 nonce 连续位于末尾时一并收回
+                while state.released and max(state.released) == state.next_nonce - 1:
+                    state.released.remove(state.next_nonce - 1)
+                    heapq.heapify(state.released)
+                    state.next_nonce -= 1
+            elif nonce not in state.released:
+                heapq.heappush(state.released, nonce)
+
+    def resync(self, address: str):
+        """丢弃本地状态，下次分配时重新从链上同步"""
+        state = self._wallet(address)
+        with state.lock:
+            state.next_nonce = None
+            state.released = []
+
+    def handle_send_error(self, address: str, nonce: int, error: Exception):
+        """发送失败后的恢复：节点明确拒收时回收该 nonce，nonce 冲突或结果不确定时重新同步"""
+        message = str(error).lower()
+        if any(pattern in message for pattern in NONCE_SYNC_ERRORS):
+            self.resync(address)
+        elif any(pattern in message for pattern in NONCE_REJECTED_ERRORS):
+            self.release(address, nonce)
+        else:
+            self.resync(address)
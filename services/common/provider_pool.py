@@ -0,0 +1,264 @@
+# ATM/services/common/provider_pool.py
+import time
+import threading
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from web3 import Web3, HTTPProvider
+from web3.providers.base import JSONBaseProvider
+# 同时支持Docker环境和本地环境的导入
+try:
+    from services.common.rpc_batch import batch_request, RPCBatchError, RPCBatchUnsupported
+    from services.common.http_pool import SESSIONS
+except ImportError:
+    from .rpc_batch import batch_request, RPCBatchError, RPCBatchUnsupported
+    from .http_pool import SESSIONS
+
+# 节点限流时返回的 JSON-RPC 错误码，视为节点故障并切换到下一个节点
+RATE_LIMIT_CODES = (-32005, -32029, 429)
+# 节点已收到过相同交易时的错误信息，说明广播已经成功
+ALREADY_KNOWN_ERRORS = ("already known", "known transaction", "already imported")
+# 过滤器只存在于创建它的节点上：创建后记录所在节点，之后对同一过滤器的请求只发往该节点
+FILTER_CREATE_METHODS = ("eth_newFilter", "eth_newBlockFilter", "eth_newPendingTransactionFilter")
+FILTER_METHODS = ("eth_getFilterChanges", "eth_getFilterLogs", "eth_uninstallFilter")
+
+
+def rpc_urls(network_cfg: dict) -> list:
+    """网络配置中的 RPC 节点列表：rpc_urls 优先，否则为单个 rpc_url"""
+    urls = network_cfg.get("rpc_urls") or [network_cfg.get("rpc_url")]
+    return [url for url in urls if url]
+
+
+def make_http_provider(url, request_timeout=10):
+    """使用共享连接池 Session 的 HTTPProvider"""
+    if not url:
+        return HTTPProvider(request_kwargs={"timeout": request_timeout})
+    return HTTPProvider(url, request_kwargs={"timeout": request_timeout}, session=SESSIONS.session_for(url))
+
+
+def rpc_target(web3, rpc_url):
+    """批量 JSON-RPC 请求的目标：Web3 使用连接池时交给连接池选择节点，否则直接使用 rpc_url"""
+    provider = getattr(web3, "provider", None)
+    return provider if isinstance(provider, ProviderPool) else rpc_url
+
+
+class _Endpoint:
+    __slots__ = ("url", "provider", "latency", "error_rate", "failures", "open_until", "probing", "requests")
+
+    def __init__(self, url, provider):
+        # 未配置地址时 HTTPProvider 使用其默认节点
+        self.url = url or provider.endpoint_uri
+        self.provider = provider
+        self.latency = None  # 成功请求耗时的指数移动平均（秒）
+        self.error_rate = 0.0
+        self.failures = 0  # 连续失败次数
+        self.open_until = None  # 熔断打开时为恢复试探的时间
+        self.probing = False
+        self.requests = 0
+
+
+class ProviderPool(JSONBaseProvider):
+    """
+    多节点 RPC 连接池（Web3 provider）。
+
+    每个节点跟踪成功请求耗时和错误率的指数移动平均，读请求发往得分最好的可用节点，
+    连接失败、HTTP 错误或限流时切换到下一个节点。连续失败 failure_threshold 次的节点
+    熔断 cooldown 秒，之后放行一个试探请求，成功则恢复。eth_sendRawTransaction 并行
+    广播到最多 broadcast 个节点，任一节点接受即返回。过滤器请求固定发往创建该过滤器的节点。
+    """
+
+    def __init__(self, urls, broadcast=3, failure_threshold=3, cooldown=30, ewma_alpha=0.2,
+                 request_timeout=10, provider_factory=None):
+        super().__init__()
+        urls = list(urls) or [None]
+        factory = provider_factory or (lambda url: make_http_provider(url, request_timeout))
+        self.endpoints = [_Endpoint(url, factory(url)) for url in urls]
+        self.broadcast = max(1, broadcast)
+        self.failure_threshold = failure_threshold
+        self.cooldown = cooldown
+        self.ewma_alpha = ewma_alpha
+        self.request_timeout = request_timeout
+        self._lock = threading.Lock()
+        self._executor = None
+        self._filters = {}  # 过滤器 ID -> 创建它的节点
+
+    @classmethod
+    def from_config(cls, network_cfg: dict, pool_cfg=None):
+        """根据网络配置和 config.json 中的 rpc_pool 配置创建连接池"""
+        pool_cfg = pool_cfg or {}
+        if "connection_pool" in pool_cfg:
+            SESSIONS.configure(pool_cfg["connection_pool"])
+        return cls(
+            rpc_urls(network_cfg),
+            broadcast=pool_cfg.get("broadcast", 3),
+            failure_threshold=pool_cfg.get("failure_threshold", 3),
+            cooldown=pool_cfg.get("cooldown", 30),
+            ewma_alpha=pool_cfg.get("ewma_alpha", 0.2),
+            request_timeout=pool_cfg.get("request_timeout", 10)
+        )
+
+    @property
+    def primary_url(self) -> str:
+        return self.endpoints[0].url
+
+    def _score(self, endpoint: _Endpoint) -> float:
+        # 尚无耗时数据的节点优先试用，之后按错误率放大的平均耗时排序
+        latency = endpoint.latency if endpoint.latency is not None else 0.0
+        return latency * (1 + 4 * endpoint.error_rate)
+
+    def _candidates(self, limit=None) -> list:
+        """
+        按得分排序的可用节点。熔断到期的节点每次只放行一个试探请求，并排在最前面：
+        试探标记只有在请求真正发给该节点后才会清除，排在健康节点之后可能永远轮不到它
+        """
+        now = time.monotonic()
+        with self._lock:
+            available = sorted((e for e in self.endpoints if e.open_until is None), key=self._score)
+            probe = next((e for e in self.endpoints
+                          if e.open_until is not None and now >= e.open_until and not e.probing), None)
+            if probe is not None:
+                probe.probing = True
+                available.insert(0, probe)
+            if not available:
+                # 全部熔断时仍尝试最早恢复的节点，而不是直接失败
+                available = [min(self.endpoints, key=lambda e: e.open_until)]
+        return available[:limit] if limit else available
+
+    def _record(self, endpoint: _Endpoint, elapsed=None, failed=False):
+        alpha = self.ewma_alpha
+        with self._lock:
+            endpoint.requests += 1
+            endpoint.probing = False
+            endpoint.error_rate = (1 - alpha) * endpoint.error_rate + (alpha if failed else 0.0)
+            if failed:
+                endpoint.failures += 1
+                if endpoint.failures >= self.failure_threshold or endpoint.open_until is not None:
+                    endpoint.open_until = time.monotonic() + self.cooldown
+                return
+            endpoint.failures = 0
+            endpoint.open_until = None
+            endpoint.latency = elapsed if endpoint.latency is None else \
+                (1 - alpha) * endpoint.latency + alpha * elapsed
+
+    @staticmethod
+    def _rate_limited(response) -> bool:
+        error = response.get("error") if isinstance(response, dict) else None
+        return isinstance(error, dict) and error.get("code") in RATE_LIMIT_CODES
+
+    def _call(self, endpoint: _Endpoint, method, params):
+        """向单个节点发送请求并更新其统计，节点故障时抛出异常"""
+        started = time.monotonic()
+        try:
+            response = endpoint.provider.make_request(method, params)
+        except Exception:
+            self._record(endpoint, failed=True)
+            raise
+        if self._rate_limited(response):
+            self._record(endpoint, failed=True)
+            raise ConnectionError(f"RPC endpoint rate limited: {response['error']}")
+        self._record(endpoint, time.monotonic() - started)
+        return response
+
+    def make_request(self, method, params):
+        if method == "eth_sendRawTransaction":
+            return self._broadcast(method, params)
+        if method in FILTER_METHODS and params:
+            endpoint = self._filters.get(params[0])
+            if endpoint is not None:
+                return self._filter_request(endpoint, method, params)
+        last_error = None
+        for endpoint in self._candidates():
+            try:
+                response = self._call(endpoint, method, params)
+            except Exception as e:
+                last_error = e
+                continue
+            if method in FILTER_CREATE_METHODS and response.get("result") is not None:
+                with self._lock:
+                    self._filters[response["result"]] = endpoint
+            return response
+        raise last_error
+
+    def _filter_request(self, endpoint: _Endpoint, method, params):
+        """过滤器请求不切换节点：节点故障时过滤器随之失效，由调用方重新创建"""
+        try:
+            response = self._call(endpoint, method, params)
+        except Exception:
+            with self._lock:
+                self._filters.pop(params[0], None)
+            raise
+        if method == "eth_uninstallFilter" or response.get("error"):
+            with self._lock:
+                self._filters.pop(params[0], None)
+        return response
+
+    def _broadcast(self, method, params):
+        """并行发送到多个节点，返回第一个接受交易的节点的响应"""
+        endpoints = self._candidates(self.broadcast)
+        if len(endpoints) == 1:
+            return self._call(endpoints[0], method, params)
+        with self._lock:
+            if self._executor is None:
+                self._executor = ThreadPoolExecutor(max_workers=len(self.endpoints),
+                                                    thread_name_prefix="rpc-broadcast")
+        futures = [self._executor.submit(self._call, endpoint, method, params) for endpoint in endpoints]
+        first_response, last_error = None, None
+        for future in as_completed(futures):
+            try:
+                response = future.result()
+            except Exception as e:
+                last_error = e
+                continue
+            error = response.get("error")
+            if not error:
+                return response
+            message = str(error.get("message", "") if isinstance(error, dict) else error).lower()
+            if any(known in message for known in ALREADY_KNOWN_ERRORS):
+                # 其它节点已先收到该交易，交易哈希由原始交易计算
+                raw = params[0]
+                tx_hash = Web3.keccak(hexstr=raw) if isinstance(raw, str) else Web3.keccak(raw)
+                return {"jsonrpc": "2.0", "id": response.get("id"), "result": Web3.to_hex(tx_hash)}
+            if first_response is None:
+                first_response = response
+        if first_response is not None:
+            return first_response
+        raise last_error
+
+    def batch_request(self, calls: list, timeout=None) -> list:
+        """
+        批量 JSON-RPC 请求，整体失败时切换到下一个节点。
+        节点不支持批量请求时仍视为正常响应，不计入节点故障，全部节点都不支持时抛出 RPCBatchUnsupported
+        """
+        last_error, unsupported = None, None
+        for endpoint in self._candidates():
+            started = time.monotonic()
+            try:
+                results = batch_request(endpoint.url, calls, timeout=timeout or self.request_timeout)
+            except RPCBatchUnsupported as e:
+                # 限流时节点同样返回单个错误对象，这种情况仍属于节点故障
+                if self._rate_limited({"error": e.error}):
+                    self._record(endpoint, failed=True)
+                    last_error = RPCBatchError(f"RPC endpoint rate limited: {e.error}")
+                else:
+                    self._record(endpoint, time.monotonic() - started)
+                    unsupported = e
+                continue
+            except RPCBatchError as e:
+                self._record(endpoint, failed=True)
+                last_error = e
+                continue
+            self._record(endpoint, time.monotonic() - started)
+            return results
+        raise unsupported or last_error
+
+    def is_connected(self, show_traceback=False) -> bool:
+        return any(endpoint.open_until is None for endpoint in self.endpoints)
+
+    def status(self) -> list:
+        now = time.monotonic()
+        with self._lock:
+            return [{
+                "url": endpoint.url,
+                "latency_ms": round(endpoint.latency * 1000, 2) if endpoint.latency is not None else None,
+                "error_rate": round(endpoint.error_rate, 4),
+                "requests": endpoint.requests,
+                "open": endpoint.open_until is not None and now < endpoint.open_until
+            } for endpoint in self.endpoints]
@@ -0,0 +1,72 @@
+# ATM/services/common/rpc_batch.py
+import itertools
+# 同时支持Docker环境和本地环境的导入
+try:
+    from services.common.http_pool import SESSIONS
+except ImportError:
+    from .http_pool import SESSIONS
+
+# 批量请求与 Web3 provider 共用进程内的连接池，复用到 RPC 节点的长连接
+_request_ids = itertools.count(1)
+
+
+class RPCBatchError(Exception):
+    """JSON-RPC 批量请求失败，或批量中的单个请求返回错误"""
+
+
+class RPCBatchUnsupported(RPCBatchError):
+    """节点正常响应但不接受批量请求（返回单个错误对象），error 为节点返回的错误"""
+
+    def __init__(self, message, error=None):
+        super().__init__(message)
+        self.error = error
+
+
+def batch_request(rpc_url: str, calls: list, timeout: float = 10, session=None) -> list:
+    """
+    在一次 HTTP 往返中发送多个 JSON-RPC 请求。
+
+    calls 为 (method, params) 列表，返回与之顺序一致的结果列表；
+    单个请求出错时对应位置为 RPCBatchError 实例，整体失败时直接抛出 RPCBatchError。
+    rpc_url 也可以是多节点连接池（ProviderPool），由连接池选择节点并在失败时切换。
+    """
+    if not calls:
+        return []
+    if not isinstance(rpc_url, str):
+        return rpc_url.batch_request(calls, timeout=timeout)
+    payload = [
+        {"jsonrpc": "2.0", "id": next(_request_ids), "method": method, "params": params}
+        for method, params in calls
+    ]
+    try:
+        response = (session or SESSIONS.session_for(rpc_url)).post(rpc_url, json=payload, timeout=timeout)
+        response.raise_for_status()
+        data = response.json()
+    except Exception as e:
+        raise RPCBatchError(f"Batch RPC request failed: {str(e)}")
+
+    # 不支持批量请求的节点会返回单个错误对象
+    if not isinstance(data, list):
+        error = data.get("error") if isinstance(data, dict) else data
+        raise RPCBatchUnsupported(f"RPC node rejected batch request: {error}", error)
+
+    by_id = {item.get("id"): item for item in data if isinstance(item, dict)}
+    results = []
+    for request in payload:
+        item = by_id.get(request["id"])
+        if item is None:
+            results.append(RPCBatchError(f"No response for {request['method']}"))
+        elif "error" in item:
+            results.append(RPCBatchError(f"{request['method']} failed: {item['error']}"))
+        else:
+            results.append(item.get("result"))
+    return results
+
+
+def to_int(value):
+    """将 JSON-RPC 返回的十六进制数量转换为整数"""
+    if value is None:
+        return None
+    if isinstance(value, int):
+        return value
+    return int(value, 16)
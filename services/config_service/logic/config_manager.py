@@ -1,29 +1,34 @@
 # ATM/services/config_service/logic/config_manager.py
 import json
 
+# 默认配置
+DEFAULT_CONFIG = {
+    "network_mode": "testnet",
+    "auto_approve": False,
+    "testnet": {
+        "chain_id": 11155111,  # Sepolia
+        "rpc_url": "https://rpc.sepolia.org",
+        "router_address": "0x0000000000000000000000000000000000000000"
+    },
+    "ports": {
+        "config_service": 52100,
+        "signal_listener": 52110,
+        "risk_controller": 52120,
+        "dex_executor": 52130,
+        "execution_monitor": 52140,
+        "asset_manager": 52150
+    },
+    "trade_pair": []
+}
+
+
 class ConfigManager:
-    def __init__(self, config_path=None):
-        # 默认配置
-        default_config = {
-            "network_mode": "testnet",
-            "auto_approve": False,
-            "testnet": {
-                "chain_id": 11155111,  # Sepolia
-                "rpc_url": "https://rpc.sepolia.org",
-                "router_address": "0x0000000000000000000000000000000000000000"
-            },
-            "ports": {
-                "config_service": 52100,
-                "signal_listener": 52110,
-                "risk_controller": 52120,
-                "dex_executor": 52130,
-                "execution_monitor": 52140,
-                "asset_manager": 52150
-            },
-            "trade_pair": []
-        }
-        
-        data = default_config
+    def __init__(self, config_path=None, data=None):
+        # data 为配置服务内存中的快照，提供时不再读取文件
+        if data is not None:
+            config_path = None
+        else:
+            data = DEFAULT_CONFIG
         
         # 如果提供了配置文件路径，尝试读取
         if config_path:
@@ -34,7 +39,7 @@ class ConfigManager:
             except Exception as e:
                 print(f"Error loading config file {config_path}: {str(e)}")
                 print("Using default configuration")
-        else:
+        elif data is DEFAULT_CONFIG:
             print("No config file specified. Using default configuration.")
             
         # 从配置中读取设置
@@ -0,0 +1,109 @@
+# ATM/services/config_service/logic/config_store.py
+import os
+import json
+import time
+import asyncio
+# 同时支持Docker环境和本地环境的导入
+try:
+    from services.common.config_client import REDACTED_SECTIONS
+except ImportError:
+    from ...common.config_client import REDACTED_SECTIONS
+
+
+class ConfigStore:
+    """
+    带版本号的内存配置快照。
+
+    后台任务每隔 poll_interval 秒检查一次配置文件的 mtime 和大小，变化且内容解析成功时
+    整体替换快照并递增版本号，唤醒所有等待新版本的长轮询请求；解析失败时保留旧快照。
+    快照一经发布不再修改，读取方无需加锁。
+    """
+
+    def __init__(self, path=None, defaults=None, poll_interval=1.0):
+        self.path = path
+        self.defaults = defaults or {}
+        self.poll_interval = poll_interval
+        self.version = 0
+        self.updated_at = None
+        self.config = {}
+        self._file_state = None
+        self._changed = asyncio.Event()
+        self._task = None
+        self.refresh()
+        if not self.version:
+            self._publish(dict(self.defaults))
+
+    def _stat(self):
+        try:
+            st = os.stat(self.path)
+        except (OSError, TypeError):
+            return None
+        return (st.st_mtime_ns, st.st_size)
+
+    def refresh(self) -> bool:
+        """配置文件有变化时重新加载，返回是否发布了新版本"""
+        file_state = self._stat()
+        if file_state is None or file_state == self._file_state:
+            return False
+        try:
+            with open(self.path, "r") as f:
+                data = json.load(f)
+        except Exception as e:
+            print(f"Warning: Failed to reload config file {self.path}: {str(e)}")
+            return False
+        self._file_state = file_state
+        if not isinstance(data, dict) or data == self.config:
+            return False
+        self._publish(data)
+        print(f"Loaded configuration version {self.version} from {self.path}")
+        return True
+
+    def _publish(self, data: dict):
+        self.config = data
+        self.version += 1
+        self.updated_at = time.time()
+        changed, self._changed = self._changed, asyncio.Event()
+        changed.set()
+
+    def snapshot(self) -> dict:
+        """对外发布的快照，不含敏感配置段"""
+        return {
+            "version": self.version,
+            "updated_at": self.updated_at,
+            "config": {k: v for k, v in self.config.items() if k not in REDACTED_SECTIONS}
+        }
+
+    async def wait(self, since: int, timeout: float) -> dict:
+        """
+        长轮询：版本号与 since 不同时立即返回，否则等待新版本或超时后返回当前快照。
+        配置服务重启后版本号会变小，因此比较的是"不同"而不是"更大"。
+        """
+        if since != self.version:
+            return self.snapshot()
+        try:
+            await asyncio.wait_for(self._changed.wait(), timeout)
+        except asyncio.TimeoutError:
+            pass
+        return self.snapshot()
+
+    async def _watch(self):
+        while True:
+            await asyncio.sleep(self.poll_interval)
+            try:
+                self.refresh()
+            except Exception as e:
+                print(f"Warning: Config watch failed: {str(e)}")
+
+    def start(self):
+        """启动配置文件监视任务（需在事件循环中调用）"""
+        if self._task is None or self._task.done():
+            self._task = asyncio.ensure_future(self._watch())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
@@ -1,38 +1,34 @@
 # ATM/services/config_service/main.py
-import json, os
 from fastapi import FastAPI
 
 # 注意：在Docker容器中使用绝对导入而不是相对导入
 try:
     from services.config_service.router import router
+    from services.config_service import router as config_router
+    from services.common.config_file import load_config
 except ImportError:
     # 在本地开发环境中回退使用相对导入
     from .router import router
+    from . import router as config_router
+    from ..common.config_file import load_config
 
 def get_service_port(service_name: str) -> int:
-    # 首先尝试Docker容器中的配置路径
-    config_path = "/app/config.json"
-    # 检查文件是否真的存在且是文件而不是目录
-    if os.path.isfile(config_path):
-        with open(config_path, "r") as f:
-            cfg = json.load(f)
-        ports = cfg.get("ports", {})
-        return int(ports.get(service_name, 52100))
-    
-    # 回退到本地开发环境的路径
-    config_path = os.path.join(os.path.dirname(os.path.dirname(os.path.dirname(__file__))), "config.json")
-    if os.path.isfile(config_path):
-        with open(config_path, "r") as f:
-            cfg = json.load(f)
-        ports = cfg.get("ports", {})
-        return int(ports.get(service_name, 52100))
-    
-    # 如果找不到配置文件，使用默认端口
-    return 52100
+    # 读取Docker容器中或本地开发环境的配置文件（按 mtime 缓存），找不到时使用默认端口
+    ports = load_config().get("ports", {})
+    return int(ports.get(service_name, 52100))
 
 app = FastAPI(title="Config Service", version="1.0")
 app.include_router(router)
 
+@app.on_event("startup")
+async def start_config_watch():
+    """开始监视配置文件，变化时发布新版本"""
+    config_router.STORE.start()
+
+@app.on_event("shutdown")
+async def stop_config_watch():
+    await config_router.STORE.stop()
+
 if __name__ == "__main__":
     import uvicorn
     port = get_service_port("config_service")
@@ -1,13 +1,15 @@
 # ATM/services/config_service/router.py
-from fastapi import APIRouter, HTTPException
+from fastapi import APIRouter, HTTPException, Query
 import os, json
 
 # u5728Dockeru73afu5883u4e2du4f7fu7528u7eddu5bf9u5bfcu5165
 try:
-    from services.config_service.logic.config_manager import ConfigManager
+    from services.config_service.logic.config_manager import ConfigManager, DEFAULT_CONFIG
+    from services.config_service.logic.config_store import ConfigStore
 except ImportError:
     # u5728u672cu5730u5f00u53d1u73afu5883u4e2du56deu9000u5230u76f8u5bf9u5bfcu5165
-    from .logic.config_manager import ConfigManager
+    from .logic.config_manager import ConfigManager, DEFAULT_CONFIG
+    from .logic.config_store import ConfigStore
 
 router = APIRouter()
 
@@ -48,17 +50,29 @@ if not os.path.isfile(config_path):
     if not os.path.isfile(config_path):
         config_path = os.path.join(os.path.dirname(os.path.dirname(os.path.dirname(__file__))), "config.json")
 
-# u4f7fu7528u786eu8ba4u6709u6548u7684u914du7f6eu6587u4ef6u8defu5f84u521du59cbu5316ConfigManager
-if os.path.isfile(config_path):
-    cfg = ConfigManager(config_path)
-else:
-    # u5982u679cu4ecdu7136u65e0u6cd5u627eu5230u914du7f6eu6587u4ef6uff0cu4f7fu7528u9ed8u8ba4u914du7f6e
+# 带版本号的内存配置快照，配置文件变化时由后台任务重新加载（在 main.py 启动时开启）
+if not os.path.isfile(config_path):
     print("WARNING: Could not find config file. Using default configuration.")
-    cfg = ConfigManager(None)  # u9700u8981u4feeu6539ConfigManageru4ee5u652fu6301u65e0u6587u4ef6u65f6u4f7fu7528u9ed8u8ba4u503c
+STORE = ConfigStore(config_path if os.path.isfile(config_path) else None, defaults=DEFAULT_CONFIG)
+
+# 按快照版本缓存的 ConfigManager 视图
+_cfg = None
+_cfg_version = None
+
+def current_config() -> ConfigManager:
+    global _cfg, _cfg_version
+    if _cfg_version != STORE.version:
+        _cfg = ConfigManager(data=STORE.config)
+        _cfg_version = STORE.version
+    return _cfg
 
 @router.get("/config")
-def get_full_config():
+async def get_full_config(since: int = None, timeout: float = Query(30, ge=0, le=120)):
+    # 带 since 时为长轮询：版本号仍为 since 时挂起，直到配置变化或超时
+    snapshot = await STORE.wait(since, timeout) if since is not None else STORE.snapshot()
+    cfg = current_config()
     return {
+        **snapshot,
         "network_mode": cfg.network_mode,
         "auto_approve": cfg.auto_approve,
         "chain_id": cfg.chain_id,
@@ -69,6 +83,7 @@ def get_full_config():
 
 @router.get("/config/{key}")
 def get_config_key(key: str):
+    cfg = current_config()
     if key == "network":
         return {"network_mode": cfg.network_mode}
     elif key == "chain_id":
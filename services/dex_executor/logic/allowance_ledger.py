@@ -0,0 +1,164 @@
+# ATM/services/dex_executor/logic/allowance_ledger.py
+import threading
+from web3 import Web3
+
+# Approval(address indexed owner, address indexed spender, uint256 value)
+APPROVAL_TOPIC = "0x" + bytes(Web3.keccak(text="Approval(address,address,uint256)")).hex()
+
+
+def _topic_to_address(topic) -> str:
+    """从32字节的indexed参数中取出地址（小写）"""
+    if isinstance(topic, (bytes, bytearray)):
+        topic = topic.hex()
+    topic = topic.lower().removeprefix("0x")
+    return "0x" + topic[-40:]
+
+
+def _address_topic(address: str) -> str:
+    return "0x" + "0" * 24 + address.lower().removeprefix("0x")
+
+
+class AllowanceLedger:
+    """
+    内存中的 (链, 钱包, 代币, 授权对象) 授权额度账本。
+
+    额度从链上读取后写入，每笔提交的swap在本地扣减；只有缓存额度不足以覆盖交易额，
+    或观察到相关的 Approval 事件时，才重新从链上读取。已提交但尚未上链的swap按nonce
+    记录其扣减，从链上重新读取额度时仍从中减去，避免把这些swap将要使用的额度当作余量。
+    """
+
+    def __init__(self):
+        self._entries = {}
+        self._key_locks = {}
+        self._pending = {}  # 条目 -> {swap nonce: 扣减额度}
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _key(chain_id, wallet, token, spender):
+        return (chain_id, wallet.lower(), token.lower(), spender.lower())
+
+    def lock(self, chain_id, wallet, token, spender) -> threading.Lock:
+        """返回该授权条目的锁，持有期间其它交易不会为同一条目检查额度或发送 approve"""
+        key = self._key(chain_id, wallet, token, spender)
+        with self._lock:
+            return self._key_locks.setdefault(key, threading.Lock())
+
+    def get(self, chain_id, wallet, token, spender):
+        """返回缓存的授权额度，未缓存时返回 None"""
+        with self._lock:
+            return self._entries.get(self._key(chain_id, wallet, token, spender))
+
+    def covers(self, chain_id, wallet, token, spender, amount) -> bool:
+        """缓存额度是否足以覆盖本次交易"""
+        cached = self.get(chain_id, wallet, token, spender)
+        return cached is not None and cached >= amount
+
+    def set(self, chain_id, wallet, token, spender, amount):
+        """
+        写入刚授权的额度。approve 覆盖原额度，且之前的swap（nonce更小）都会先于它上链，
+        因此丢弃这些swap的待扣减记录
+        """
+        key = self._key(chain_id, wallet, token, spender)
+        with self._lock:
+            self._entries[key] = amount
+            self._pending.pop(key, None)
+
+    def seed(self, chain_id, wallet, token, spender, allowance, confirmed_nonce=None):
+        """
+        写入从链上读取的额度，并减去尚未上链的swap的扣减。confirmed_nonce 为同时读取的
+        钱包链上nonce，小于它的swap已上链，其扣减已体现在链上额度中；未知时保留全部记录
+        """
+        key = self._key(chain_id, wallet, token, spender)
+        with self._lock:
+            pending = self._pending.get(key, {})
+            if confirmed_nonce is not None:
+                pending = {nonce: amount for nonce, amount in pending.items() if nonce >= confirmed_nonce}
+                if pending:
+                    self._pending[key] = pending
+                else:
+                    self._pending.pop(key, None)
+            self._entries[key] = max(allowance - sum(pending.values()), 0)
+            return self._entries[key]
+
+    def consume(self, chain_id, wallet, token, spender, amount, nonce=None):
+        """swap提交后在本地扣减额度，并按swap的nonce记录扣减直到其上链"""
+        key = self._key(chain_id, wallet, token, spender)
+        with self._lock:
+            if key in self._entries:
+                self._entries[key] = max(self._entries[key] - amount, 0)
+            if nonce is not None:
+                self._pending.setdefault(key, {})[nonce] = amount
+
+    def invalidate(self, chain_id, wallet, token, spender=None):
+        """丢弃缓存额度，下次使用时重新从链上读取"""
+        with self._lock:
+            if spender is not None:
+                self._entries.pop(self._key(chain_id, wallet, token, spender), None)
+                return
+            prefix = (chain_id, wallet.lower(), token.lower())
+            for key in [k for k in self._entries if k[:3] == prefix]:
+                del self._entries[key]
+
+    def owners(self, chain_id) -> list:
+        """返回指定链上已缓存额度的钱包地址"""
+        with self._lock:
+            return sorted({key[1] for key in self._entries if key[0] == chain_id})
+
+    def apply_approval_logs(self, chain_id, logs) -> int:
+        """根据 Approval 事件使相应缓存失效，返回失效的条目数"""
+        invalidated = 0
+        for log in logs:
+            topics = log.get("topics", [])
+            if len(topics) < 3:
+                continue
+            token = log.get("address")
+            owner = _topic_to_address(topics[1])
+            spender = _topic_to_address(topics[2])
+            if self.get(chain_id, owner, token, spender) is not None:
+                self.invalidate(chain_id, owner, token, spender)
+                invalidated += 1
+        return invalidated
+
+
+class ApprovalWatcher(threading.Thread):
+    """后台线程定期拉取已缓存钱包的 Approval 事件，使对应的账本条目失效"""
+
+    def __init__(self, web3, chain_id, ledger, interval=12):
+        super().__init__(name="approval-watcher", daemon=True)
+        self.web3 = web3
+        self.chain_id = chain_id
+        self.ledger = ledger
+        self.interval = interval
+        self.last_block = None
+        self._stop_event = threading.Event()
+
+    def run(self):
+        while not self._stop_event.is_set():
+            try:
+                self.poll()
+            except Exception as e:
+                print(f"Warning: Approval watcher error: {str(e)}")
+            self._stop_event.wait(self.interval)
+
+    def poll(self) -> int:
+        head = self.web3.eth.block_number
+        if self.last_block is None:
+            self.last_block = head
+            return 0
+        if head <= self.last_block:
+            return 0
+        owners = self.ledger.owners(self.chain_id)
+        if not owners:
+            self.last_block = head
+            return 0
+        # 拉取失败时 last_block 不前移，下一轮重新查询这段区块，避免漏掉 Approval 事件
+        logs = self.web3.eth.get_logs({
+            "fromBlock": self.last_block + 1,
+            "toBlock": head,
+            "topics": [APPROVAL_TOPIC, [_address_topic(owner) for owner in owners]]
+        })
+        self.last_block = head
+        return self.ledger.apply_approval_logs(self.chain_id, logs)
+
+    def stop(self):
+        self._stop_event.set()
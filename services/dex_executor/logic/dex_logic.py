@@ -2,19 +2,47 @@
 import os
 import time
 import json
-from web3 import Web3, HTTPProvider
+import functools
+import contextlib
+import threading
+from types import MappingProxyType
+from collections import OrderedDict
+from eth_abi import encode as abi_encode
+from web3 import Web3
+# 同时支持Docker环境和本地环境的导入
+try:
+    from services.common.nonce_manager import NonceManager, NONCE_REJECTED_ERRORS
+    from services.common.gas_oracle import GasOracle
+    from services.common.rpc_batch import batch_request, RPCBatchError, to_int
+    from services.common.provider_pool import ProviderPool, rpc_target, rpc_urls
+    from services.dex_executor.logic.allowance_ledger import AllowanceLedger, ApprovalWatcher
+except ImportError:
+    from ...common.nonce_manager import NonceManager, NONCE_REJECTED_ERRORS
+    from ...common.gas_oracle import GasOracle
+    from ...common.rpc_batch import batch_request, RPCBatchError, to_int
+    from ...common.provider_pool import ProviderPool, rpc_target, rpc_urls
+    from .allowance_ledger import AllowanceLedger, ApprovalWatcher
 
 # 从上层配置文件加载网络参数
-CONFIG_PATH = os.path.join(os.path.dirname(os.path.dirname(os.path.dirname(__file__))), "config.json")
+# ATM_CONFIG_PATH 可指定其它配置文件（如测试使用 config.example.json）
+CONFIG_PATH = os.getenv("ATM_CONFIG_PATH") or \
+    os.path.join(os.path.dirname(os.path.dirname(os.path.dirname(__file__))), "config.json")
 with open(CONFIG_PATH, "r", encoding='utf-8') as f:
     config_data = json.load(f)
 
+# 支持的网络；配置中的默认网络，各网络的参数在下面的 NETWORKS 上下文中
+SUPPORTED_NETWORKS = ("testnet", "mainnet")
 network_mode = config_data.get("network_mode", "testnet")
-network_cfg = config_data.get(network_mode, {})
-CHAIN_ID = network_cfg.get("chain_id")
-RPC_URL = network_cfg.get("rpc_url")
-ROUTER_ADDRESS = network_cfg.get("router_address")
 AUTO_APPROVE = config_data.get("auto_approve", False)
+# 授权模式：pipeline 时 approve 与 swap 使用连续nonce连续发送，不等待 approve 上链；
+# wait 时保持原有行为，等待 approve 收据后再发送 swap
+APPROVE_MODE = config_data.get("approve_mode", "pipeline")
+# 交易时授权不足的处理：默认只授权本次交易所需的数量；unlimited_approve 为 true 时授权最大额度，
+# 之后的交易不再需要 approve，但路由合约可支配钱包中该代币的全部余额
+UNLIMITED_APPROVE = config_data.get("unlimited_approve", False)
+# 启动时是否为映射表中的所有代币预先设置最大授权额度
+PRE_APPROVE = config_data.get("pre_approve", False)
+MAX_UINT256 = 2 ** 256 - 1
 
 # 从配置文件加载默认钱包信息（仅用于测试）
 DEFAULT_WALLET_ADDRESS = config_data.get("wallet", {}).get("address", "")
@@ -23,92 +51,378 @@ DEFAULT_PRIVATE_KEY = config_data.get("wallet", {}).get("private_key", "")
 # 从配置文件加载可选的代币地址映射表
 TOKEN_ADDRESSES = config_data.get("token_addresses", {})
 
-# 预先初始化Web3对象
-w3 = Web3(HTTPProvider(RPC_URL))
-
-# 简单 ERC20 ABI，只包含 allowance 和 approve 方法
-erc20_abi = [
-    {
-        "constant": True,
-        "inputs": [
-            {"name": "_owner", "type": "address"},
-            {"name": "_spender", "type": "address"}
-        ],
-        "name": "allowance",
-        "outputs": [{"name": "remaining", "type": "uint256"}],
-        "type": "function"
-    },
-    {
-        "constant": False,
-        "inputs": [
-            {"name": "_spender", "type": "address"},
-            {"name": "_value", "type": "uint256"}
-        ],
-        "name": "approve",
-        "outputs": [{"name": "success", "type": "bool"}],
-        "type": "function"
-    }
-]
-
-# Uniswap V3 Router ABI示例
-router_abi = [
-    {
-        "name": "swapExactTokensForTokens",
-        "type": "function",
-        "inputs": [
-            {"name": "amountIn", "type": "uint256"},
-            {"name": "amountOutMin", "type": "uint256"},
-            {"name": "path", "type": "address[]"},
-            {"name": "to", "type": "address"},
-            {"name": "deadline", "type": "uint256"}
-        ],
-        "outputs": [{"name": "amounts", "type": "uint256[]"}]
-    }
-]
-
-# 动态加载网络配置
-def get_network_config(network=None):
-    """根据指定的网络返回相应的配置参数"""
-    global config_data, w3, CHAIN_ID, RPC_URL, ROUTER_ADDRESS
-    
-    # 如果没有指定网络，使用配置文件中的默认设置
-    if not network:
-        network = config_data.get("network_mode", "testnet")
-    
-    # 确保网络类型有效
-    if network not in ["testnet", "mainnet"]:
-        network = "testnet"  # 默认回退到测试网
-    
+# 原生ETH的占位地址
+NATIVE_TOKEN_ADDRESS = "0xeeeeeeeeeeeeeeeeeeeeeeeeeeeeeeeeeeeeeeee"
+
+# 多节点RPC连接池的参数（节点列表来自各网络配置的 rpc_urls 或 rpc_url）
+RPC_POOL_CFG = config_data.get("rpc_pool", {})
+
+# 每组RPC节点一个Web3对象，切换网络时直接复用，底层长连接由进程内共享的连接池保持
+WEB3_CLIENTS = {}
+
+def get_web3(network_cfg: dict):
+    """获取使用多节点连接池的Web3对象：读请求发往最快的可用节点，交易广播到多个节点"""
+    key = tuple(rpc_urls(network_cfg))
+    web3 = WEB3_CLIENTS.get(key)
+    if web3 is None:
+        web3 = WEB3_CLIENTS.setdefault(key, Web3(ProviderPool.from_config(network_cfg, RPC_POOL_CFG)))
+    return web3
+
+# 授权额度账本：swap提交后本地扣减，额度不足或出现 Approval 事件时才重新读链
+ALLOWANCES = AllowanceLedger()
+# 每个网络一个 Approval 事件监听线程
+APPROVAL_WATCHERS = {}
+
+# 每个RPC节点一个nonce分配器，按钱包在内存中分配nonce
+NONCE_MANAGERS = {}
+
+def get_nonce_manager(rpc_url, web3):
+    """获取指定网络的nonce分配器"""
+    manager = NONCE_MANAGERS.get(rpc_url)
+    if manager is None:
+        manager = NONCE_MANAGERS[rpc_url] = NonceManager(web3)
+    return manager
+
+# 每个RPC节点一个手续费预言机，后台跟踪 eth_feeHistory
+GAS_ORACLES = {}
+
+# 未能估算gas时使用的默认gas limit
+DEFAULT_SWAP_GAS = 250000
+DEFAULT_APPROVE_GAS = 60000
+
+def get_gas_oracle(rpc_url, web3):
+    """获取指定网络的手续费预言机"""
+    oracle = GAS_ORACLES.get(rpc_url)
+    if oracle is None:
+        oracle = GAS_ORACLES[rpc_url] = GasOracle.from_config(web3, config_data.get("gas", {}))
+    return oracle
+
+def build_network_context(network: str):
+    """构建一个网络的只读上下文：Web3、链ID、Router、代币映射、nonce分配器和手续费预言机"""
     network_cfg = config_data.get(network, {})
-    chain_id = network_cfg.get("chain_id")
     rpc_url = network_cfg.get("rpc_url")
-    router_address = network_cfg.get("router_address")
-    
-    # 如果网络配置与当前不同，重新初始化 Web3
-    if rpc_url != RPC_URL:
-        w3 = Web3(HTTPProvider(rpc_url))
-        CHAIN_ID = chain_id
-        RPC_URL = rpc_url
-        ROUTER_ADDRESS = router_address
-    
-    return {
-        "chain_id": chain_id,
+    web3 = get_web3(network_cfg)
+    # 网络专用的代币映射（如 testnet_token_addresses）优先，否则使用通用映射表
+    tokens = network_cfg.get("token_addresses") or config_data.get(f"{network}_token_addresses") or TOKEN_ADDRESSES
+    return MappingProxyType({
+        "network": network,
+        "chain_id": network_cfg.get("chain_id"),
         "rpc_url": rpc_url,
-        "router_address": router_address,
-        "web3": w3
-    }
+        "router_address": network_cfg.get("router_address"),
+        "web3": web3,
+        "token_addresses": MappingProxyType(dict(tokens)),
+        "nonce_manager": get_nonce_manager(rpc_url, web3),
+        "gas_oracle": get_gas_oracle(rpc_url, web3)
+    })
+
+# 启动时为每个网络构建一次上下文，交易时按信号中的网络只读查找，不修改任何全局变量，
+# 不同网络的交易可以在多个线程中并行执行，切换网络没有重新初始化的开销
+NETWORKS = MappingProxyType({network: build_network_context(network) for network in SUPPORTED_NETWORKS})
+
+def start_gas_oracles():
+    """为配置中的每个网络启动手续费预言机的后台刷新"""
+    for context in NETWORKS.values():
+        if context["rpc_url"]:
+            context["gas_oracle"].start()
+
+def apply_config(config: dict):
+    """
+    应用配置服务推送的新快照：授权策略、替换提价幅度和手续费参数立即生效；
+    网络、RPC 节点和钱包在启动时构建进网络上下文，修改后需重启服务
+    """
+    global AUTO_APPROVE, APPROVE_MODE, UNLIMITED_APPROVE, REPLACEMENT_FEE_BUMP
+    AUTO_APPROVE = config.get("auto_approve", False)
+    APPROVE_MODE = config.get("approve_mode", "pipeline")
+    UNLIMITED_APPROVE = config.get("unlimited_approve", False)
+    REPLACEMENT_FEE_BUMP = config.get("replacement", {}).get("fee_bump", 1.125)
+    for oracle in GAS_ORACLES.values():
+        oracle.configure(config.get("gas", {}))
+    # 运行中开启 auto_approve 时补启动授权额度的事件监听
+    start_approval_watchers()
+
+# 热路径使用的函数签名及参数类型，选择器在模块加载时预先计算
+FUNCTION_SIGNATURES = {
+    "balanceOf": ("balanceOf(address)", ["address"]),
+    "allowance": ("allowance(address,address)", ["address", "address"]),
+    "approve": ("approve(address,uint256)", ["address", "uint256"]),
+    "swapExactTokensForTokens": (
+        "swapExactTokensForTokens(uint256,uint256,address[],address,uint256)",
+        ["uint256", "uint256", "address[]", "address", "uint256"]
+    )
+}
+FUNCTION_SELECTORS = {name: bytes(Web3.keccak(text=sig)[:4]) for name, (sig, _) in FUNCTION_SIGNATURES.items()}
+
+# 按 RPC 缓存的链ID；键中包含RPC，各网络的条目互不影响
+_chain_id_cache = {}
+
+@functools.lru_cache(maxsize=4096)
+def to_checksum(address: str) -> str:
+    """缓存地址的校验和格式，避免每笔交易重复计算 keccak"""
+    return Web3.to_checksum_address(address)
+
+def encode_call(name: str, *args) -> str:
+    """使用预先计算的选择器直接编码合约调用数据"""
+    _, arg_types = FUNCTION_SIGNATURES[name]
+    return "0x" + (FUNCTION_SELECTORS[name] + abi_encode(arg_types, list(args))).hex()
+
+def get_chain_id(web3, rpc_url, configured=None):
+    """优先使用配置中的链ID，否则只向节点查询一次并缓存"""
+    if configured:
+        return configured
+    chain_id = _chain_id_cache.get(rpc_url)
+    if chain_id is None:
+        chain_id = _chain_id_cache[rpc_url] = web3.eth.chain_id
+    return chain_id
+
+def is_native_token(token: str) -> bool:
+    return token.lower() in (NATIVE_TOKEN_ADDRESS, "eth")
+
+def pre_trade_checks(web3, rpc_url, wallet_address, token_in, router_address, check_token=True, check_allowance=False):
+    """
+    在一次JSON-RPC批量请求中读取交易前检查需要的链上数据：
+    ETH余额、token_in余额以及对Router的授权额度（同时读取钱包的链上nonce，用于判断哪些swap已上链）。
+    返回字典中单项查询失败的值为异常对象；节点不支持批量请求时退回逐个查询。
+    """
+    keys = ["eth_balance"]
+    calls = [("eth_getBalance", [wallet_address, "latest"])]
+    if check_token:
+        keys.append("token_balance")
+        calls.append(("eth_call", [{"to": to_checksum(token_in), "data": encode_call("balanceOf", wallet_address)}, "latest"]))
+    if check_allowance:
+        keys.append("allowance")
+        calls.append(("eth_call", [{"to": to_checksum(token_in), "data": encode_call("allowance", wallet_address, to_checksum(router_address))}, "latest"]))
+        keys.append("confirmed_nonce")
+        calls.append(("eth_getTransactionCount", [wallet_address, "latest"]))
+    try:
+        results = batch_request(rpc_target(web3, rpc_url), calls)
+    except RPCBatchError:
+        results = []
+        for method, params in calls:
+            try:
+                results.append(web3.manager.request_blocking(method, params))
+            except Exception as e:
+                results.append(e)
+    checks = {}
+    for key, result in zip(keys, results):
+        if isinstance(result, Exception):
+            checks[key] = result
+        else:
+            try:
+                checks[key] = to_int(result if result not in ("0x", None) else "0x0")
+            except Exception:
+                checks[key] = ValueError(f"Unexpected {key} result: {result}")
+    return checks
+
+# 已发送交易的参数，供执行监控请求以相同nonce提价替换卡住的交易；
+# 记录中不保存私钥，替换时按发送钱包从配置中取得签名私钥
+REPLACEMENT_FEE_BUMP = config_data.get("replacement", {}).get("fee_bump", 1.125)
+# 节点要求替换交易的手续费至少提高10%
+MIN_REPLACEMENT_BUMP = 1.1
+MAX_PENDING_RECORDS = 10000
+PENDING_TXS = OrderedDict()
+_pending_lock = threading.Lock()
+
+def _normalize_tx_hash(tx_hash: str) -> str:
+    tx_hash = tx_hash.lower()
+    return tx_hash if tx_hash.startswith("0x") else "0x" + tx_hash
+
+def record_sent_transaction(tx_hash, tx, wallet_address, web3, gas_oracle):
+    """记录已发送交易的参数，超过上限时淘汰最早的记录"""
+    with _pending_lock:
+        PENDING_TXS[_normalize_tx_hash(tx_hash)] = {
+            "tx": dict(tx),
+            "wallet_address": wallet_address,
+            "web3": web3,
+            "gas_oracle": gas_oracle
+        }
+        while len(PENDING_TXS) > MAX_PENDING_RECORDS:
+            PENDING_TXS.popitem(last=False)
+
+def bump_fees(tx: dict, current_fees: dict, bump: float) -> dict:
+    """在原手续费基础上按比例提价，且不低于当前预言机报价"""
+    bump = max(bump, MIN_REPLACEMENT_BUMP)
+    bumped = dict(tx)
+    if "maxFeePerGas" in tx:
+        tip = max(int(tx["maxPriorityFeePerGas"] * bump) + 1, current_fees.get("maxPriorityFeePerGas", 0))
+        max_fee = max(int(tx["maxFeePerGas"] * bump) + 1, current_fees.get("maxFeePerGas", 0), tip)
+        bumped.update({"maxPriorityFeePerGas": tip, "maxFeePerGas": max_fee})
+    else:
+        bumped["gasPrice"] = max(int(tx["gasPrice"] * bump) + 1, current_fees.get("gasPrice", 0))
+    return bumped
+
+def signing_key(wallet_address: str):
+    """返回配置中该钱包的私钥；交易请求中临时传入的私钥不保存，这类交易无法替换"""
+    if wallet_address and DEFAULT_PRIVATE_KEY and wallet_address.lower() == DEFAULT_WALLET_ADDRESS.lower():
+        return DEFAULT_PRIVATE_KEY
+    return None
+
+def replace_transaction(tx_hash: str, fee_bump=None):
+    """以相同nonce、更高手续费重新签名并发送卡住的交易"""
+    with _pending_lock:
+        record = PENDING_TXS.get(_normalize_tx_hash(tx_hash))
+    if record is None:
+        return {"error": f"Unknown transaction {tx_hash}, only transactions sent by this executor can be replaced"}
+    private_key = signing_key(record["wallet_address"])
+    if private_key is None:
+        return {"error": f"No configured key for wallet {record['wallet_address']}, transaction {tx_hash} cannot be replaced"}
+    web3 = record["web3"]
+    tx = bump_fees(record["tx"], record["gas_oracle"].fee_params(), fee_bump or REPLACEMENT_FEE_BUMP)
+    try:
+        signed = web3.eth.account.sign_transaction(tx, private_key=private_key)
+        new_hash = web3.eth.send_raw_transaction(signed.raw_transaction).hex()
+    except Exception as e:
+        error_msg = str(e)
+        if "nonce too low" in error_msg.lower():
+            # 该nonce已有交易上链，无需替换
+            return {"error": "Replacement not needed: a transaction with this nonce was already mined", "mined": True}
+        return {"error": f"Replacement submission failed: {error_msg}"}
+    record_sent_transaction(new_hash, tx, record["wallet_address"], web3, record["gas_oracle"])
+    return {"tx_hash": new_hash, "replaced_tx_hash": _normalize_tx_hash(tx_hash), "nonce": tx["nonce"]}
+
+# 查找网络上下文
+def get_network_config(network=None):
+    """返回指定网络的只读上下文，未指定时使用配置文件中的默认网络"""
+    if not network:
+        network = network_mode
+    
+    # 确保网络类型有效，默认回退到测试网
+    return NETWORKS.get(network) or NETWORKS["testnet"]
+
+def sync_nonces():
+    """启动时同步默认钱包的nonce，之后的交易直接从内存分配"""
+    if not DEFAULT_WALLET_ADDRESS or not Web3.is_address(DEFAULT_WALLET_ADDRESS):
+        return
+    try:
+        net_config = get_network_config()
+        net_config["nonce_manager"].sync(DEFAULT_WALLET_ADDRESS)
+    except Exception as e:
+        print(f"Warning: Failed to sync nonce for {DEFAULT_WALLET_ADDRESS}: {str(e)}")
+
+def approve_gas_key(token) -> tuple:
+    return ("approve", token.lower())
+
+def send_approve(web3, nonce_manager, gas_oracle, wallet_address, private_key, token, spender, chain_id, amount):
+    """
+    签名并发送 ERC20 approve 交易，不等待上链，返回 (交易哈希, nonce)。
+    交易参数与swap一样记录下来，卡住时可由执行监控请求提价替换
+    """
+    approve_nonce = nonce_manager.allocate(wallet_address)
+    try:
+        approve_tx = {
+            'from': wallet_address,
+            'to': to_checksum(token),
+            'data': encode_call("approve", to_checksum(spender), amount),
+            'value': 0
+        }
+        approve_tx['gas'] = gas_oracle.gas_limit(
+            approve_gas_key(token), lambda: web3.eth.estimate_gas(approve_tx), DEFAULT_APPROVE_GAS)
+        approve_tx.update(gas_oracle.fee_params())
+        approve_tx.update({'nonce': approve_nonce, 'chainId': chain_id})
+        signed_approve = web3.eth.account.sign_transaction(approve_tx, private_key=private_key)
+        tx_hash = web3.eth.send_raw_transaction(signed_approve.raw_transaction)
+    except Exception as e:
+        nonce_manager.handle_send_error(wallet_address, approve_nonce, e)
+        gas_oracle.forget_on_error(approve_gas_key(token), e)
+        raise
+    record_sent_transaction(tx_hash.hex(), approve_tx, wallet_address, web3, gas_oracle)
+    return tx_hash, approve_nonce
+
+def pre_approve_tokens(network=None):
+    """
+    为映射表中的所有ERC20代币预先设置最大授权额度。
+    一次批量请求读取全部授权额度，对额度不足的代币连续发送 approve，不等待上链。
+    每个代币的额度写入和 approve 持有与 execute_swap 相同的授权条目锁，
+    锁内发现并发swap已授权到最大额度时不再重复 approve。
+    返回 {代币符号: approve交易哈希}。
+    """
+    if not DEFAULT_WALLET_ADDRESS or not DEFAULT_PRIVATE_KEY or not Web3.is_address(DEFAULT_WALLET_ADDRESS):
+        return {}
+    net_config = get_network_config(network)
+    web3 = net_config["web3"]
+    rpc_url = net_config["rpc_url"]
+    router_address = net_config["router_address"]
+    wallet_address = to_checksum(DEFAULT_WALLET_ADDRESS)
+    chain_id = get_chain_id(web3, rpc_url, net_config["chain_id"])
+    token_addresses = net_config.get("token_addresses", TOKEN_ADDRESSES)
+    tokens = [(symbol, address) for symbol, address in token_addresses.items() if not is_native_token(address)]
+    calls = [
+        ("eth_call", [{"to": to_checksum(address), "data": encode_call("allowance", wallet_address, to_checksum(router_address))}, "latest"])
+        for _, address in tokens
+    ]
+    allowances = batch_request(rpc_target(web3, rpc_url), calls)
+    approved = {}
+    for (symbol, address), allowance in zip(tokens, allowances):
+        if isinstance(allowance, Exception):
+            print(f"Warning: Failed to read allowance for {symbol}: {str(allowance)}")
+            continue
+        allowance = to_int(allowance if allowance not in ("0x", None) else "0x0")
+        with ALLOWANCES.lock(chain_id, wallet_address, address, router_address):
+            cached = ALLOWANCES.get(chain_id, wallet_address, address, router_address)
+            # 额度仍高于最大值的一半时视为已授权
+            if cached is not None and cached >= MAX_UINT256 // 2:
+                continue
+            allowance = ALLOWANCES.seed(chain_id, wallet_address, address, router_address, allowance)
+            if allowance >= MAX_UINT256 // 2:
+                continue
+            try:
+                tx_hash, _ = send_approve(web3, net_config["nonce_manager"], net_config["gas_oracle"], wallet_address, DEFAULT_PRIVATE_KEY,
+                                       address, router_address, chain_id, MAX_UINT256)
+                ALLOWANCES.set(chain_id, wallet_address, address, router_address, MAX_UINT256)
+                approved[symbol] = tx_hash.hex()
+            except Exception as e:
+                print(f"Warning: Pre-approval for {symbol} failed: {str(e)}")
+    return approved
+
+def start_approval_watchers():
+    """
+    开启 auto_approve 时为配置中的每个网络启动后台 Approval 事件监听，
+    使被外部修改的授权额度缓存失效；已在运行的监听不重复启动
+    """
+    if not AUTO_APPROVE:
+        return APPROVAL_WATCHERS
+    for network, context in NETWORKS.items():
+        watcher = APPROVAL_WATCHERS.get(network)
+        if not context["rpc_url"] or (watcher is not None and watcher.is_alive()):
+            continue
+        try:
+            web3 = context["web3"]
+            chain_id = get_chain_id(web3, context["rpc_url"], context["chain_id"])
+            watcher = ApprovalWatcher(web3, chain_id, ALLOWANCES)
+            watcher.start()
+            APPROVAL_WATCHERS[network] = watcher
+        except Exception as e:
+            print(f"Warning: Failed to start approval watcher for {network}: {str(e)}")
+    return APPROVAL_WATCHERS
+
+def start_pre_approval():
+    """在后台线程中执行预授权，避免阻塞服务启动"""
+    if not PRE_APPROVE:
+        return None
+
+    def run():
+        try:
+            approved = pre_approve_tokens()
+            if approved:
+                print(f"Pre-approval transactions sent: {approved}")
+        except Exception as e:
+            print(f"Warning: Pre-approval job failed: {str(e)}")
+
+    thread = threading.Thread(target=run, name="pre-approval", daemon=True)
+    thread.start()
+    return thread
 
 # 解析代币地址，支持符号（如"BTC"）或直接使用合约地址
-def resolve_token_address(token):
-    """将代币符号解析为合约地址，如果输入已经是地址则直接返回"""
+def resolve_token_address(token, token_addresses=None):
+    """将代币符号解析为合约地址（默认使用通用映射表），如果输入已经是地址则直接返回"""
     # 如果输入已经看起来像是地址，则直接返回
     if token and token.startswith("0x") and len(token) >= 40:
         return token
     
-    # 否则，尝试从TOKEN_ADDRESSES映射中查找
+    # 否则，尝试从代币映射表中查找
+    token_addresses = TOKEN_ADDRESSES if token_addresses is None else token_addresses
     token_upper = token.upper() if token else ""
-    if token_upper in TOKEN_ADDRESSES:
-        return TOKEN_ADDRESSES[token_upper]
+    if token_upper in token_addresses:
+        return token_addresses[token_upper]
     
     # 如果找不到映射，返回原始输入
     return token
@@ -135,17 +449,19 @@ def execute_swap(trade: dict):
         amount_in = int(float(trade.get("amount", 0)) * (10 ** 18))  # Assuming 18 decimals
         slippage = float(trade.get("slippage", 0.01))
         network = trade.get("network")  # Support dynamic network from signal
+        net_config = get_network_config(network)
+        token_addresses = net_config.get("token_addresses", TOKEN_ADDRESSES)
         
-        # Resolve token symbols to addresses
+        # Resolve token symbols to addresses using the network's token map
         try:
-            token_in = resolve_token_address(token_in_raw)
+            token_in = resolve_token_address(token_in_raw, token_addresses)
             if not token_in:
                 return {"error": f"Unable to resolve input token {token_in_raw}, check token address mapping in config"}
         except Exception as e:
             return {"error": f"Error resolving input token: {str(e)}, check if token symbol {token_in_raw} exists in config"}
         
         try:
-            token_out = resolve_token_address(token_out_raw)
+            token_out = resolve_token_address(token_out_raw, token_addresses)
             if not token_out:
                 return {"error": f"Unable to resolve output token {token_out_raw}, check token address mapping in config"}
         except Exception as e:
@@ -160,114 +476,183 @@ def execute_swap(trade: dict):
             return {"error": "Parameter error: Input and output token addresses are required"}
         if amount_in <= 0:
             return {"error": "Parameter error: Trade amount must be greater than 0"}
+        try:
+            wallet_address = to_checksum(wallet_address)
+        except Exception:
+            return {"error": f"Configuration error: Invalid wallet address {wallet_address}"}
         
-        # Get network configuration
+        # Get network context
         try:
-            net_config = get_network_config(network)
             w3 = net_config["web3"]
-            chain_id = net_config["chain_id"]
+            rpc_url = net_config["rpc_url"]
+            chain_id = get_chain_id(w3, rpc_url, net_config["chain_id"])
             router_address = net_config["router_address"]
+            nonce_manager = net_config["nonce_manager"]
+            gas_oracle = net_config["gas_oracle"]
+            
+            # Check if router address is valid
+            if not w3.is_address(router_address):
+                return {"error": f"Invalid Router address: {router_address}"}
+            
+            # Read ETH balance, token balance and allowance in a single batched round trip
+            # The allowance is only read from chain when the cached ledger value cannot cover this trade
+            native_in = is_native_token(token_in)
+            check_allowance = AUTO_APPROVE and not native_in
+            # approve 会覆盖而不是累加授权额度：同一 (钱包, 代币, 授权对象) 的授权检查、approve 和 swap
+            # 串行执行，避免并发交易的 approve 互相覆盖导致先发送的 swap 因额度不足而回滚
+            approve_lock = ALLOWANCES.lock(chain_id, wallet_address, token_in, router_address) \
+                if check_allowance else contextlib.nullcontext()
+            with approve_lock:
+                read_allowance = check_allowance and \
+                    not ALLOWANCES.covers(chain_id, wallet_address, token_in, router_address, amount_in)
+                try:
+                    checks = pre_trade_checks(w3, rpc_url, wallet_address, token_in, router_address,
+                                              check_token=not native_in, check_allowance=read_allowance)
+                except Exception as e:
+                    return {"error": f"Failed to check wallet balance: {str(e)}"}
             
-            # Check wallet balance
-            try:
                 # Check ETH balance for gas
-                eth_balance = w3.eth.get_balance(wallet_address)
-                if eth_balance < w3.to_wei(0.001, "ether"):  # Check if enough ETH for gas
+                eth_balance = checks["eth_balance"]
+                if isinstance(eth_balance, Exception):
+                    return {"error": f"Failed to check wallet balance: {str(eth_balance)}"}
+                if eth_balance < w3.to_wei(0.001, "ether"):
                     return {"error": f"Insufficient ETH balance: {w3.from_wei(eth_balance, 'ether')} ETH, at least 0.001 ETH needed for gas"}
-                
+            
                 # If input token is not ETH, check ERC20 token balance
-                if token_in.lower() != "0xeeeeeeeeeeeeeeeeeeeeeeeeeeeeeeeeeeeeeeee" and \
-                   token_in.lower() != "eth":
+                if not native_in:
+                    token_balance = checks["token_balance"]
+                    if isinstance(token_balance, Exception):
+                        return {"error": f"Failed to check token balance: {str(token_balance)}, token contract address {token_in} may be invalid or not support standard ERC20 interface"}
+                    if token_balance < amount_in:
+                        return {"error": f"Insufficient token balance: Need {amount_in/(10**18)} {token_in_raw}, account only has {token_balance/(10**18)} {token_in_raw}"}
+            
+                # Auto approve: If token_in is not ETH and auto_approve is enabled, check and execute ERC20 approve
+                approve_tx_hash = approve_nonce = None
+                if read_allowance:
                     try:
-                        # Simple ERC20 balance check ABI
-                        balance_abi = [{"constant":True,"inputs":[{"name":"_owner","type":"address"}],
-                                        "name":"balanceOf","outputs":[{"name":"balance","type":"uint256"}],
-                                        "type":"function"}]
-                        token_contract = w3.eth.contract(address=Web3.to_checksum_address(token_in), abi=balance_abi)
-                        token_balance = token_contract.functions.balanceOf(wallet_address).call()
-                        if token_balance < amount_in:
-                            return {"error": f"Insufficient token balance: Need {amount_in/(10**18)} {token_in_raw}, account only has {token_balance/(10**18)} {token_in_raw}"}
+                        current_allowance = checks["allowance"]
+                        if isinstance(current_allowance, Exception):
+                            raise current_allowance
+                        # 额度读取到的是已上链的状态，仍需减去本地已提交、尚未上链的swap
+                        confirmed_nonce = checks.get("confirmed_nonce")
+                        if isinstance(confirmed_nonce, Exception):
+                            confirmed_nonce = None
+                        current_allowance = ALLOWANCES.seed(chain_id, wallet_address, token_in, router_address,
+                                                            current_allowance, confirmed_nonce)
+                        if current_allowance < amount_in:
+                            if APPROVE_MODE == "wait":
+                                # Legacy mode: approve the exact amount and wait for it to be mined
+                                approve_tx_hash, approve_nonce = send_approve(
+                                    w3, nonce_manager, gas_oracle, wallet_address, private_key,
+                                    token_in, router_address, chain_id, amount_in)
+                                receipt = w3.eth.wait_for_transaction_receipt(approve_tx_hash, timeout=120)
+                                if receipt.status != 1:
+                                    ALLOWANCES.invalidate(chain_id, wallet_address, token_in, router_address)
+                                    # 失败可能是缓存的 gas limit 不足，下次重新估算
+                                    gas_oracle.forget_gas_limit(approve_gas_key(token_in))
+                                    return {"error": "Approval transaction failed: Transaction rejected by blockchain, possibly due to insufficient gas or contract error"}
+                                ALLOWANCES.set(chain_id, wallet_address, token_in, router_address, amount_in)
+                            else:
+                                # Pipeline mode: the swap follows the approve with the next nonce
+                                # Approve the exact amount unless unlimited approval is explicitly enabled
+                                approve_amount = MAX_UINT256 if UNLIMITED_APPROVE else amount_in
+                                approve_tx_hash, approve_nonce = send_approve(
+                                    w3, nonce_manager, gas_oracle, wallet_address, private_key,
+                                    token_in, router_address, chain_id, approve_amount)
+                                ALLOWANCES.set(chain_id, wallet_address, token_in, router_address, approve_amount)
                     except Exception as e:
-                        return {"error": f"Failed to check token balance: {str(e)}, token contract address {token_in} may be invalid or not support standard ERC20 interface"}
-            except Exception as e:
-                return {"error": f"Failed to check wallet balance: {str(e)}"}
+                        return {"error": f"Token approval failed: {str(e)}"}
             
-            # Check if router address is valid
-            if not w3.is_address(router_address):
-                return {"error": f"Invalid Router address: {router_address}"}
+                # Calculate minimum output amount (simple ratio calculation, should use oracle in production)
+                min_amount_out = int(amount_in * (1 - slippage))
             
-            # Check network connection status
-            try:
-                block_number = w3.eth.block_number
-                print(f"Current block height: {block_number}")
-            except Exception as e:
-                return {"error": f"RPC connection error: {str(e)}, check if RPC URL is correct and accessible"}
+                # Allocate nonce locally, no RPC round trip per transaction
+                try:
+                    swap_nonce = nonce_manager.allocate(wallet_address)
+                except Exception as e:
+                    return {"error": f"Failed to allocate nonce: {str(e)}"}
             
-            # Auto approve: If token_in is not ETH and auto_approve is enabled, check and execute ERC20 approve
-            if AUTO_APPROVE and token_in.lower() != "0xeeeeeeeeeeeeeeeeeeeeeeeeeeeeeeeeeeeeeeee" and \
-               token_in.lower() != "eth":
+                # Construct swap transaction (example using swapExactTokensForTokens)
+                # Call data is encoded with the precomputed selector, no ABI lookup or RPC call needed
+                # Fees come from the cached fee history, the gas limit from a cached estimate per (router, path shape)
                 try:
-                    token_in_contract = w3.eth.contract(address=Web3.to_checksum_address(token_in), abi=erc20_abi)
-                    current_allowance = token_in_contract.functions.allowance(wallet_address, Web3.to_checksum_address(router_address)).call()
-                    if current_allowance < amount_in:
-                        approve_tx = token_in_contract.functions.approve(
-                            Web3.to_checksum_address(router_address),
-                            amount_in
-                        ).build_transaction({
-                            'from': wallet_address,
-                            'nonce': w3.eth.get_transaction_count(wallet_address),
-                            'chainId': chain_id,
-                            'gas': 60000,
-                            'gasPrice': w3.to_wei('5', 'gwei')
-                        })
-                        signed_approve = w3.eth.account.sign_transaction(approve_tx, private_key=private_key)
-                        approve_tx_hash = w3.eth.send_raw_transaction(signed_approve.rawTransaction)
-                        receipt = w3.eth.wait_for_transaction_receipt(approve_tx_hash, timeout=120)
-                        if receipt.status != 1:
-                            return {"error": "Approval transaction failed: Transaction rejected by blockchain, possibly due to insufficient gas or contract error"}
+                    deadline = int(time.time()) + 300
+                    path = [to_checksum(token_in), to_checksum(token_out)]
+                    swap_tx = {
+                        'from': wallet_address,
+                        'to': to_checksum(router_address),
+                        'data': encode_call(
+                            "swapExactTokensForTokens",
+                            amount_in,
+                            min_amount_out,
+                            path,
+                            wallet_address,
+                            deadline
+                        ),
+                        'value': 0
+                    }
+                    # The estimate would revert while a pipelined approve is still pending, use the default then
+                    swap_gas_key = ("swap", router_address.lower(), len(path))
+                    if approve_tx_hash is None:
+                        swap_tx['gas'] = gas_oracle.gas_limit(
+                            swap_gas_key,
+                            lambda: w3.eth.estimate_gas(swap_tx),
+                            DEFAULT_SWAP_GAS
+                        )
+                    else:
+                        swap_tx['gas'] = DEFAULT_SWAP_GAS
+                    swap_tx.update(gas_oracle.fee_params())
+                    swap_tx.update({'nonce': swap_nonce, 'chainId': chain_id})
                 except Exception as e:
-                    return {"error": f"Token approval failed: {str(e)}"}
+                    nonce_manager.release(wallet_address, swap_nonce)
+                    return {"error": f"Failed to build swap transaction: {str(e)}, Router contract ABI may not match or Router address is invalid on current network"}
             
-            # Calculate minimum output amount (simple ratio calculation, should use oracle in production)
-            min_amount_out = int(amount_in * (1 - slippage))
+                # Sign locally first: a signing failure never reached the node, so the nonce is returned
+                try:
+                    signed_swap = w3.eth.account.sign_transaction(swap_tx, private_key=private_key)
+                except Exception as e:
+                    nonce_manager.release(wallet_address, swap_nonce)
+                    return {"error": f"Failed to sign swap transaction: {str(e)}"}
             
-            # Construct swap transaction (example using swapExactTokensForTokens)
-            try:
-                router = w3.eth.contract(address=Web3.to_checksum_address(router_address), abi=router_abi)
-                deadline = int(time.time()) + 300
-                swap_tx = router.functions.swapExactTokensForTokens(
-                    amount_in,
-                    min_amount_out,
-                    [Web3.to_checksum_address(token_in), Web3.to_checksum_address(token_out)],
-                    wallet_address,
-                    deadline
-                ).build_transaction({
-                    'from': wallet_address,
-                    'nonce': w3.eth.get_transaction_count(wallet_address),
-                    'chainId': chain_id,
-                    'gas': 250000,
-                    'gasPrice': w3.to_wei('5', 'gwei')
-                })
-            except Exception as e:
-                return {"error": f"Failed to build swap transaction: {str(e)}, Router contract ABI may not match or Router address is invalid on current network"}
+                # Send transaction; only errors raised by the node decide whether the swap may be in the mempool
+                try:
+                    tx_hash = w3.eth.send_raw_transaction(signed_swap.raw_transaction)
+                except Exception as e:
+                    nonce_manager.handle_send_error(wallet_address, swap_nonce, e)
+                    gas_oracle.forget_on_error(swap_gas_key, e)
+                    if check_allowance:
+                        ALLOWANCES.invalidate(chain_id, wallet_address, token_in, router_address)
+                    error_msg = str(e).lower()
+                    if "insufficient funds" in error_msg:
+                        result = {"error": "Transaction failed: Insufficient ETH balance to pay for gas"}
+                    elif "nonce too low" in error_msg:
+                        result = {"error": "Transaction failed: Nonce too low, wallet may have pending transactions"}
+                    elif "gas price too low" in error_msg:
+                        result = {"error": "Transaction failed: Gas price too low, fee history may be stale"}
+                    elif "already known" in error_msg:
+                        result = {"error": "Transaction failed: Transaction already submitted, waiting for confirmation"}
+                    else:
+                        result = {"error": f"Transaction submission failed: {str(e)}"}
+                    # Unless the node definitely rejected it, the swap may already be in the mempool
+                    # A nonce that is too low was taken by another transaction, this swap was not accepted
+                    if "nonce too low" not in error_msg and \
+                            not any(pattern in error_msg for pattern in NONCE_REJECTED_ERRORS):
+                        result["sent"] = "unknown"
+                    return result
             
-            # Sign and send transaction
-            try:
-                signed_swap = w3.eth.account.sign_transaction(swap_tx, private_key=private_key)
-                tx_hash = w3.eth.send_raw_transaction(signed_swap.rawTransaction)
-                return {"tx_hash": tx_hash.hex()}
-            except Exception as e:
-                error_msg = str(e)
-                if "insufficient funds" in error_msg.lower():
-                    return {"error": "Transaction failed: Insufficient ETH balance to pay for gas"}
-                elif "nonce too low" in error_msg.lower():
-                    return {"error": "Transaction failed: Nonce too low, wallet may have pending transactions"}
-                elif "gas price too low" in error_msg.lower():
-                    return {"error": "Transaction failed: Gas price too low, increase gasPrice"}
-                elif "already known" in error_msg.lower():
-                    return {"error": "Transaction failed: Transaction already submitted, waiting for confirmation"}
-                else:
-                    return {"error": f"Transaction submission failed: {error_msg}"}
+                # The swap was sent once the hash exists, bookkeeping failures must not reset the nonce
+                try:
+                    record_sent_transaction(tx_hash.hex(), swap_tx, wallet_address, w3, gas_oracle)
+                    if check_allowance:
+                        ALLOWANCES.consume(chain_id, wallet_address, token_in, router_address, amount_in, swap_nonce)
+                except Exception as e:
+                    print(f"Warning: Failed to record sent swap {tx_hash.hex()}: {str(e)}")
+                # The nonces let the execution monitor replace a stuck approve before the swap behind it
+                result = {"tx_hash": tx_hash.hex(), "nonce": swap_nonce, "wallet_address": wallet_address}
+                if approve_tx_hash is not None:
+                    result["approve_tx_hash"] = approve_tx_hash.hex()
+                    result["approve_nonce"] = approve_nonce
+                return result
                 
         except Exception as e:
             return {"error": f"Network configuration error: {str(e)}"}
@@ -1,5 +1,7 @@
 # ATM/services/dex_executor/router.py
-from fastapi import APIRouter
+import os
+import hmac
+from fastapi import APIRouter, Header, HTTPException
 # 同时支持Docker环境和本地环境的导入
 try:
     from services.dex_executor.logic import dex_logic
@@ -9,14 +11,32 @@ except ImportError:
 
 router = APIRouter()
 
+# 内部接口（如交易替换）的共享令牌，由执行监控在 X-Internal-Token 请求头中携带；未配置时拒绝调用
+INTERNAL_API_TOKEN = os.getenv("INTERNAL_API_TOKEN", "")
+
+def require_internal_token(token: str):
+    if not INTERNAL_API_TOKEN or not hmac.compare_digest(token or "", INTERNAL_API_TOKEN):
+        raise HTTPException(status_code=403, detail="Internal endpoint: invalid or missing X-Internal-Token")
+
 @router.post("/dex/execute")
 def execute_trade(trade: dict):
     try:
-        tx_hash = dex_logic.execute_swap(trade)
-        return {"status": "submitted", "tx_hash": tx_hash}
+        result = dex_logic.execute_swap(trade)
+        if "error" in result:
+            return result
+        return {"status": "submitted", **result}
     except Exception as e:
         return {"error": str(e)}
 
+@router.post("/dex/replace")
+def replace_trade(request: dict, x_internal_token: str = Header(None)):
+    # 以相同nonce提价重发卡住的交易，仅供执行监控服务调用
+    require_internal_token(x_internal_token)
+    tx_hash = request.get("tx_hash")
+    if not tx_hash:
+        return {"error": "tx_hash is required"}
+    return dex_logic.replace_transaction(tx_hash, request.get("fee_bump"))
+
 @router.get("/dex/status")
 def get_dex_status():
     # 返回服务状态信息
@@ -1,20 +1,509 @@
-# ATM/services/execution_monitor/logic/monitor_logic.py
 import time
 import os, json
-from web3 import Web3, HTTPProvider
+import threading
+import requests
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from web3 import Web3
+# 同时支持Docker环境和本地环境的导入
+try:
+    from services.common.rpc_batch import batch_request, RPCBatchError, to_int
+    from services.common.provider_pool import ProviderPool
+except ImportError:
+    from ...common.rpc_batch import batch_request, RPCBatchError, to_int
+    from ...common.provider_pool import ProviderPool
 
-CONFIG_PATH = os.path.join(os.path.dirname(os.path.dirname(os.path.dirname(__file__))), "config.json")
+# ATM_CONFIG_PATH 可指定其它配置文件（如测试使用 config.example.json）
+CONFIG_PATH = os.getenv("ATM_CONFIG_PATH") or \
+    os.path.join(os.path.dirname(os.path.dirname(os.path.dirname(__file__))), "config.json")
 with open(CONFIG_PATH, "r") as f:
     config_data = json.load(f)
+# 支持的网络：配置了节点的网络各由一个 BlockFollower 跟踪区块
+SUPPORTED_NETWORKS = ("testnet", "mainnet")
 network_mode = config_data.get("network_mode", "testnet")
 network_cfg = config_data.get(network_mode, {})
 RPC_URL = network_cfg.get("rpc_url")
-w3 = Web3(HTTPProvider(RPC_URL))
+# 多节点连接池：读请求发往最快的可用节点，故障节点熔断后自动恢复
+RPC_POOL = ProviderPool.from_config(network_cfg, config_data.get("rpc_pool"))
+w3 = Web3(RPC_POOL)
+# 各网络的 RPC 连接池和 Web3 对象，默认网络之外的在首次用到时创建
+RPC_POOLS = {network_mode: RPC_POOL}
+WEB3_CLIENTS = {}
+_pools_lock = threading.Lock()
+
+# 跟踪参数：订阅（或轮询）新区块，只对出现在新区块中的已登记交易查询收据
+MONITOR_CFG = config_data.get("monitor", {})
+POLL_INTERVAL = MONITOR_CFG.get("poll_interval", 2)
+BATCH_SIZE = MONITOR_CFG.get("batch_size", 100)
+PENDING_TIMEOUT = MONITOR_CFG.get("pending_timeout", 1800)
+# 轮询模式下一次最多追赶的区块数，超过时对全部未确认交易做一次收据全量检查
+MAX_CATCHUP_BLOCKS = MONITOR_CFG.get("max_catchup_blocks", 20)
+# 已到达最终状态的交易保留 final_retention 秒供查询，且最多保留 max_final 条，超出后从缓存中移除
+FINAL_RETENTION = MONITOR_CFG.get("final_retention", 3600)
+MAX_FINAL = MONITOR_CFG.get("max_final", 10000)
+
+# 卡住交易的替换策略：连续 after_blocks 个区块未上链时，请求 DEX Executor 以相同nonce提价重发
+REPLACEMENT_CFG = config_data.get("replacement", {})
+DEFAULT_REPLACEMENT_POLICY = {
+    "enabled": REPLACEMENT_CFG.get("enabled", True),
+    "after_blocks": REPLACEMENT_CFG.get("after_blocks", 3),
+    "max_replacements": REPLACEMENT_CFG.get("max_replacements", 3),
+    "fee_bump": REPLACEMENT_CFG.get("fee_bump", 1.125)
+}
+DEX_EXECUTOR_URL = "http://dex_executor:52130"
+_dex_session = requests.Session()
+# 调用 DEX Executor 内部接口的共享令牌（与 dex_executor 的 INTERNAL_API_TOKEN 相同）
+_dex_session.headers["X-Internal-Token"] = os.getenv("INTERNAL_API_TOKEN", "")
+
+# 各网络已处理的新区块计数，用于判断交易在其所在链上已等待了多少个区块
+BLOCK_TICKS = {}
+
+# 已登记交易的状态缓存：原始 tx_hash -> 状态字典
+TRACKED_TXS = {}
+# 替换交易哈希 -> 原始交易哈希
+ALIASES = {}
+# 仍在等待上链的交易哈希集合，用于与新区块中的交易做匹配
+WATCHED = set()
+# 新登记、尚未做过首次收据检查的交易（可能在登记前就已上链）
+UNCHECKED = set()
+# 已到达最终状态的交易：原始 tx_hash -> 进入最终状态的时间，按时间顺序淘汰
+FINALIZED = OrderedDict()
+_tracked_lock = threading.Lock()
+
+def _normalize_hash(tx_hash) -> str:
+    if isinstance(tx_hash, (bytes, bytearray)):
+        tx_hash = tx_hash.hex()
+    tx_hash = tx_hash.lower()
+    return tx_hash if tx_hash.startswith("0x") else "0x" + tx_hash
+
+def get_rpc_pool(network=None) -> ProviderPool:
+    """返回指定网络的 RPC 连接池，未配置的网络使用默认网络"""
+    network = network or network_mode
+    pool = RPC_POOLS.get(network)
+    if pool is None:
+        if not config_data.get(network):
+            return RPC_POOL
+        with _pools_lock:
+            pool = RPC_POOLS.get(network)
+            if pool is None:
+                pool = RPC_POOLS[network] = ProviderPool.from_config(config_data[network], config_data.get("rpc_pool"))
+    return pool
+
+def get_web3(network=None) -> Web3:
+    """返回指定网络的 Web3 对象，未配置的网络使用默认网络"""
+    network = follower_network(network)
+    if network == network_mode:
+        return w3
+    client = WEB3_CLIENTS.get(network)
+    if client is None:
+        client = WEB3_CLIENTS.setdefault(network, Web3(get_rpc_pool(network)))
+    return client
+
+def follower_network(network=None) -> str:
+    """返回跟踪该网络区块的网络：与 get_rpc_pool 一致，未配置的网络归入默认网络"""
+    network = network or network_mode
+    return network if config_data.get(network) else network_mode
+
+def monitored_networks() -> list:
+    """需要跟踪区块的网络：默认网络以及其它配置了节点的网络"""
+    return [network_mode] + [network for network in SUPPORTED_NETWORKS
+                             if network != network_mode and config_data.get(network)]
+
+def _entry_network_locked(tx_hash: str) -> str:
+    entry = TRACKED_TXS.get(ALIASES.get(tx_hash, tx_hash))
+    return follower_network(entry["network"] if entry else None)
+
+def _finalize_locked(original_hash: str, entry: dict, now: float):
+    """交易到达最终状态：停止匹配其所有版本，并登记到淘汰队列（调用方持有 _tracked_lock）"""
+    for candidate in entry["tx_hashes"]:
+        WATCHED.discard(candidate)
+    FINALIZED[original_hash] = now
+
+def _public(entry: dict) -> dict:
+    """返回对外展示的状态副本，隐藏内部字段"""
+    return {key: value for key, value in entry.items() if not key.startswith("_")}
+
+def register_tx(tx_hash: str, network=None, original_signal=None, replacement_policy=None,
+                wallet_address=None, nonce=None) -> dict:
+    """
+    登记需要监控的交易并立即返回当前缓存状态。提供发送钱包和nonce时，
+    同一钱包卡住的交易按nonce从小到大替换
+    """
+    tx_hash = _normalize_hash(tx_hash)
+    network = network or network_mode
+    now = time.time()
+    with _tracked_lock:
+        entry = TRACKED_TXS.get(ALIASES.get(tx_hash, tx_hash))
+        if entry is None:
+            entry = {
+                "tx_hash": tx_hash,
+                "status": "pending",
+                "network": network,
+                "original_signal": original_signal,
+                "wallet_address": wallet_address.lower() if wallet_address else None,
+                "nonce": nonce,
+                "timestamp": int(now),
+                "updated_at": int(now),
+                "replacements": 0,
+                "tx_hashes": [tx_hash],
+                "_policy": {**DEFAULT_REPLACEMENT_POLICY, **(replacement_policy or {})},
+                "_submitted_tick": BLOCK_TICKS.get(follower_network(network), 0)
+            }
+            TRACKED_TXS[tx_hash] = entry
+            WATCHED.add(tx_hash)
+            UNCHECKED.add(tx_hash)
+        return _public(entry)
+
+def get_tx_status(tx_hash: str):
+    """返回缓存中的交易状态（可用原始或替换交易哈希查询），未登记的交易返回 None"""
+    tx_hash = _normalize_hash(tx_hash)
+    with _tracked_lock:
+        entry = TRACKED_TXS.get(ALIASES.get(tx_hash, tx_hash))
+        return _public(entry) if entry else None
 
 def monitor_tx(tx_hash: str):
-    try:
-        receipt = w3.eth.wait_for_transaction_receipt(tx_hash, timeout=120)
-        status = "confirmed" if receipt.status == 1 else "failed"
-        return {"status": status, "block": receipt.blockNumber, "gas_used": receipt.gasUsed}
-    except Exception as e:
-        return {"status": "pending", "error": str(e)}
+    """登记交易，不再阻塞等待收据；状态由后台区块跟踪更新"""
+    entry = register_tx(tx_hash)
+    return {key: entry[key] for key in ("status", "block", "gas_used") if key in entry}
+
+def pending_hashes() -> list:
+    with _tracked_lock:
+        return [h for entry in TRACKED_TXS.values() if entry["status"] == "pending" for h in entry["tx_hashes"]]
+
+def take_unchecked(network=None) -> list:
+    """取出尚未做过首次收据检查的交易；指定网络时只取出该网络的交易"""
+    with _tracked_lock:
+        if network is None:
+            hashes = [h for h in UNCHECKED if h in WATCHED]
+            UNCHECKED.clear()
+            return hashes
+        taken = [h for h in UNCHECKED if _entry_network_locked(h) == network]
+        UNCHECKED.difference_update(taken)
+        return [h for h in taken if h in WATCHED]
+
+def mark_all_unchecked(network=None):
+    """区块跟踪出现断档时，让（指定网络的）全部未确认交易在下一轮重新检查收据"""
+    with _tracked_lock:
+        UNCHECKED.update(h for h in WATCHED if network is None or _entry_network_locked(h) == network)
+
+def match_block_transactions(tx_hashes) -> list:
+    """返回区块交易中属于已登记、未确认交易的哈希"""
+    with _tracked_lock:
+        if not WATCHED:
+            return []
+        return [h for h in (_normalize_hash(t) for t in tx_hashes) if h in WATCHED]
+
+def apply_receipt(tx_hash: str, receipt: dict):
+    """根据 JSON-RPC 返回的原始收据更新交易状态，记录最终上链的交易哈希"""
+    now = time.time()
+    with _tracked_lock:
+        original_hash = ALIASES.get(tx_hash, tx_hash)
+        entry = TRACKED_TXS.get(original_hash)
+        if entry is None or entry["status"] != "pending":
+            return
+        entry["status"] = "confirmed" if to_int(receipt.get("status")) == 1 else "failed"
+        entry["block"] = to_int(receipt.get("blockNumber"))
+        entry["gas_used"] = to_int(receipt.get("gasUsed"))
+        entry["final_tx_hash"] = tx_hash
+        entry["updated_at"] = int(now)
+        # 同一nonce的其它版本不会再上链
+        _finalize_locked(original_hash, entry, now)
+
+def add_replacement(original_hash: str, new_hash: str):
+    """登记替换交易，与原交易一起参与区块匹配"""
+    new_hash = _normalize_hash(new_hash)
+    with _tracked_lock:
+        entry = TRACKED_TXS.get(original_hash)
+        if entry is None or entry["status"] != "pending":
+            return
+        entry["tx_hashes"].append(new_hash)
+        entry["replacements"] += 1
+        entry["_submitted_tick"] = BLOCK_TICKS.get(follower_network(entry["network"]), 0)
+        entry["updated_at"] = int(time.time())
+        ALIASES[new_hash] = original_hash
+        WATCHED.add(new_hash)
+        UNCHECKED.add(new_hash)
+
+def _lowest_nonces_locked() -> dict:
+    """各 (网络, 钱包) 未确认交易中最小的nonce（调用方持有 _tracked_lock）"""
+    lowest = {}
+    for entry in TRACKED_TXS.values():
+        if entry["status"] != "pending" or entry.get("wallet_address") is None or entry.get("nonce") is None:
+            continue
+        key = (entry["network"], entry["wallet_address"])
+        if key not in lowest or entry["nonce"] < lowest[key]:
+            lowest[key] = entry["nonce"]
+    return lowest
+
+def stuck_transactions(network=None) -> list:
+    """
+    返回按替换策略需要提价重发的交易：(原始哈希, 最新哈希, 提价比例)，指定网络时只返回该网络的交易。
+    同一钱包只替换nonce最小的未确认交易：更大nonce的交易（如 approve 之后的 swap）
+    在它上链前无法上链，提价只会白白消耗替换次数
+    """
+    stuck = []
+    with _tracked_lock:
+        lowest = _lowest_nonces_locked()
+        for original_hash, entry in TRACKED_TXS.items():
+            policy = entry["_policy"]
+            if entry["status"] != "pending" or not policy["enabled"]:
+                continue
+            chain = follower_network(entry["network"])
+            if network is not None and chain != network:
+                continue
+            if entry.get("nonce") is not None and \
+                    entry["nonce"] > lowest.get((entry["network"], entry.get("wallet_address")), entry["nonce"]):
+                continue
+            if entry["replacements"] >= policy["max_replacements"]:
+                continue
+            if BLOCK_TICKS.get(chain, 0) - entry["_submitted_tick"] >= policy["after_blocks"]:
+                stuck.append((original_hash, entry["tx_hashes"][-1], policy["fee_bump"]))
+    return stuck
+
+def request_replacement(tx_hash: str, fee_bump: float):
+    """请求 DEX Executor 以相同nonce提价重发交易，返回响应字典"""
+    response = _dex_session.post(f"{DEX_EXECUTOR_URL}/dex/replace",
+                                 json={"tx_hash": tx_hash, "fee_bump": fee_bump}, timeout=10)
+    return response.json()
+
+def replace_stuck_transactions(network=None) -> int:
+    """对（指定网络）卡住的交易执行替换，返回成功发出的替换交易数"""
+    replaced = 0
+    for original_hash, latest_hash, fee_bump in stuck_transactions(network):
+        try:
+            result = request_replacement(latest_hash, fee_bump)
+        except Exception as e:
+            print(f"Warning: Replacement request for {latest_hash} failed: {str(e)}")
+            continue
+        if "tx_hash" in result:
+            add_replacement(original_hash, result["tx_hash"])
+            replaced += 1
+            continue
+        with _tracked_lock:
+            entry = TRACKED_TXS.get(original_hash)
+            if entry is None:
+                continue
+            if result.get("mined"):
+                # 该nonce已有交易上链，等待收据即可，并立即复查所有版本
+                entry["_submitted_tick"] = BLOCK_TICKS.get(follower_network(entry["network"]), 0)
+                UNCHECKED.update(h for h in entry["tx_hashes"] if h in WATCHED)
+            else:
+                # 无法替换（例如不是由本系统发出的交易），停止对该交易的替换尝试
+                entry["_policy"] = {**entry["_policy"], "enabled": False}
+                entry["replacement_error"] = result.get("error")
+    return replaced
+
+def hashes_by_network(hashes) -> dict:
+    """按交易登记的网络对交易哈希分组"""
+    groups = {}
+    with _tracked_lock:
+        for tx_hash in hashes:
+            entry = TRACKED_TXS.get(ALIASES.get(tx_hash, tx_hash))
+            network = entry["network"] if entry else network_mode
+            groups.setdefault(network, []).append(tx_hash)
+    return groups
+
+def poll_receipts(hashes=None):
+    """按网络分批通过 JSON-RPC 批量请求查询交易收据，返回本轮确认（或失败）的交易数"""
+    hashes = pending_hashes() if hashes is None else hashes
+    resolved = 0
+    chunks = [(network, group[start:start + BATCH_SIZE])
+              for network, group in hashes_by_network(hashes).items()
+              for start in range(0, len(group), BATCH_SIZE)]
+    for network, chunk in chunks:
+        try:
+            receipts = batch_request(get_rpc_pool(network), [("eth_getTransactionReceipt", [h]) for h in chunk])
+        except RPCBatchError as e:
+            print(f"Warning: Receipt polling failed: {str(e)}")
+            # 查询失败的交易留到下一轮重新检查
+            with _tracked_lock:
+                UNCHECKED.update(chunk)
+            continue
+        for tx_hash, receipt in zip(chunk, receipts):
+            if receipt and not isinstance(receipt, RPCBatchError):
+                apply_receipt(tx_hash, receipt)
+                resolved += 1
+    return resolved
+
+def expire_stale(now=None):
+    """长时间未上链的交易标记为 timeout，不再参与跟踪"""
+    now = now or time.time()
+    with _tracked_lock:
+        for tx_hash in list(WATCHED):
+            original_hash = ALIASES.get(tx_hash, tx_hash)
+            entry = TRACKED_TXS[original_hash]
+            if entry["status"] == "pending" and now - entry["timestamp"] > PENDING_TIMEOUT:
+                entry["status"] = "timeout"
+                entry["updated_at"] = int(now)
+                _finalize_locked(original_hash, entry, now)
+
+def evict_final(now=None) -> int:
+    """从缓存中移除超过保留期或超出数量上限的最终状态交易，返回移除数"""
+    now = now or time.time()
+    evicted = 0
+    with _tracked_lock:
+        while FINALIZED:
+            original_hash, finalized_at = next(iter(FINALIZED.items()))
+            if now - finalized_at <= FINAL_RETENTION and len(FINALIZED) <= MAX_FINAL:
+                break
+            del FINALIZED[original_hash]
+            entry = TRACKED_TXS.pop(original_hash, None)
+            for tx_hash in (entry["tx_hashes"] if entry else ()):
+                ALIASES.pop(tx_hash, None)
+                UNCHECKED.discard(tx_hash)
+            evicted += 1
+    return evicted
+
+
+class BlockFollower(threading.Thread):
+    """
+    每个网络一个后台线程跟踪该网络的新区块。
+
+    优先使用节点的新区块过滤器（eth_newBlockFilter）接收新块，节点不支持时
+    退回 eth_blockNumber 轮询。每个新块只拉取一次交易哈希列表，与已登记交易匹配，
+    仅对匹配到的交易批量查询收据，RPC 开销随出块速度而不是登记交易数增长。
+    """
+
+    def __init__(self, network=None, interval=POLL_INTERVAL):
+        self.network = network or network_mode
+        super().__init__(name=f"block-follower-{self.network}", daemon=True)
+        self.interval = interval
+        self.last_block = None
+        self._polled_head = None  # 本轮轮询到的最新区块号，处理成功后才记为 last_block
+        self.block_filter = None
+        self.polling_only = False
+        # 替换请求是对 DEX Executor 的阻塞调用，在单独的线程中执行，不拖慢区块跟踪和收据查询
+        self._replacer = None
+        self._replacing = None
+        self._stop_event = threading.Event()
+
+    def run(self):
+        while not self._stop_event.is_set():
+            try:
+                self.tick()
+            except Exception as e:
+                print(f"Warning: Block follower error: {str(e)}")
+            self._stop_event.wait(self.interval)
+
+    @property
+    def web3(self) -> Web3:
+        return get_web3(self.network)
+
+    def tick(self):
+        matched = set(take_unchecked(self.network))
+        try:
+            new_blocks = self.new_blocks()
+            for block_id in new_blocks:
+                if not WATCHED:
+                    continue
+                block = self.web3.eth.get_block(block_id)
+                matched.update(match_block_transactions(block["transactions"]))
+            if matched:
+                poll_receipts(sorted(matched))
+        except Exception:
+            # 本轮已取出的待查交易和过滤器返回的新块无法重新获取，全部未确认交易下一轮复查；
+            # 轮询模式下 last_block 不前移，下一轮重新拉取这些区块
+            self._polled_head = None
+            mark_all_unchecked(self.network)
+            raise
+        if self._polled_head is not None:
+            self.last_block, self._polled_head = self._polled_head, None
+        if new_blocks:
+            BLOCK_TICKS[self.network] = BLOCK_TICKS.get(self.network, 0) + len(new_blocks)
+            self.schedule_replacements()
+        expire_stale()
+        evict_final()
+
+    def schedule_replacements(self):
+        """在替换线程中处理卡住的交易，上一轮仍在进行时跳过"""
+        if self._replacing is not None and not self._replacing.done():
+            return
+        if self._replacer is None:
+            self._replacer = ThreadPoolExecutor(max_workers=1, thread_name_prefix="tx-replacer")
+        self._replacing = self._replacer.submit(self._replace)
+
+    def _replace(self):
+        try:
+            replace_stuck_transactions(self.network)
+        except Exception as e:
+            print(f"Warning: Transaction replacement error: {str(e)}")
+
+    def new_blocks(self) -> list:
+        """返回自上次调用以来的新区块（区块哈希或区块号）"""
+        if self.block_filter is None and not self.polling_only:
+            try:
+                self.block_filter = self.web3.eth.filter("latest")
+            except Exception as e:
+                print(f"Block filter not supported, falling back to polling: {str(e)}")
+                self.polling_only = True
+        if self.block_filter is not None:
+            try:
+                return list(self.block_filter.get_new_entries())
+            except Exception as e:
+                # 过滤器失效（如节点重启），下一轮重建，期间可能漏块，全量复查一次
+                print(f"Warning: Block filter lost, recreating: {str(e)}")
+                self.block_filter = None
+                mark_all_unchecked(self.network)
+                return []
+        return self.poll_block_numbers()
+
+    def poll_block_numbers(self) -> list:
+        head = self.web3.eth.block_number
+        if self.last_block is None:
+            self._polled_head = head
+            return [head]
+        if head <= self.last_block:
+            return []
+        start = self.last_block + 1
+        if head - start + 1 > MAX_CATCHUP_BLOCKS:
+            start = head - MAX_CATCHUP_BLOCKS + 1
+            mark_all_unchecked(self.network)
+        self._polled_head = head
+        return list(range(start, head + 1))
+
+    def stop(self):
+        self._stop_event.set()
+        if self._replacer is not None:
+            self._replacer.shutdown(wait=False)
+
+
+# 网络 -> 跟踪该网络区块的 BlockFollower
+FOLLOWERS = {}
+
+def start_scheduler():
+    """为每个配置了节点的网络启动一个区块跟踪线程，已在运行的不重复启动"""
+    for network in monitored_networks():
+        follower = FOLLOWERS.get(network)
+        if follower is None or not follower.is_alive():
+            follower = FOLLOWERS[network] = BlockFollower(network)
+            follower.start()
+    return FOLLOWERS
+
+def stop_scheduler():
+    for follower in FOLLOWERS.values():
+        follower.stop()
+    FOLLOWERS.clear()
+
+def apply_config(config: dict):
+    """
+    应用配置服务推送的新快照：跟踪参数和默认替换策略立即生效（已登记交易保留登记时的策略）；
+    RPC 节点和网络修改后需重启服务
+    """
+    global POLL_INTERVAL, BATCH_SIZE, PENDING_TIMEOUT, MAX_CATCHUP_BLOCKS, FINAL_RETENTION, MAX_FINAL
+    global DEFAULT_REPLACEMENT_POLICY
+    monitor_cfg = config.get("monitor", {})
+    replacement_cfg = config.get("replacement", {})
+    POLL_INTERVAL = monitor_cfg.get("poll_interval", 2)
+    BATCH_SIZE = monitor_cfg.get("batch_size", 100)
+    PENDING_TIMEOUT = monitor_cfg.get("pending_timeout", 1800)
+    MAX_CATCHUP_BLOCKS = monitor_cfg.get("max_catchup_blocks", 20)
+    FINAL_RETENTION = monitor_cfg.get("final_retention", 3600)
+    MAX_FINAL = monitor_cfg.get("max_final", 10000)
+    DEFAULT_REPLACEMENT_POLICY = {
+        "enabled": replacement_cfg.get("enabled", True),
+        "after_blocks": replacement_cfg.get("after_blocks", 3),
+        "max_replacements": replacement_cfg.get("max_replacements", 3),
+        "fee_bump": replacement_cfg.get("fee_bump", 1.125)
+    }
+    for follower in FOLLOWERS.values():
+        follower.interval = POLL_INTERVAL
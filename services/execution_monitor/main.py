@@ -1,12 +1,19 @@
 # ATM/services/execution_monitor/main.py
-import json, os
 from fastapi import FastAPI
 # 注意：在Docker容器中使用绝对导入而不是相对导入
 try:
     from services.execution_monitor.router import router
+    from services.common.config_file import load_config
 except ImportError:
     # 在本地开发环境中回退使用相对导入
     from .router import router
+    from ..common.config_file import load_config
+try:
+    from services.execution_monitor.logic import monitor_logic
+    from services.common.config_client import CONFIG
+except ImportError:
+    from .logic import monitor_logic
+    from ..common.config_client import CONFIG
 
 
 def get_default_port(service_name: str) -> int:
@@ -21,24 +28,26 @@ def get_default_port(service_name: str) -> int:
     }
     return default_ports.get(service_name, 52100)
 def get_service_port(service_name: str) -> int:
-    # 首先尝试Docker容器中的配置路径
-    config_path = "/app/config.json"
-    # 检查文件是否真的存在且是文件而不是目录
-    if not os.path.isfile(config_path):
-        # 本地开发环境的回退路径
-        config_path = os.path.join(os.path.dirname(os.path.dirname(os.path.dirname(__file__))), "config.json")
-    if os.path.isfile(config_path):
-        with open(config_path, "r") as f:
-            cfg = json.load(f)
-        ports = cfg.get("ports", {})
-        return int(ports.get(service_name, get_default_port(service_name)))
-    
-    # 如果找不到配置文件，使用默认端口
-    return get_default_port(service_name)
+    # 读取Docker容器中或本地开发环境的配置文件（按 mtime 缓存），找不到时使用默认端口
+    ports = load_config().get("ports", {})
+    return int(ports.get(service_name, get_default_port(service_name)))
 
 app = FastAPI(title="Execution Monitor Service", version="1.0")
 app.include_router(router)
 
+@app.on_event("startup")
+def start_receipt_scheduler():
+    """启动后台区块跟踪线程"""
+    monitor_logic.start_scheduler()
+    # 订阅配置服务推送的配置变化
+    CONFIG.subscribe(monitor_logic.apply_config)
+    CONFIG.start()
+
+@app.on_event("shutdown")
+def stop_receipt_scheduler():
+    monitor_logic.stop_scheduler()
+    CONFIG.stop()
+
 if __name__ == "__main__":
     import uvicorn
     port = get_service_port("execution_monitor")
@@ -1,5 +1,5 @@
 # ATM/services/execution_monitor/router.py
-from fastapi import APIRouter
+from fastapi import APIRouter, HTTPException
 # 同时支持Docker环境和本地环境的导入
 try:
     from services.execution_monitor.logic import monitor_logic
@@ -14,7 +14,25 @@ def monitor_transaction(tx_hash: str):
     status = monitor_logic.monitor_tx(tx_hash)
     return {"tx_hash": tx_hash, "status": status}
 
+@router.post("/monitor/tx")
+def register_transaction(request: dict):
+    # 登记交易后立即返回，收据由后台轮询获取
+    tx_hash = request.get("tx_hash")
+    if not tx_hash:
+        raise HTTPException(status_code=400, detail="tx_hash is required")
+    return monitor_logic.register_tx(tx_hash, request.get("network"), request.get("original_signal"),
+                                     request.get("replacement_policy"), request.get("wallet_address"),
+                                     request.get("nonce"))
+
 @router.get("/monitor/status")
 def get_monitor_status():
     # 返回服务状态信息
-    return {"status": "running", "service": "execution_monitor"}
+    return {"status": "running", "service": "execution_monitor", "pending": len(monitor_logic.pending_hashes())}
+
+@router.get("/monitor/{tx_hash}")
+def get_transaction_status(tx_hash: str):
+    # 返回缓存中的交易状态
+    entry = monitor_logic.get_tx_status(tx_hash)
+    if entry is None:
+        return {"tx_hash": tx_hash, "status": "unknown"}
+    return entry
@@ -0,0 +1,184 @@
+# ATM/services/risk_controller/logic/risk_journal.py
+import os
+import re
+import json
+import time
+import threading
+
+SNAPSHOT_FILE = "snapshot.json"
+SEGMENT_PATTERN = re.compile(r"^journal-(\d+)\.log$")
+
+
+def _fsync_dir(directory: str):
+    """确保目录项（新建、重命名、删除的文件）落盘"""
+    try:
+        fd = os.open(directory, os.O_RDONLY)
+    except OSError:
+        return
+    try:
+        os.fsync(fd)
+    except OSError:
+        pass
+    finally:
+        os.close(fd)
+
+
+class RiskJournal:
+    """
+    风控状态的追加日志。
+
+    事件以 JSON 行追加到内存缓冲，后台线程每隔 flush_interval 秒批量写入当前日志段并
+    fsync 一次，热路径只有一次内存追加。日志段达到 segment_events 条后切换到新段，
+    由后台线程把旧段重放进上一个快照生成新快照，再删除旧段，重启时只需加载快照并
+    重放最近的日志段。进程崩溃最多丢失最后一个刷盘周期内的事件。
+    """
+
+    def __init__(self, directory: str, engine_factory, flush_interval=0.05, segment_events=10000):
+        self.directory = directory
+        self.engine_factory = engine_factory
+        self.flush_interval = flush_interval
+        self.segment_events = segment_events
+        self._buffer = []
+        self._lock = threading.Lock()
+        self._file = None
+        self._segment = 0
+        self._segment_count = 0
+        self._thread = None
+        self._stop_event = threading.Event()
+
+    def _segment_path(self, segment: int) -> str:
+        return os.path.join(self.directory, f"journal-{segment:08d}.log")
+
+    def _segments(self) -> list:
+        segments = []
+        for name in os.listdir(self.directory):
+            match = SEGMENT_PATTERN.match(name)
+            if match:
+                segments.append(int(match.group(1)))
+        return sorted(segments)
+
+    def _read_snapshot(self):
+        path = os.path.join(self.directory, SNAPSHOT_FILE)
+        if not os.path.isfile(path):
+            return None
+        with open(path, "r") as f:
+            return json.load(f)
+
+    def _replay_segment(self, engine, segment: int) -> int:
+        replayed = 0
+        with open(self._segment_path(segment), "r") as f:
+            for line in f:
+                try:
+                    event = json.loads(line)
+                except ValueError:
+                    # 崩溃时最后一行可能只写了一半
+                    break
+                engine.apply_event(event)
+                replayed += 1
+        return replayed
+
+    def load(self, engine) -> dict:
+        """把快照和之后的日志段重放进 engine，并打开新的日志段"""
+        started = time.time()
+        os.makedirs(self.directory, exist_ok=True)
+        snapshot = self._read_snapshot()
+        last_segment = 0
+        if snapshot is not None:
+            engine.load_state(snapshot["state"])
+            last_segment = snapshot["segment"]
+        # 快照已包含的日志段（压缩后、删除前崩溃时遗留）不再重放，直接删除
+        self._remove_segments(last_segment)
+        replayed = 0
+        segments = [segment for segment in self._segments() if segment > last_segment]
+        for segment in segments:
+            replayed += self._replay_segment(engine, segment)
+        # 不向可能被截断的旧段继续追加，总是从新段开始
+        self._segment = max([last_segment] + segments)
+        self._open_next_segment()
+        return {"snapshot": snapshot is not None, "segments": len(segments), "events": replayed,
+                "elapsed_ms": round((time.time() - started) * 1000, 2)}
+
+    def _open_next_segment(self):
+        if self._file is not None:
+            self._file.close()
+        self._segment += 1
+        self._segment_count = 0
+        self._file = open(self._segment_path(self._segment), "a")
+        _fsync_dir(self.directory)
+
+    def append(self, event: dict):
+        """追加一条事件，由后台线程批量落盘"""
+        line = json.dumps(event, separators=(",", ":")) + "\n"
+        with self._lock:
+            self._buffer.append(line)
+
+    def flush(self):
+        """把缓冲的事件写入当前日志段并 fsync，必要时切换日志段并压缩"""
+        with self._lock:
+            lines, self._buffer = self._buffer, []
+        if not lines:
+            return
+        self._file.write("".join(lines))
+        self._file.flush()
+        os.fsync(self._file.fileno())
+        self._segment_count += len(lines)
+        if self._segment_count >= self.segment_events:
+            closed = self._segment
+            self._open_next_segment()
+            self.compact(closed)
+
+    def compact(self, upto_segment: int):
+        """把不晚于 upto_segment 的日志段合并进快照，然后删除这些日志段"""
+        engine = self.engine_factory()
+        snapshot = self._read_snapshot()
+        if snapshot is not None:
+            engine.load_state(snapshot["state"])
+        segments = [segment for segment in self._segments() if segment <= upto_segment
+                    and (snapshot is None or segment > snapshot["segment"])]
+        for segment in segments:
+            self._replay_segment(engine, segment)
+        path = os.path.join(self.directory, SNAPSHOT_FILE)
+        tmp_path = path + ".tmp"
+        with open(tmp_path, "w") as f:
+            json.dump({"segment": upto_segment, "created_at": time.time(), "state": engine.export_state()}, f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, path)
+        _fsync_dir(self.directory)
+        self._remove_segments(upto_segment)
+
+    def _remove_segments(self, upto_segment: int):
+        """删除已合并进快照的日志段"""
+        removed = False
+        for segment in self._segments():
+            if segment <= upto_segment:
+                os.remove(self._segment_path(segment))
+                removed = True
+        if removed:
+            _fsync_dir(self.directory)
+
+    def start(self):
+        """启动后台刷盘线程"""
+        if self._thread is not None and self._thread.is_alive():
+            return self
+        self._stop_event.clear()
+        self._thread = threading.Thread(target=self._run, name="risk-journal", daemon=True)
+        self._thread.start()
+        return self
+
+    def _run(self):
+        while not self._stop_event.wait(self.flush_interval):
+            try:
+                self.flush()
+            except Exception as e:
+                print(f"Warning: Risk journal flush failed: {str(e)}")
+
+    def close(self):
+        """停止后台线程并刷盘剩余事件"""
+        self._stop_event.set()
+        if self._thread is not None:
+            self._thread.join(timeout=5)
+        self.flush()
+        if self._file is not None:
+            self._file.close()
+            self._file = None
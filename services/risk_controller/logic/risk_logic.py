@@ -1,36 +1,481 @@
 # ATM/services/risk_controller/logic/risk_logic.py
+import os
 import time
+import uuid
+import threading
+from collections import OrderedDict
+# 同时支持Docker环境和本地环境的导入
+try:
+    from services.risk_controller.logic.risk_journal import RiskJournal
+except ImportError:
+    from .risk_journal import RiskJournal
 
 # 模拟风控参数（后续可改为动态从 Config Service 获取）
+# windows 为滑动窗口限制列表：scope 为 wallet（按钱包）或 pair（按钱包+交易对），
+# seconds 为窗口长度，max_trades / max_volume 为窗口内允许的交易笔数 / 交易量（可省略）。
+# 未配置 windows 时由 daily_limit 和 cooldown 生成等价的窗口。
+# reservation_ttl 为预占额度的有效期（秒），超时未提交的预占自动释放。
 RISK_PARAMS = {
     "max_trade_amount": 1000,
     "daily_limit": 5000,
-    "cooldown": 60
+    "cooldown": 60,
+    "reservation_ttl": 300
 }
 
-LAST_TRADE_TIME = 0
-DAILY_VOLUME = 0
-DAILY_RESET = time.time()
+# 风控状态日志目录：Docker 中为挂载的 /app/data 卷，本地开发时为服务目录下的 data
+STATE_DIR = os.environ.get("RISK_STATE_DIR") or (
+    "/app/data" if os.path.isdir("/app") else
+    os.path.join(os.path.dirname(os.path.dirname(__file__)), "data"))
+JOURNAL_FLUSH_INTERVAL = 0.05
+JOURNAL_SEGMENT_EVENTS = 10000
+
+DEFAULT_WALLET = "default"
+# 每个滑动窗口划分的桶数，决定窗口的时间精度（窗口长度 / 桶数）
+WINDOW_BUCKETS = 60
+
+
+def window_specs(params: dict) -> list:
+    """返回风控参数对应的滑动窗口配置"""
+    if "windows" in params:
+        return params["windows"]
+    return [
+        {"scope": "wallet", "seconds": 86400, "max_volume": params["daily_limit"],
+         "reason": "Daily volume limit exceeded"},
+        {"scope": "pair", "seconds": params["cooldown"], "max_trades": 1,
+         "reason": "Cooldown period not elapsed"}
+    ]
+
+
+class SlidingWindow:
+    """
+    分桶环形缓冲区实现的滑动窗口计数器。
+
+    窗口划分为固定数量的桶，每个桶累计该时间段内的交易笔数和交易量，并维护窗口总和；
+    时间前进时只清空过期的桶，内存固定，每次检查和记录的开销与交易数无关。
+    """
+
+    __slots__ = ("seconds", "size", "width", "counts", "volumes", "head", "total_count", "total_volume")
+
+    def __init__(self, seconds, buckets=WINDOW_BUCKETS):
+        self.seconds = seconds
+        self.size = max(1, min(buckets, int(seconds))) if seconds > 0 else 1
+        self.width = seconds / self.size if seconds > 0 else 0
+        self.counts = [0] * self.size
+        self.volumes = [0.0] * self.size
+        self.head = None
+        self.total_count = 0
+        self.total_volume = 0.0
+
+    def _advance(self, now: float) -> int:
+        """把窗口推进到 now 所在的桶，清空滑出窗口的桶"""
+        index = int(now // self.width)
+        if self.head is None:
+            self.head = index
+        elif index > self.head:
+            for step in range(1, min(index - self.head, self.size) + 1):
+                slot = (self.head + step) % self.size
+                self.total_count -= self.counts[slot]
+                self.total_volume -= self.volumes[slot]
+                self.counts[slot] = 0
+                self.volumes[slot] = 0.0
+            self.head = index
+        # 时钟回拨时计入当前桶
+        return self.head
+
+    def totals(self, now: float) -> tuple:
+        """返回窗口内的 (交易笔数, 交易量)"""
+        if self.seconds <= 0:
+            return 0, 0.0
+        self._advance(now)
+        return self.total_count, max(self.total_volume, 0.0)
+
+    def add(self, now: float, count: int, volume: float):
+        """计入一笔交易，返回所在桶的编号（用于撤销）"""
+        if self.seconds <= 0:
+            return None
+        index = self._advance(now)
+        slot = index % self.size
+        self.counts[slot] += count
+        self.volumes[slot] += volume
+        self.total_count += count
+        self.total_volume += volume
+        return index
+
+    def remove(self, index, count: int, volume: float):
+        """撤销之前计入的交易，所在桶已滑出窗口时无需处理"""
+        if index is None or self.head - index >= self.size:
+            return
+        slot = index % self.size
+        self.counts[slot] = max(self.counts[slot] - count, 0)
+        self.volumes[slot] = max(self.volumes[slot] - volume, 0.0)
+        self.total_count = max(self.total_count - count, 0)
+        self.total_volume = max(self.total_volume - volume, 0.0)
+
+
+class _Limit:
+    """一个滑动窗口限制及其计数器"""
+
+    __slots__ = ("spec", "window")
+
+    def __init__(self, spec: dict):
+        self.spec = spec
+        self.window = SlidingWindow(spec["seconds"])
+
+    def violation(self, now: float, amount: float):
+        """加入本次交易后超出限制时返回拒绝原因，否则返回 None"""
+        count, volume = self.window.totals(now)
+        spec = self.spec
+        if "max_volume" in spec and volume + amount > spec["max_volume"]:
+            return spec.get("reason") or f"Volume limit exceeded ({spec['scope']}, {spec['seconds']}s window)"
+        if "max_trades" in spec and count + 1 > spec["max_trades"]:
+            return spec.get("reason") or f"Trade rate limit exceeded ({spec['scope']}, {spec['seconds']}s window)"
+        return None
+
+
+class _Reservation:
+    """一次通过风控检查后预占的额度"""
+
+    __slots__ = ("wallet", "pair", "amount", "expires_at", "stamps")
+
+    def __init__(self, wallet, pair, amount, expires_at, stamps):
+        self.wallet = wallet
+        self.pair = pair
+        self.amount = amount
+        self.expires_at = expires_at
+        self.stamps = stamps  # [(限制, 桶编号)]，释放时从对应窗口撤销
+
+
+class _WalletShard:
+    """单个钱包的滑动窗口状态"""
+
+    __slots__ = ("lock", "limits", "reserved")
+
+    def __init__(self, specs):
+        self.lock = threading.Lock()
+        self.limits = [_Limit(spec) for spec in specs]
+        self.reserved = 0  # 已预占、尚未提交的交易量
+
+
+class _PairShard:
+    """单个钱包在单个交易对上的滑动窗口状态"""
+
+    __slots__ = ("lock", "limits")
+
+    def __init__(self, specs):
+        self.lock = threading.Lock()
+        self.limits = [_Limit(spec) for spec in specs]
+
+
+class RiskEngine:
+    """
+    风控状态引擎。
+
+    状态按钱包和按钱包+交易对分片，每个分片持有各自作用域的滑动窗口限制并单独加锁，
+    互不相关的交易对不会互相等待。check_risk 在锁内完成检查并把本次交易计入窗口，
+    返回预占编号，并发信号无法同时通过限制；交易成交后 commit 确认预占，
+    交易未发出时 release 从窗口撤销，超过 reservation_ttl 未提交的预占自动释放。
+    锁顺序固定为先交易对、后钱包。
+
+    设置 journal 后，每次状态变更都在持有分片锁时追加一条事件，重启时由
+    apply_event 按顺序重放恢复状态；export_state / load_state 用于压缩快照。
+    """
+
+    def __init__(self, params=None, clock=time.time):
+        self.params = params if params is not None else RISK_PARAMS
+        self.clock = clock
+        specs = window_specs(self.params)
+        self._wallet_specs = [spec for spec in specs if spec["scope"] == "wallet"]
+        self._pair_specs = [spec for spec in specs if spec["scope"] == "pair"]
+        self._wallets = {}
+        self._pairs = {}
+        self._shards_lock = threading.Lock()
+        # 预占编号 -> 预占；有效期相同，插入顺序即过期顺序
+        self._reservations = OrderedDict()
+        self._reservations_lock = threading.Lock()
+        self.journal = None
+
+    def _log(self, event: dict):
+        if self.journal is not None:
+            self.journal.append(event)
+
+    @staticmethod
+    def _wallet_key(data: dict) -> str:
+        return (data.get("wallet_address") or DEFAULT_WALLET).lower()
+
+    @staticmethod
+    def _pair_key(data: dict) -> tuple:
+        # 买卖方向共用同一个交易对的限制
+        tokens = sorted(str(data.get(key) or "").upper() for key in ("token_in", "token_out"))
+        return tuple(tokens)
+
+    def wallet_shard(self, wallet: str) -> _WalletShard:
+        key = (wallet or DEFAULT_WALLET).lower()
+        shard = self._wallets.get(key)
+        if shard is None:
+            with self._shards_lock:
+                shard = self._wallets.get(key)
+                if shard is None:
+                    shard = self._wallets[key] = _WalletShard(self._wallet_specs)
+        return shard
+
+    def pair_shard(self, wallet: str, pair: tuple) -> _PairShard:
+        key = ((wallet or DEFAULT_WALLET).lower(), pair)
+        shard = self._pairs.get(key)
+        if shard is None:
+            with self._shards_lock:
+                shard = self._pairs.get(key)
+                if shard is None:
+                    shard = self._pairs[key] = _PairShard(self._pair_specs)
+        return shard
+
+    @staticmethod
+    def _first_violation(limits, now, amount):
+        for limit in limits:
+            reason = limit.violation(now, amount)
+            if reason:
+                return reason
+        return None
+
+    def check_risk(self, signal: dict) -> dict:
+        """原子地完成风控检查，通过时把本次交易计入钱包和交易对的滑动窗口并返回预占编号"""
+        amount = float(signal.get("amount", 0))
+        if amount > self.params["max_trade_amount"]:
+            return {"allowed": False, "reason": "Trade amount exceeds limit"}
+        self.expire_reservations()
+        wallet = self._wallet_key(signal)
+        pair_key = self._pair_key(signal)
+        pair = self.pair_shard(wallet, pair_key)
+        shard = self.wallet_shard(wallet)
+        reservation_id = uuid.uuid4().hex
+        with pair.lock:
+            now = self.clock()
+            with shard.lock:
+                reason = self._first_violation(shard.limits, now, amount) or \
+                         self._first_violation(pair.limits, now, amount)
+                if reason:
+                    return {"allowed": False, "reason": reason}
+                expires_at = now + self.params.get("reservation_ttl", 300)
+                self._reserve_locked(pair, shard, reservation_id, wallet, pair_key, amount, now, expires_at)
+                self._log({"op": "reserve", "id": reservation_id, "wallet": wallet, "pair": list(pair_key),
+                           "amount": amount, "ts": now, "expires_at": expires_at})
+        return {"allowed": True, "reservation_id": reservation_id, "expires_at": int(expires_at)}
+
+    def _reserve_locked(self, pair, shard, reservation_id, wallet, pair_key, amount, now, expires_at):
+        """在持有交易对和钱包锁时计入窗口并登记预占"""
+        stamps = [(limit, limit.window.add(now, 1, amount)) for limit in shard.limits]
+        stamps += [(limit, limit.window.add(now, 1, amount)) for limit in pair.limits]
+        shard.reserved += amount
+        with self._reservations_lock:
+            self._reservations[reservation_id] = _Reservation(wallet, pair_key, amount, expires_at, stamps)
+
+    def _take(self, reservation_id):
+        with self._reservations_lock:
+            return self._reservations.pop(reservation_id, None)
+
+    def commit(self, reservation_id, trade=None) -> dict:
+        """确认预占：额度保留在窗口中。预占已过期时按交易数据补记"""
+        reservation = self._take(reservation_id) if reservation_id else None
+        if reservation is None:
+            if trade is None:
+                return {"committed": False, "reason": "Unknown or expired reservation"}
+            return self._record_untracked(trade)
+        shard = self.wallet_shard(reservation.wallet)
+        with shard.lock:
+            shard.reserved = max(shard.reserved - reservation.amount, 0)
+            self._log({"op": "commit", "id": reservation_id})
+            volume = self._wallet_volume(shard, self.clock())
+        return {"committed": True, "recorded": True, "current_daily_volume": volume}
+
+    def release(self, reservation_id) -> dict:
+        """释放预占：从窗口中撤销本次交易"""
+        reservation = self._take(reservation_id)
+        if reservation is None:
+            return {"released": False, "reason": "Unknown or expired reservation"}
+        self._undo(reservation_id, reservation)
+        return {"released": True}
+
+    def _undo(self, reservation_id, reservation: _Reservation):
+        pair = self.pair_shard(reservation.wallet, reservation.pair)
+        shard = self.wallet_shard(reservation.wallet)
+        with pair.lock:
+            with shard.lock:
+                for limit, index in reservation.stamps:
+                    limit.window.remove(index, 1, reservation.amount)
+                shard.reserved = max(shard.reserved - reservation.amount, 0)
+                self._log({"op": "release", "id": reservation_id})
+
+    def expire_reservations(self, now=None) -> int:
+        """释放超过有效期仍未提交的预占，返回释放数量"""
+        now = self.clock() if now is None else now
+        expired = []
+        with self._reservations_lock:
+            while self._reservations:
+                reservation_id, reservation = next(iter(self._reservations.items()))
+                if reservation.expires_at > now:
+                    break
+                del self._reservations[reservation_id]
+                expired.append((reservation_id, reservation))
+        for reservation_id, reservation in expired:
+            self._undo(reservation_id, reservation)
+        return len(expired)
+
+    def record_trade(self, trade: dict) -> dict:
+        """记录成交；带预占编号时等同于 commit，否则直接计入钱包窗口"""
+        if trade.get("reservation_id"):
+            return self.commit(trade["reservation_id"], trade)
+        return self._record_untracked(trade)
+
+    def _record_untracked(self, trade: dict) -> dict:
+        """按交易数据计入钱包和交易对的窗口，与预占时计入的窗口相同"""
+        amount = float(trade.get("amount", 0))
+        wallet = self._wallet_key(trade)
+        pair_key = self._pair_key(trade)
+        pair = self.pair_shard(wallet, pair_key)
+        shard = self.wallet_shard(wallet)
+        with pair.lock:
+            with shard.lock:
+                now = self.clock()
+                for limit in shard.limits + pair.limits:
+                    limit.window.add(now, 1, amount)
+                self._log({"op": "record", "wallet": wallet, "pair": list(pair_key), "amount": amount, "ts": now})
+                return {"recorded": True, "current_daily_volume": self._wallet_volume(shard, now)}
+
+    def apply_event(self, event: dict):
+        """重放一条日志事件（不做风控检查，也不再写日志）"""
+        op = event["op"]
+        if op == "reserve":
+            pair_key = tuple(event["pair"])
+            pair = self.pair_shard(event["wallet"], pair_key)
+            shard = self.wallet_shard(event["wallet"])
+            with pair.lock, shard.lock:
+                self._reserve_locked(pair, shard, event["id"], event["wallet"], pair_key,
+                                     event["amount"], event["ts"], event["expires_at"])
+        elif op == "commit":
+            reservation = self._take(event["id"])
+            if reservation is not None:
+                shard = self.wallet_shard(reservation.wallet)
+                shard.reserved = max(shard.reserved - reservation.amount, 0)
+        elif op == "release":
+            reservation = self._take(event["id"])
+            if reservation is not None:
+                journal, self.journal = self.journal, None
+                try:
+                    self._undo(event["id"], reservation)
+                finally:
+                    self.journal = journal
+        elif op == "record":
+            limits = list(self.wallet_shard(event["wallet"]).limits)
+            # 旧版本日志中的 record 事件不带交易对
+            if "pair" in event:
+                limits += self.pair_shard(event["wallet"], tuple(event["pair"])).limits
+            for limit in limits:
+                limit.window.add(event["ts"], 1, event["amount"])
+
+    def export_state(self) -> dict:
+        """导出完整状态用于快照，调用方需保证期间没有并发修改"""
+        def windows(limits):
+            return [[l.window.head, l.window.counts, l.window.volumes, l.window.total_count, l.window.total_volume]
+                    for l in limits]
+        return {
+            "specs": self._wallet_specs + self._pair_specs,
+            "wallets": {wallet: {"reserved": shard.reserved, "windows": windows(shard.limits)}
+                        for wallet, shard in self._wallets.items()},
+            "pairs": [[wallet, list(pair), windows(shard.limits)] for (wallet, pair), shard in self._pairs.items()],
+            "reservations": [[reservation_id, r.wallet, list(r.pair), r.amount, r.expires_at,
+                              [index for _, index in r.stamps]]
+                             for reservation_id, r in self._reservations.items()]
+        }
+
+    def load_state(self, state: dict):
+        """从快照恢复状态；窗口配置已变化时丢弃快照中的窗口计数"""
+        same_specs = state.get("specs") == self._wallet_specs + self._pair_specs
+        if not same_specs:
+            print("Warning: Risk window configuration changed, window counters in snapshot discarded")
+
+        def restore(limits, data):
+            if not same_specs:
+                return
+            for limit, (head, counts, volumes, total_count, total_volume) in zip(limits, data):
+                limit.window.head = head
+                limit.window.counts = counts
+                limit.window.volumes = volumes
+                limit.window.total_count = total_count
+                limit.window.total_volume = total_volume
+
+        for wallet, data in state.get("wallets", {}).items():
+            shard = self.wallet_shard(wallet)
+            shard.reserved = data["reserved"]
+            restore(shard.limits, data["windows"])
+        for wallet, pair_key, data in state.get("pairs", []):
+            restore(self.pair_shard(wallet, tuple(pair_key)).limits, data)
+        for reservation_id, wallet, pair_key, amount, expires_at, indexes in state.get("reservations", []):
+            pair_key = tuple(pair_key)
+            limits = self.wallet_shard(wallet).limits + self.pair_shard(wallet, pair_key).limits
+            stamps = list(zip(limits, indexes)) if same_specs else []
+            self._reservations[reservation_id] = _Reservation(wallet, pair_key, amount, expires_at, stamps)
+
+    @staticmethod
+    def _wallet_volume(shard: _WalletShard, now: float) -> float:
+        """钱包最长窗口内的交易量（默认即24小时交易量）"""
+        volume_limits = [limit for limit in shard.limits if "max_volume" in limit.spec]
+        if not volume_limits:
+            return 0.0
+        longest = max(volume_limits, key=lambda limit: limit.spec["seconds"])
+        return longest.window.totals(now)[1]
+
+    def wallet_volume(self, wallet=None) -> float:
+        shard = self.wallet_shard(wallet)
+        with shard.lock:
+            return self._wallet_volume(shard, self.clock())
+
+    def status(self) -> dict:
+        with self._shards_lock:
+            shards = {"wallets": len(self._wallets), "pairs": len(self._pairs)}
+        with self._reservations_lock:
+            return {**shards, "reservations": len(self._reservations)}
+
+
+ENGINE = RiskEngine()
+JOURNAL = None
+
+def start_journal(directory=None):
+    """从快照和日志恢复风控状态，之后的状态变更写入日志"""
+    global JOURNAL
+    journal = RiskJournal(directory or STATE_DIR, lambda: RiskEngine(ENGINE.params),
+                          flush_interval=JOURNAL_FLUSH_INTERVAL, segment_events=JOURNAL_SEGMENT_EVENTS)
+    stats = journal.load(ENGINE)
+    ENGINE.journal = journal
+    ENGINE.expire_reservations()
+    JOURNAL = journal.start()
+    print(f"Risk state restored: {stats}")
+    return stats
+
+def stop_journal():
+    global JOURNAL
+    if JOURNAL is not None:
+        ENGINE.journal = None
+        JOURNAL.close()
+        JOURNAL = None
 
 def check_risk(signal: dict):
-    global LAST_TRADE_TIME, DAILY_VOLUME, DAILY_RESET
-    now = time.time()
-    amount = float(signal.get("amount", 0))
-    # 重置每日累计数（超过24小时则重置）
-    if now - DAILY_RESET > 86400:
-        DAILY_VOLUME = 0
-        DAILY_RESET = now
-    if amount > RISK_PARAMS["max_trade_amount"]:
-        return {"allowed": False, "reason": "Trade amount exceeds limit"}
-    if DAILY_VOLUME + amount > RISK_PARAMS["daily_limit"]:
-        return {"allowed": False, "reason": "Daily volume limit exceeded"}
-    if now - LAST_TRADE_TIME < RISK_PARAMS["cooldown"]:
-        return {"allowed": False, "reason": "Cooldown period not elapsed"}
-    LAST_TRADE_TIME = now
-    return {"allowed": True}
+    return ENGINE.check_risk(signal)
 
 def record_trade(trade: dict):
-    global DAILY_VOLUME
-    amount = float(trade.get("amount", 0))
-    DAILY_VOLUME += amount
-    return {"recorded": True, "current_daily_volume": DAILY_VOLUME}
+    return ENGINE.record_trade(trade)
+
+def check_risk_batch(signals: list):
+    # 每条信号依次原子地检查并预占，批内靠前的信号先占用额度；
+    # 单条信号格式错误时只拒绝该条，不能让整个请求失败而丢下已预占的额度
+    results = []
+    for signal in signals:
+        try:
+            results.append(ENGINE.check_risk(signal))
+        except (AttributeError, TypeError, ValueError) as e:
+            results.append({"allowed": False, "reason": f"Invalid signal: {str(e)}"})
+    return {"results": results}
+
+def commit_reservation(request: dict):
+    return ENGINE.commit(request.get("reservation_id"), request if "amount" in request else None)
+
+def release_reservation(request: dict):
+    return ENGINE.release(request.get("reservation_id"))
@@ -13,11 +13,25 @@ router = APIRouter()
 def check_risk(signal: dict):
     return risk_logic.check_risk(signal)
 
+@router.post("/risk/check/batch")
+def check_risk_batch(request: dict):
+    return risk_logic.check_risk_batch(request.get("signals", []))
+
 @router.post("/risk/record")
 def record_trade(trade: dict):
     return risk_logic.record_trade(trade)
 
+@router.post("/risk/commit")
+def commit_reservation(request: dict):
+    # 交易已发出，确认 /risk/check 返回的预占额度
+    return risk_logic.commit_reservation(request)
+
+@router.post("/risk/release")
+def release_reservation(request: dict):
+    # 交易未发出，释放预占额度
+    return risk_logic.release_reservation(request)
+
 @router.get("/risk/status")
 def get_risk_status():
     # 返回服务状态信息
-    return {"status": "running", "service": "risk_controller"}
+    return {"status": "running", "service": "risk_controller", **risk_logic.ENGINE.status()}
@@ -0,0 +1,179 @@
+# ATM/services/signal_listener/logic/admission.py
+import asyncio
+import math
+import time
+from collections import deque, defaultdict
+from decimal import Decimal, InvalidOperation
+
+# 优先级从高到低：平仓类信号（exit）总是先于开仓类信号（entry）处理
+PRIORITY_ORDER = ("exit", "entry")
+EXIT_ACTIONS = ("exit", "close", "stop_loss", "take_profit")
+
+# 合并排队中的信号时，除 amount 外必须完全一致的字段
+COALESCE_FIELDS = ("wallet_address", "token_in", "token_out", "network", "slippage")
+
+
+class AdmissionRejected(Exception):
+    """队列已满，调用方应在 retry_after 秒后重试"""
+
+    def __init__(self, priority: str, retry_after: int):
+        super().__init__(f"Signal queue for '{priority}' signals is full, retry after {retry_after}s")
+        self.priority = priority
+        self.retry_after = retry_after
+
+
+def classify(signal: dict) -> str:
+    """根据 priority 或 action 字段确定信号的优先级类别"""
+    priority = signal.get("priority")
+    if priority in PRIORITY_ORDER:
+        return priority
+    if str(signal.get("action", "")).lower() in EXIT_ACTIONS:
+        return "exit"
+    return "entry"
+
+
+class _Item:
+    __slots__ = ("signal", "job", "priority", "wallet", "key", "futures", "records", "enqueued_at")
+
+    def __init__(self, signal, job, priority, wallet, key, future, record):
+        self.signal = signal
+        self.job = job
+        self.priority = priority
+        self.wallet = wallet
+        self.key = key
+        self.futures = [future]
+        self.records = [record] if record is not None else []
+        self.enqueued_at = time.time()
+
+
+class AdmissionQueue:
+    """
+    信号准入队列。
+
+    按优先级类别分别排队并设容量上限，超出时抛出 AdmissionRejected（对应 HTTP 429）；
+    调度时总是先取高优先级类别，同一钱包同时处理的信号数不超过 per_wallet，
+    总并发不超过 max_in_flight，其中 exit_reserve 个名额只留给平仓信号，开仓信号占满并发时
+    平仓信号仍能立即开始处理。同一钱包、同一交易对和方向且仍在排队的信号合并为一笔，
+    数量相加，所有提交者得到同一个结果；合并后的数量超过 max_amount（风控的单笔上限）时不合并，
+    避免各自能通过风控的信号因合并而一起被拒绝。
+    """
+
+    def __init__(self, capacity=None, max_in_flight=32, per_wallet=4, exit_reserve=None, max_amount=None):
+        self.capacity = capacity or {"exit": 200, "entry": 500}
+        self.max_in_flight = max_in_flight
+        # 默认预留约 1/8 的并发给平仓信号，至少 1 个，且开仓信号至少有 1 个名额
+        if exit_reserve is None:
+            exit_reserve = max(1, max_in_flight // 8)
+        self.exit_reserve = min(exit_reserve, max_in_flight - 1)
+        self.per_wallet = per_wallet
+        self.max_amount = Decimal(str(max_amount)) if max_amount is not None else None
+        self._queues = {priority: deque() for priority in PRIORITY_ORDER}
+        self._pending = {}  # 合并键 -> 排队中的 _Item
+        self._in_flight = 0
+        self._wallet_in_flight = defaultdict(int)
+        self._service_time = 1.0  # 单个信号处理耗时的指数移动平均（秒）
+        self._stats = {"admitted": 0, "coalesced": 0, "rejected": 0, "completed": 0}
+
+    @staticmethod
+    def _coalesce_key(signal: dict, priority: str) -> tuple:
+        return (priority,) + tuple(str(signal.get(field) or "").lower() for field in COALESCE_FIELDS)
+
+    def retry_after(self, priority: str) -> int:
+        """按当前排队数和平均处理耗时估算重试等待秒数"""
+        ahead = sum(len(self._queues[p]) for p in PRIORITY_ORDER[:PRIORITY_ORDER.index(priority) + 1])
+        return max(1, math.ceil(ahead * self._service_time / self.max_in_flight))
+
+    async def submit(self, signal: dict, job, coalesce=True, record=None) -> dict:
+        """
+        提交信号并等待处理结果。job 为协程函数，参数为（可能已合并的）信号和所有提交者的
+        record 列表（提交时传入的历史记录，合并后一起更新各阶段耗时）。
+        """
+        priority = classify(signal)
+        wallet = str(signal.get("wallet_address") or "").lower()
+        future = asyncio.get_running_loop().create_future()
+        key = self._coalesce_key(signal, priority) if coalesce else None
+        item = self._pending.get(key) if key else None
+        if item is not None and self._merge(item.signal, signal):
+            item.futures.append(future)
+            if record is not None:
+                item.records.append(record)
+            self._stats["coalesced"] += 1
+            return await future
+        queue = self._queues[priority]
+        if len(queue) >= self.capacity[priority]:
+            self._stats["rejected"] += 1
+            raise AdmissionRejected(priority, self.retry_after(priority))
+        item = _Item(dict(signal), job, priority, wallet, key, future, record)
+        queue.append(item)
+        if key:
+            self._pending[key] = item
+        self._stats["admitted"] += 1
+        self._pump()
+        return await future
+
+    def _merge(self, queued: dict, signal: dict) -> bool:
+        """把 signal 的数量加到排队中的信号上，数量无法解析或合计超过单笔上限时不合并"""
+        try:
+            total = Decimal(str(queued.get("amount", 0))) + Decimal(str(signal.get("amount", 0)))
+        except InvalidOperation:
+            return False
+        if self.max_amount is not None and total > self.max_amount:
+            return False
+        queued["amount"] = str(total)
+        return True
+
+    def _next_item(self):
+        for priority in PRIORITY_ORDER:
+            if priority != "exit" and self._in_flight >= self.max_in_flight - self.exit_reserve:
+                continue
+            queue = self._queues[priority]
+            for index, item in enumerate(queue):
+                if self._wallet_in_flight[item.wallet] < self.per_wallet:
+                    del queue[index]
+                    return item
+        return None
+
+    def _pump(self):
+        """在并发上限内启动可执行的信号"""
+        while self._in_flight < self.max_in_flight:
+            item = self._next_item()
+            if item is None:
+                return
+            if item.key and self._pending.get(item.key) is item:
+                del self._pending[item.key]
+            self._in_flight += 1
+            self._wallet_in_flight[item.wallet] += 1
+            asyncio.ensure_future(self._run(item))
+
+    async def _run(self, item: _Item):
+        started = time.time()
+        # 任务被取消时也要唤醒提交者，否则它们会一直等待
+        result = {"error": "Signal processing cancelled"}
+        try:
+            result = await item.job(item.signal, item.records)
+        except Exception as e:
+            result = {"error": f"Signal processing failed: {str(e)}"}
+        finally:
+            self._in_flight -= 1
+            self._wallet_in_flight[item.wallet] -= 1
+            if not self._wallet_in_flight[item.wallet]:
+                del self._wallet_in_flight[item.wallet]
+            self._service_time = 0.8 * self._service_time + 0.2 * (time.time() - started)
+            self._stats["completed"] += 1
+            if len(item.futures) > 1:
+                result = {**result, "coalesced": len(item.futures), "amount": item.signal.get("amount")}
+            for future in item.futures:
+                if not future.done():
+                    future.set_result(result)
+            self._pump()
+
+    def stats(self) -> dict:
+        return {
+            "queued": {priority: len(queue) for priority, queue in self._queues.items()},
+            "capacity": dict(self.capacity),
+            "in_flight": self._in_flight,
+            "max_in_flight": self.max_in_flight,
+            "exit_reserve": self.exit_reserve,
+            "per_wallet": self.per_wallet,
+            **self._stats
+        }
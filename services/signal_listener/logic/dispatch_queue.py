@@ -0,0 +1,152 @@
+# ATM/services/signal_listener/logic/dispatch_queue.py
+import time
+import asyncio
+
+
+class DispatchQueue:
+    """
+    交易提交后的后台调用队列。
+
+    执行监控登记、风控记录等调用不影响返回给调用方的 tx_hash，
+    因此放入有界队列由后台 worker 异步执行，失败时按指数退避重试。
+    带截止时间的任务（如提交风控预占）不受 max_retries 限制，一直重试到截止时间。
+    提交时可指定 check 校验任务返回值，check 抛出异常时与任务失败一样重试。
+    停止时等待退避中的重试不再延迟，直接重新入队执行，避免关闭服务时丢失。
+    """
+
+    def __init__(self, maxsize=1000, workers=4, max_retries=5, base_delay=0.5, max_delay=10.0):
+        self.maxsize = maxsize
+        self.workers = workers
+        self.max_retries = max_retries
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self._queue = asyncio.Queue(maxsize=maxsize)
+        self._tasks = []
+        self._timers = {}  # 退避中的重试：TimerHandle -> 任务
+        self._in_flight = 0
+        self._stats = {"submitted": 0, "completed": 0, "retried": 0, "failed": 0, "inline": 0}
+
+    async def start(self):
+        """启动后台 worker，需在事件循环内调用"""
+        if self._tasks:
+            return
+        self._tasks = [asyncio.create_task(self._worker()) for _ in range(self.workers)]
+
+    async def stop(self, timeout=5.0):
+        """停止 worker，尽量在超时前把队列中的任务和退避中的重试执行完"""
+        loop = asyncio.get_running_loop()
+        stop_at = loop.time() + timeout
+        while True:
+            self._flush_retries()
+            remaining = stop_at - loop.time()
+            try:
+                await asyncio.wait_for(self._queue.join(), timeout=max(remaining, 0))
+            except asyncio.TimeoutError:
+                break
+            if not self._timers:
+                break
+            # 执行时再次失败的任务已重新进入退避，稍等后再取出，避免对下游连续重试
+            await asyncio.sleep(max(min(self.base_delay, stop_at - loop.time()), 0))
+        pending = self._queue.qsize() + len(self._timers)
+        if pending:
+            print(f"Warning: Dispatch queue stopped with {pending} pending jobs")
+        for handle in self._timers:
+            handle.cancel()
+        self._stats["failed"] += len(self._timers)
+        self._timers = {}
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+
+    async def submit(self, name: str, job, deadline=None, check=None):
+        """
+        提交一个后台任务。job 为无参协程函数，每次重试都会重新调用。
+        deadline 为时间戳（time.time()）时失败后一直重试到该时间，否则最多尝试 max_retries 次。
+        check 为可选的返回值校验函数，下游返回 200 但未完成操作时由它抛出异常。
+        队列已满时直接在当前协程内执行一次，以此向调用方施加背压。
+        """
+        self._stats["submitted"] += 1
+        if check is not None:
+            job = self._checked(job, check)
+        try:
+            self._queue.put_nowait((name, job, 0, deadline))
+        except asyncio.QueueFull:
+            self._stats["inline"] += 1
+            await self._run(name, job, 0, deadline)
+
+    @staticmethod
+    def _checked(job, check):
+        async def checked_job():
+            result = await job()
+            check(result)
+            return result
+        return checked_job
+
+    def depth(self) -> int:
+        """当前排队中的任务数"""
+        return self._queue.qsize()
+
+    def stats(self) -> dict:
+        """返回队列深度及累计统计信息"""
+        return {
+            "depth": self._queue.qsize(),
+            "capacity": self.maxsize,
+            "in_flight": self._in_flight,
+            "retrying": len(self._timers),
+            "workers": len(self._tasks),
+            **self._stats
+        }
+
+    async def _worker(self):
+        while True:
+            name, job, attempt, deadline = await self._queue.get()
+            try:
+                await self._run(name, job, attempt, deadline)
+            finally:
+                self._queue.task_done()
+
+    async def _run(self, name, job, attempt, deadline=None):
+        self._in_flight += 1
+        try:
+            await job()
+            self._stats["completed"] += 1
+        except Exception as e:
+            exhausted = time.time() >= deadline if deadline is not None else attempt + 1 >= self.max_retries
+            if exhausted:
+                self._stats["failed"] += 1
+                print(f"Warning: Background job {name} failed after {attempt + 1} attempts: {str(e)}")
+                return
+            self._stats["retried"] += 1
+            self._schedule_retry(name, job, attempt + 1, deadline)
+        finally:
+            self._in_flight -= 1
+
+    def _schedule_retry(self, name, job, attempt, deadline=None):
+        """按指数退避延迟后重新入队，等待期间不占用 worker"""
+        delay = min(self.base_delay * (2 ** (attempt - 1)), self.max_delay)
+
+        def requeue():
+            self._timers.pop(handle, None)
+            try:
+                self._queue.put_nowait((name, job, attempt, deadline))
+            except asyncio.QueueFull:
+                if deadline is not None and time.time() < deadline:
+                    # 带截止时间的任务不丢弃，稍后再入队
+                    self._schedule_retry(name, job, attempt, deadline)
+                    return
+                self._stats["failed"] += 1
+                print(f"Warning: Dropped retry of background job {name}, dispatch queue is full")
+
+        handle = asyncio.get_running_loop().call_later(delay, requeue)
+        self._timers[handle] = (name, job, attempt, deadline)
+
+    def _flush_retries(self):
+        """取消退避计时，把等待中的重试立即放回队列；队列已满的继续留在退避中"""
+        for handle, item in list(self._timers.items()):
+            try:
+                self._queue.put_nowait(item)
+            except asyncio.QueueFull:
+                break
+            handle.cancel()
+            del self._timers[handle]
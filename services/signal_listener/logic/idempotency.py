@@ -0,0 +1,133 @@
+# ATM/services/signal_listener/logic/idempotency.py
+import asyncio
+import hashlib
+import json
+import time
+from collections import OrderedDict
+
+# 计算内容哈希时忽略的字段：幂等键本身和仅用于关联响应的客户端编号
+HASH_EXCLUDED_FIELDS = ("signal_id", "client_id")
+
+
+class _Entry:
+    __slots__ = ("future", "result", "expires_at")
+
+    def __init__(self, future):
+        self.future = future
+        self.result = None
+        self.expires_at = None  # 处理完成前为 None
+
+
+class IdempotencyCache:
+    """
+    信号幂等缓存（带 TTL 的内存 LRU）。
+
+    以客户端提供的 signal_id（或规范化信号的内容哈希）为键：首个请求登记一个 future 并执行
+    处理流程，相同键的重复请求在处理中时等待该 future，处理完成后直接返回缓存结果。
+    未执行任何交易的结果（如风控服务不可达）不缓存，重试时会重新处理。
+    """
+
+    def __init__(self, maxsize=10000, ttl=600, hash_ttl=30):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.hash_ttl = hash_ttl
+        self._entries = OrderedDict()
+        self._stats = {"hits": 0, "in_flight_hits": 0, "misses": 0}
+
+    def key_for(self, signal: dict) -> tuple:
+        """返回 (键, TTL)：有 signal_id 时使用它，否则使用规范化信号的哈希"""
+        signal_id = signal.get("signal_id")
+        if signal_id:
+            return f"id:{signal_id}", self.ttl
+        content = {k: v for k, v in signal.items() if k not in HASH_EXCLUDED_FIELDS}
+        digest = hashlib.sha256(json.dumps(content, sort_keys=True, default=str).encode()).hexdigest()
+        # 内容相同的信号也可能是策略有意的重复下单，只在较短时间内视为重试
+        return f"sha256:{digest}", self.hash_ttl
+
+    def _evict(self, now: float):
+        """按 LRU 顺序淘汰过期或超出容量的已完成条目；处理中的条目不淘汰，否则重复请求会再次执行"""
+        excess = len(self._entries) - self.maxsize
+        victims = []
+        for key, entry in self._entries.items():
+            if entry.expires_at is None:
+                continue
+            if excess <= 0 and entry.expires_at > now:
+                break
+            victims.append(key)
+            excess -= 1
+        for key in victims:
+            del self._entries[key]
+
+    def lookup(self, key: str):
+        """
+        查找已登记的键：已完成时返回缓存结果，处理中时返回 future，未登记或已过期时返回 None
+        """
+        entry = self._entries.get(key)
+        if entry is None or (entry.expires_at is not None and entry.expires_at <= time.time()):
+            self._stats["misses"] += 1
+            return None
+        self._entries.move_to_end(key)
+        if entry.expires_at is None:
+            self._stats["in_flight_hits"] += 1
+            return entry.future
+        self._stats["hits"] += 1
+        return entry.result
+
+    def begin(self, key: str) -> _Entry:
+        """登记一个处理中的键"""
+        entry = self._entries[key] = _Entry(asyncio.get_running_loop().create_future())
+        self._entries.move_to_end(key)
+        self._evict(time.time())
+        return entry
+
+    def finish(self, key: str, result: dict, ttl: float, cache=True):
+        """处理完成：唤醒等待中的重复请求，并按需缓存结果"""
+        entry = self._entries.get(key)
+        if entry is None:
+            return
+        if not entry.future.done():
+            entry.future.set_result(result)
+        if cache:
+            entry.result = result
+            entry.expires_at = time.time() + ttl
+        else:
+            del self._entries[key]
+
+    async def run(self, key: str, ttl: float, factory, cacheable=lambda result: True) -> tuple:
+        """
+        按幂等键执行 factory()，返回 (结果, 是否为重复请求)
+        """
+        existing = self.lookup(key)
+        if existing is not None:
+            if isinstance(existing, asyncio.Future):
+                return await asyncio.shield(existing), True
+            return existing, True
+        entry = self.begin(key)
+        result = None
+        try:
+            result = await factory()
+        except Exception as e:
+            # 处理抛出异常（如准入队列已满）：等待者收到同一个异常，并允许重试
+            if self._entries.get(key) is entry:
+                del self._entries[key]
+            if not entry.future.done():
+                entry.future.set_exception(e)
+                # 没有等待者时不报告未取回的异常
+                entry.future.exception()
+            raise
+        finally:
+            if result is None:
+                # 处理被取消：唤醒等待者，并允许重试
+                if self._entries.get(key) is entry:
+                    del self._entries[key]
+                result_for_waiters = {"error": "Signal processing aborted"}
+            else:
+                self.finish(key, result, ttl, cache=cacheable(result))
+                result_for_waiters = result
+            # 条目被替换或清除时也要唤醒等待者
+            if not entry.future.done():
+                entry.future.set_result(result_for_waiters)
+        return result, False
+
+    def stats(self) -> dict:
+        return {"size": len(self._entries), **self._stats}
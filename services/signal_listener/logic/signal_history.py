@@ -0,0 +1,164 @@
+# ATM/services/signal_listener/logic/signal_history.py
+import bisect
+import time
+import threading
+
+# 不保存到历史记录中的凭据字段，信号历史可通过 GET /signal/history 查询
+CREDENTIAL_FIELDS = ("private_key", "mnemonic", "seed_phrase")
+
+
+class SignalRecord:
+    """一条信号及其处理结果和各阶段耗时（毫秒）"""
+
+    __slots__ = ("seq", "received_at", "signal", "pair", "status", "result",
+                 "queue_ms", "risk_ms", "dex_ms", "total_ms")
+
+    def __init__(self, seq, signal, pair):
+        self.seq = seq
+        self.received_at = time.time()
+        self.signal = signal
+        self.pair = pair
+        self.status = "pending"
+        self.result = None
+        self.queue_ms = None
+        self.risk_ms = None
+        self.dex_ms = None
+        self.total_ms = None
+
+    def to_dict(self) -> dict:
+        return {
+            "seq": self.seq,
+            "received_at": self.received_at,
+            "pair": self.pair,
+            "status": self.status,
+            "signal": self.signal,
+            "result": self.result,
+            "timings_ms": {"queue": self.queue_ms, "risk": self.risk_ms,
+                           "dex": self.dex_ms, "total": self.total_ms}
+        }
+
+
+def redact(signal: dict) -> dict:
+    """去掉凭据字段后的信号副本"""
+    return {key: value for key, value in signal.items() if key not in CREDENTIAL_FIELDS}
+
+
+def signal_pair(signal: dict) -> str:
+    return f"{str(signal.get('token_in') or '').upper()}/{str(signal.get('token_out') or '').upper()}"
+
+
+def result_status(result: dict) -> str:
+    if "status" in result:
+        return result["status"]
+    return "error" if "error" in result else "unknown"
+
+
+class SignalHistory:
+    """
+    最近信号的定长环形缓冲区。
+
+    记录按递增的 seq 存放在固定大小的列表中，写满后覆盖最旧的记录，内存占用固定；
+    按交易对和状态维护 seq 索引（有序字典充当有序集合），覆盖或状态变化时 O(1) 更新。
+    时间范围查询利用 received_at 随 seq 单调递增，用二分查找转换为 seq 范围。
+    """
+
+    def __init__(self, capacity=5000):
+        self.capacity = capacity
+        self._ring = [None] * capacity
+        self._next_seq = 0
+        self._by_pair = {}
+        self._by_status = {}
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _index_add(index: dict, key, seq):
+        index.setdefault(key, {})[seq] = None
+
+    @staticmethod
+    def _index_remove(index: dict, key, seq):
+        seqs = index.get(key)
+        if seqs is not None:
+            seqs.pop(seq, None)
+            if not seqs:
+                del index[key]
+
+    def begin(self, signal: dict) -> SignalRecord:
+        """登记收到的信号，返回用于记录耗时和结果的记录"""
+        with self._lock:
+            seq = self._next_seq
+            self._next_seq += 1
+            slot = seq % self.capacity
+            evicted = self._ring[slot]
+            if evicted is not None:
+                self._index_remove(self._by_pair, evicted.pair, evicted.seq)
+                self._index_remove(self._by_status, evicted.status, evicted.seq)
+            record = SignalRecord(seq, redact(signal), signal_pair(signal))
+            self._ring[slot] = record
+            self._index_add(self._by_pair, record.pair, seq)
+            self._index_add(self._by_status, record.status, seq)
+            return record
+
+    def finish(self, record: SignalRecord, result: dict):
+        """记录处理结果并更新状态索引"""
+        status = result_status(result)
+        with self._lock:
+            record.result = result
+            record.total_ms = round((time.time() - record.received_at) * 1000, 2)
+            if self._ring[record.seq % self.capacity] is not record:
+                record.status = status
+                return
+            self._index_remove(self._by_status, record.status, record.seq)
+            record.status = status
+            self._index_add(self._by_status, status, record.seq)
+
+    def latest(self):
+        with self._lock:
+            if not self._next_seq:
+                return None
+            return self._ring[(self._next_seq - 1) % self.capacity]
+
+    def _oldest_seq(self) -> int:
+        return max(0, self._next_seq - self.capacity)
+
+    def _seq_bound(self, timestamp: float) -> int:
+        """返回第一条 received_at >= timestamp 的记录的 seq"""
+        oldest = self._oldest_seq()
+        seqs = range(oldest, self._next_seq)
+        offset = bisect.bisect_left(seqs, timestamp, key=lambda seq: self._ring[seq % self.capacity].received_at)
+        return oldest + offset
+
+    def query(self, pair=None, status=None, since=None, until=None, limit=100) -> list:
+        """按交易对、状态和时间范围查询，返回最新的 limit 条记录"""
+        with self._lock:
+            low = self._seq_bound(since) if since is not None else self._oldest_seq()
+            high = self._seq_bound(until) if until is not None else self._next_seq
+            candidates = []
+            if pair is not None:
+                candidates.append(self._by_pair.get(pair.upper(), {}))
+            if status is not None:
+                candidates.append(self._by_status.get(status, {}))
+            if candidates:
+                smallest = min(candidates, key=len)
+                seqs = sorted((seq for seq in smallest if low <= seq < high), reverse=True)
+            else:
+                seqs = range(high - 1, low - 1, -1)
+            records = []
+            for seq in seqs:
+                record = self._ring[seq % self.capacity]
+                if pair is not None and record.pair != pair.upper():
+                    continue
+                if status is not None and record.status != status:
+                    continue
+                records.append(record.to_dict())
+                if len(records) >= limit:
+                    break
+            return records
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                "capacity": self.capacity,
+                "size": min(self._next_seq, self.capacity),
+                "total": self._next_seq,
+                "statuses": {status: len(seqs) for status, seqs in self._by_status.items()}
+            }
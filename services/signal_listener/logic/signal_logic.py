@@ -1,80 +1,439 @@
 # ATM/services/signal_listener/logic/signal_logic.py
-import requests
+import asyncio
+import httpx
 import json
-import os
+import time
+# 同时支持Docker环境和本地环境的导入
+try:
+    from services.signal_listener.logic.dispatch_queue import DispatchQueue
+    from services.signal_listener.logic.idempotency import IdempotencyCache
+    from services.signal_listener.logic.admission import AdmissionQueue, AdmissionRejected
+    from services.signal_listener.logic.signal_history import SignalHistory
+    from services.common.config_client import CONFIG
+except ImportError:
+    from .dispatch_queue import DispatchQueue
+    from .idempotency import IdempotencyCache
+    from .admission import AdmissionQueue, AdmissionRejected
+    from .signal_history import SignalHistory
+    from ...common.config_client import CONFIG
 
-LAST_SIGNAL = None
+# 最近信号及其处理结果、各阶段耗时的定长环形缓冲区
+HISTORY = SignalHistory(capacity=5000)
 
-def handle_signal(signal: dict):
-    global LAST_SIGNAL
-    LAST_SIGNAL = signal
-    
+# 下游服务地址
+SERVICE_URLS = {
+    "risk_controller": "http://risk_controller:52120",
+    "dex_executor": "http://dex_executor:52130",
+    "execution_monitor": "http://execution_monitor:52140"
+}
+
+# 各跳的超时时间（秒），与原同步实现保持一致
+HOP_TIMEOUTS = {
+    "risk_controller": 5,
+    "dex_executor": 10,
+    "execution_monitor": 5
+}
+
+# 单次批量请求允许的最大信号数
+MAX_BATCH_SIZE = 200
+
+# WebSocket 信号流推送交易状态的轮询间隔和最长跟踪时间（秒）
+STREAM_STATUS_INTERVAL = 2
+STREAM_STATUS_TIMEOUT = 600
+FINAL_TX_STATUSES = ("confirmed", "failed", "timeout")
+
+# 连接池参数：长连接复用，避免每次请求重新握手
+HTTP_LIMITS = httpx.Limits(max_connections=100, max_keepalive_connections=20, keepalive_expiry=30)
+
+# 每个下游服务一个长期存活的 AsyncClient
+_clients = {}
+
+def get_client(service_name: str) -> httpx.AsyncClient:
+    """获取（必要时创建）指定下游服务的连接池客户端"""
+    client = _clients.get(service_name)
+    if client is None or client.is_closed:
+        client = httpx.AsyncClient(
+            base_url=SERVICE_URLS[service_name],
+            timeout=HOP_TIMEOUTS[service_name],
+            limits=HTTP_LIMITS
+        )
+        _clients[service_name] = client
+    return client
+
+# 交易提交后的监控登记与风控记录走后台队列，不阻塞信号响应
+DISPATCHER = DispatchQueue(maxsize=1000, workers=4, max_retries=5)
+# 风控未返回预占有效期时使用的默认值（秒），与风控的 reservation_ttl 默认值一致
+RESERVATION_TTL = 300
+
+# 信号幂等缓存：带 signal_id 的信号10分钟内、内容相同的信号30秒内视为重试
+IDEMPOTENCY = IdempotencyCache(maxsize=10000, ttl=600, hash_ttl=30)
+
+# 风控的单笔交易上限（与 Risk Controller 的 max_trade_amount 一致），合并排队信号时不超过该值
+MAX_TRADE_AMOUNT = 1000
+
+# 信号准入队列：平仓信号优先，按钱包限制并发，队列满时返回 429
+ADMISSION = AdmissionQueue(capacity={"exit": 200, "entry": 500}, max_in_flight=32, per_wallet=4, exit_reserve=4,
+                           max_amount=MAX_TRADE_AMOUNT)
+
+def may_have_traded(result: dict) -> bool:
+    """交易已发出（或可能已发出）的结果需要缓存，重试时不能再次下单"""
+    return result.get("status") in ("success", "unknown")
+
+async def post_json(service_name: str, path: str, payload: dict) -> dict:
+    """向下游服务发送 POST 请求，HTTP 错误状态抛出异常以便重试"""
+    response = await get_client(service_name).post(path, json=payload)
+    response.raise_for_status()
+    return response.json()
+
+async def close_clients():
+    """关闭所有下游连接池，在服务停止时调用"""
+    for client in list(_clients.values()):
+        await client.aclose()
+    _clients.clear()
+
+def commit_deadline(risk_result: dict) -> float:
+    """提交预占的重试截止时间：预占过期前一直重试，否则风控会按过期释放已成交的额度"""
+    return risk_result.get("expires_at") or time.time() + RESERVATION_TTL
+
+async def release_reservation(reservation_id):
+    """交易未发出时释放风控预占的额度"""
+    if reservation_id:
+        await DISPATCHER.submit("release", lambda: post_json("risk_controller", "/risk/release",
+                                                             {"reservation_id": reservation_id}))
+
+def trade_data(signal: dict, reservation_id) -> dict:
+    """提交预占和记录成交时附带的交易数据，预占已过期时风控按这些数据补记交易"""
+    return {
+        "reservation_id": reservation_id,
+        "amount": signal.get("amount", 0),
+        "wallet_address": signal.get("wallet_address"),
+        "token_in": signal.get("token_in"),
+        "token_out": signal.get("token_out")
+    }
+
+def ensure_recorded(result: dict):
+    """风控返回 200 但未计入交易（如 committed 为 false）时抛出异常，由后台队列重试"""
+    if not result.get("recorded"):
+        raise RuntimeError(f"Trade not recorded by risk controller: {result.get('reason', result)}")
+
+async def commit_reservation(reservation_id, signal: dict, deadline=None):
+    """交易可能已发出时提交风控预占的额度，宁可多计入限额也不让额度被重复使用"""
+    if reservation_id:
+        payload = trade_data(signal, reservation_id)
+        await DISPATCHER.submit("commit", lambda: post_json("risk_controller", "/risk/commit", payload),
+                                deadline=deadline or time.time() + RESERVATION_TTL, check=ensure_recorded)
+
+def elapsed_ms(started: float) -> float:
+    return round((time.time() - started) * 1000, 2)
+
+def stamp(records, field: str, started=None):
+    """记录一个阶段的耗时；合并处理的信号共用同一次处理，每条记录都写入"""
+    for record in records:
+        setattr(record, field, elapsed_ms(record.received_at if started is None else started))
+
+async def handle_signal(signal: dict):
     # 处理交易的符号信息，支持使用交易符号（如 BTC/USDT）
     process_trade_symbols(signal)
-    
+    record = HISTORY.begin(signal)
+    result = {"error": "Signal processing aborted"}
+    try:
+        result = await process_signal(signal, record)
+    except AdmissionRejected as e:
+        result = throttled_result(e)
+        raise
+    except Exception as e:
+        result = {"error": f"Signal processing failed: {str(e)}"}
+        raise
+    finally:
+        # 异常或取消时也要结束记录，否则它会一直停留在 pending
+        HISTORY.finish(record, result)
+    return result
+
+async def process_signal(signal: dict, record=None):
     # 校验信号格式 - 确保包含必要的交易对信息
     if not validate_signal_format(signal):
         return {"error": "Invalid signal format. Must contain token_in and token_out parameters."}
     
+    # 重复的信号等待首个请求的结果或直接返回缓存结果，不会再次下单；
+    # 新信号经准入队列排队，队列已满时抛出 AdmissionRejected
+    key, ttl = IDEMPOTENCY.key_for(signal)
+    result, duplicate = await IDEMPOTENCY.run(
+        key, ttl, lambda: ADMISSION.submit(signal, check_and_execute, record=record),
+        cacheable=may_have_traded)
+    return {**result, "duplicate": True} if duplicate else result
+
+async def check_and_execute(signal: dict, records=()):
+    """风控校验通过后执行交易，records 为（合并后）所有提交者的历史记录"""
+    stamp(records, "queue_ms")
     # Step 1: 将信号转发给 Risk Controller 进行风控校验
+    started = time.time()
     try:
-        response = requests.post("http://risk_controller:52120/risk/check", json=signal, timeout=5)
+        response = await get_client("risk_controller").post("/risk/check", json=signal)
         risk_result = response.json()
         if not risk_result.get("allowed", False):
             return {"status": "rejected", "reason": risk_result.get("reason", "Risk check failed")}
     except Exception as e:
         return {"error": f"Risk check failed: {str(e)}"}
+    finally:
+        stamp(records, "risk_ms", started)
+    
+    return await execute_approved(signal, risk_result, records)
+
+async def execute_approved(signal: dict, risk_result: dict, records=()):
+    """执行已通过风控的信号：提交交易，并把监控登记和风控记录交给后台队列"""
+    # 风控预占的额度：交易发出后提交，未发出时释放
+    reservation_id = risk_result.get("reservation_id")
     
     # Step 2: 风控通过后，调用 DEX Executor 执行交易
+    started = time.time()
     try:
-        dex_response = requests.post("http://dex_executor:52130/dex/execute", json=signal, timeout=10)
+        dex_response = await get_client("dex_executor").post("/dex/execute", json=signal)
+        stamp(records, "dex_ms", started)
         dex_result = dex_response.json()
         if "tx_hash" not in dex_result:
+            if dex_result.get("sent") == "unknown":
+                # 发送结果不确定（交易可能已进入内存池），与超时一样提交预占，结果被缓存，重试不会再次下单
+                await commit_reservation(reservation_id, signal, commit_deadline(risk_result))
+                return {"status": "unknown", "error": dex_result.get("error"), "details": dex_result}
+            await release_reservation(reservation_id)
             return {"status": "failed", "reason": "DEX execution failed", "details": dex_result}
         tx_hash = dex_result["tx_hash"]
     except Exception as e:
+        # 连接建立后的传输错误（超时、读取失败、连接被关闭等）发生时请求可能已送达，交易可能已发出，
+        # 提交预占额度；若按有效期自动释放，同一额度可能被再次下单。只有连接失败时请求一定没有送达
+        if isinstance(e, httpx.TransportError) and not isinstance(e, httpx.ConnectError):
+            await commit_reservation(reservation_id, signal, commit_deadline(risk_result))
+            return {"status": "unknown", "error": f"DEX request failed after it may have been sent, the trade may have been submitted: {str(e)}"}
+        await release_reservation(reservation_id)
         return {"error": f"DEX execution failed: {str(e)}"}
     
-    # Step 3: 调用 Execution Monitor 监控交易状态
-    try:
-        monitor_data = {
-            "tx_hash": tx_hash,
-            "network": signal.get("network", get_default_network()),
-            "original_signal": signal
-        }
-        monitor_response = requests.post("http://execution_monitor:52140/monitor/tx", json=monitor_data, timeout=5)
-        monitor_result = monitor_response.json()
-    except Exception as e:
-        # 交易已发出，但监控设置失败
-        return {
-            "status": "pending", 
-            "tx_hash": tx_hash,
-            "warning": f"Transaction submitted but monitoring failed: {str(e)}"
-        }
-    
-    # Step 4: 交易成功记录到风控系统
-    try:
-        record_data = {
-            "amount": signal.get("amount", 0),
-            "token_in": signal.get("token_in"),
-            "token_out": signal.get("token_out"),
-            "tx_hash": tx_hash,
-            "timestamp": monitor_result.get("timestamp", 0)
+    # Step 3 & 4: 执行监控登记和风控记录不影响返回的 tx_hash，交给后台队列处理
+    # 钱包和nonce用于按nonce顺序替换卡住的交易；流水线发送的 approve 也登记监控，它卡住时 swap 无法上链
+    network = signal.get("network", get_default_network())
+    monitor_data = {
+        "tx_hash": tx_hash,
+        "network": network,
+        "original_signal": signal,
+        "wallet_address": dex_result.get("wallet_address"),
+        "nonce": dex_result.get("nonce")
+    }
+    if dex_result.get("approve_tx_hash"):
+        approve_data = {
+            "tx_hash": dex_result["approve_tx_hash"],
+            "network": network,
+            "wallet_address": dex_result.get("wallet_address"),
+            "nonce": dex_result.get("approve_nonce")
         }
-        requests.post("http://risk_controller:52120/risk/record", json=record_data, timeout=5)
-    except Exception as e:
-        # 记录失败但不影响交易结果
-        print(f"Warning: Failed to record trade: {str(e)}")
+        await DISPATCHER.submit("monitor", lambda: post_json("execution_monitor", "/monitor/tx", approve_data))
+    record_data = {**trade_data(signal, reservation_id), "tx_hash": tx_hash, "timestamp": int(time.time())}
+    await DISPATCHER.submit("monitor", lambda: post_json("execution_monitor", "/monitor/tx", monitor_data))
+    # 风控记录同时提交预占，预占过期前一直重试
+    await DISPATCHER.submit("record", lambda: post_json("risk_controller", "/risk/record", record_data),
+                            deadline=commit_deadline(risk_result) if reservation_id else None, check=ensure_recorded)
     
     return {
         "status": "success",
         "tx_hash": tx_hash,
-        "monitor_status": monitor_result.get("status", "unknown"),
+        "monitor_status": "queued",
         "token_in": signal.get("token_in"),
         "token_out": signal.get("token_out"),
         "amount": signal.get("amount")
     }
 
+async def handle_signal_batch(signals: list):
+    """
+    批量处理信号：一次完成格式校验，一次批量风控检查，通过的信号并发执行。
+    返回与输入顺序一致的逐条结果。
+    """
+    results = [None] * len(signals)
+    records = [None] * len(signals)
+    valid = []
+    for index, signal in enumerate(signals):
+        if not isinstance(signal, dict):
+            results[index] = {"error": "Invalid signal format. Each signal must be an object."}
+            continue
+        process_trade_symbols(signal)
+        records[index] = HISTORY.begin(signal)
+        if not validate_signal_format(signal):
+            results[index] = {"error": "Invalid signal format. Must contain token_in and token_out parameters."}
+            continue
+        valid.append(index)
+    
+    # 已处理或处理中的重复信号不再进入风控和交易流程
+    keys = {}
+    duplicates = []
+    fresh = []
+    for index in valid:
+        key, ttl = IDEMPOTENCY.key_for(signals[index])
+        existing = IDEMPOTENCY.lookup(key)
+        if existing is not None:
+            duplicates.append((index, existing))
+        else:
+            IDEMPOTENCY.begin(key)
+            keys[index] = (key, ttl)
+            fresh.append(index)
+    valid = fresh
+    try:
+        try:
+            await run_batch_pipeline(signals, valid, results, records)
+        finally:
+            for index, (key, ttl) in keys.items():
+                result = results[index] or {"error": "Signal processing aborted"}
+                IDEMPOTENCY.finish(key, result, ttl, cache=may_have_traded(result))
+        for index, existing in duplicates:
+            try:
+                result = await asyncio.shield(existing) if isinstance(existing, asyncio.Future) else existing
+            except AdmissionRejected as e:
+                # 首个请求被限流，重复请求得到同样的限流结果
+                result = throttled_result(e)
+            except Exception as e:
+                result = {"error": f"Signal processing failed: {str(e)}"}
+            results[index] = {**result, "duplicate": True}
+    finally:
+        for record, result in zip(records, results):
+            if record is not None:
+                HISTORY.finish(record, result or {"error": "Signal processing aborted"})
+    
+    # unknown 为发送结果不确定、可能已成交的交易，调用方不应重试
+    summary = {"total": len(signals), "success": 0, "rejected": 0, "throttled": 0, "unknown": 0, "failed": 0}
+    for result in results:
+        status = result.get("status")
+        summary[status if status in ("success", "rejected", "throttled", "unknown") else "failed"] += 1
+    return {"results": results, "summary": summary}
+
+async def run_batch_pipeline(signals: list, valid: list, results: list, records: list):
+    """对格式合法且非重复的信号执行批量风控和并发交易，结果写入 results"""
+    # 所有格式合法的信号合并为一次风控请求
+    risk_results = []
+    if valid:
+        started = time.time()
+        stamp([records[index] for index in valid], "queue_ms")
+        try:
+            response = await get_client("risk_controller").post(
+                "/risk/check/batch", json={"signals": [signals[index] for index in valid]})
+            risk_results = response.json()["results"]
+            if len(risk_results) != len(valid):
+                raise ValueError(f"expected {len(valid)} results, got {len(risk_results)}")
+        except Exception as e:
+            for index in valid:
+                results[index] = {"error": f"Risk check failed: {str(e)}"}
+            valid, risk_results = [], []
+        stamp([records[index] for index in valid], "risk_ms", started)
+    
+    approved = []
+    for index, risk_result in zip(valid, risk_results):
+        if risk_result.get("allowed", False):
+            approved.append((index, risk_result))
+        else:
+            results[index] = {"status": "rejected", "reason": risk_result.get("reason", "Risk check failed")}
+    outcomes = await asyncio.gather(*[admit_approved(signals[index], risk_result, records[index])
+                                      for index, risk_result in approved])
+    for (index, _), outcome in zip(approved, outcomes):
+        results[index] = outcome
+
+async def admit_approved(signal: dict, risk_result: dict, record=None):
+    """批量请求中已通过风控的信号经准入队列执行（已按单条预占额度，不合并）"""
+    try:
+        return await ADMISSION.submit(
+            signal, lambda admitted, records: execute_approved(admitted, risk_result, records),
+            coalesce=False, record=record)
+    except AdmissionRejected as e:
+        await release_reservation(risk_result.get("reservation_id"))
+        return throttled_result(e)
+
+def throttled_result(error: AdmissionRejected) -> dict:
+    return {"status": "throttled", "reason": str(error), "retry_after": error.retry_after}
+
+class SignalStream:
+    """
+    单个 WebSocket 连接上的信号流会话。
+
+    客户端发送换行分隔的 JSON 信号，每条信号立即回复 ack，处理完成后推送 result，
+    交易发出后继续推送 Execution Monitor 中的状态变化直到最终状态。
+    所有推送消息都带有按接收顺序编号的 seq，以及信号中的 client_id（如有）。
+    """
+
+    def __init__(self, websocket):
+        self.websocket = websocket
+        self._send_lock = asyncio.Lock()
+        self._tasks = set()
+        self._follows = set()
+        self._closed = False
+        self._seq = 0
+
+    async def send(self, message: dict):
+        async with self._send_lock:
+            await self.websocket.send_text(json.dumps(message))
+
+    async def run(self):
+        """接收信号直到连接断开，断开时只停止状态推送，已接收的信号继续处理完成"""
+        try:
+            while True:
+                text = await self.websocket.receive_text()
+                for line in text.splitlines():
+                    if line.strip():
+                        await self.accept(line)
+        finally:
+            self._closed = True
+            for task in list(self._follows):
+                task.cancel()
+
+    async def accept(self, line: str):
+        self._seq += 1
+        seq = self._seq
+        try:
+            signal = json.loads(line)
+            if not isinstance(signal, dict):
+                raise ValueError("signal must be a JSON object")
+        except ValueError as e:
+            await self.send({"type": "error", "seq": seq, "error": f"Invalid signal: {str(e)}"})
+            return
+        client_id = signal.get("client_id")
+        await self.send({"type": "ack", "seq": seq, "client_id": client_id})
+        task = asyncio.ensure_future(self.process(seq, client_id, signal))
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    async def process(self, seq, client_id, signal: dict):
+        try:
+            try:
+                # 信号可能已经通过风控并发往 DEX，客户端断开时不能中途取消，否则预留额度和交易状态无人处理
+                result = await asyncio.shield(handle_signal(signal))
+            except AdmissionRejected as e:
+                result = throttled_result(e)
+            if self._closed:
+                return
+            await self.send({"type": "result", "seq": seq, "client_id": client_id, "result": result})
+            if result.get("status") == "success" and not self._closed:
+                follow = asyncio.ensure_future(self.follow(seq, client_id, result["tx_hash"]))
+                self._follows.add(follow)
+                follow.add_done_callback(self._follows.discard)
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            print(f"Warning: Signal stream processing failed: {str(e)}")
+
+    async def follow(self, seq, client_id, tx_hash: str):
+        """轮询执行监控，把交易状态变化推送给客户端"""
+        deadline = time.time() + STREAM_STATUS_TIMEOUT
+        last_status = None
+        while time.time() < deadline:
+            await asyncio.sleep(STREAM_STATUS_INTERVAL)
+            try:
+                response = await get_client("execution_monitor").get(f"/monitor/{tx_hash}")
+                details = response.json()
+            except Exception:
+                continue
+            status = details.get("status")
+            # 监控登记在后台队列中，尚未登记时返回 unknown
+            if status in (None, "unknown") or status == last_status:
+                continue
+            last_status = status
+            await self.send({"type": "status", "seq": seq, "client_id": client_id,
+                             "tx_hash": tx_hash, "status": status, "details": details})
+            if status in FINAL_TX_STATUSES:
+                return
+
 def process_trade_symbols(signal):
     """处理交易符号信息，支持使用交易符号（如 BTC/USDT），解析为 token_in 和 token_out"""
     # 如果输入了symbol参数（如"BTC/USDT"），且没有指定token_in和token_out，则解析symbol为 token_in 和 token_out
@@ -102,14 +461,9 @@ def validate_signal_format(signal: dict) -> bool:
     return all(field in signal for field in essential_fields)
 
 def get_default_network() -> str:
-    """从配置文件获取默认网络模式"""
-    try:
-        config_path = os.path.join(os.path.dirname(os.path.dirname(os.path.dirname(__file__))), "config.json")
-        with open(config_path, "r") as f:
-            config = json.load(f)
-            return config.get("network_mode", "testnet")
-    except Exception:
-        return "testnet"  # 默认回退到测试网
+    """从内存中的配置快照获取默认网络模式，配置变化时由配置服务推送更新"""
+    return CONFIG.get("network_mode") or "testnet"  # 默认回退到测试网
 
 def get_latest_signal():
-    return LAST_SIGNAL
+    latest = HISTORY.latest()
+    return latest.signal if latest else None
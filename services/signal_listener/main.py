@@ -1,12 +1,19 @@
 # ATM/services/signal_listener/main.py
-import json, os
 from fastapi import FastAPI
 # 注意：在Docker容器中使用绝对导入而不是相对导入
 try:
     from services.signal_listener.router import router
+    from services.common.config_file import load_config
 except ImportError:
     # 在本地开发环境中回退使用相对导入
     from .router import router
+    from ..common.config_file import load_config
+try:
+    from services.signal_listener.logic import signal_logic
+    from services.common.config_client import CONFIG
+except ImportError:
+    from .logic import signal_logic
+    from ..common.config_client import CONFIG
 
 
 def get_default_port(service_name: str) -> int:
@@ -22,28 +29,29 @@ def get_default_port(service_name: str) -> int:
     return default_ports.get(service_name, 52100)
 def get_service_port(service_name: str) -> int:
     """
-    从位于项目根目录的 config.json 中读取指定服务的端口配置
-    本文件相对路径： ATM/services/signal_listener/main.py
-    因此 config.json 路径为 "../../config.json"
+    从 config.json 中读取指定服务的端口配置：优先使用Docker容器中的 /app/config.json，
+    否则使用本地开发环境的 services/config.json（按 mtime 缓存）
     """
-    # 首先尝试Docker容器中的配置路径
-    config_path = "/app/config.json"
-    # 检查文件是否真的存在且是文件而不是目录
-    if not os.path.isfile(config_path):
-        # 本地开发环境的回退路径
-        config_path = os.path.join(os.path.dirname(os.path.dirname(os.path.dirname(__file__))), "config.json")
-    if os.path.isfile(config_path):
-        with open(config_path, "r") as f:
-            cfg = json.load(f)
-        ports = cfg.get("ports", {})
-        return int(ports.get(service_name, get_default_port(service_name)))
-    
-    # 如果找不到配置文件，使用默认端口
-    return get_default_port(service_name)  # 默认52110
+    ports = load_config().get("ports", {})
+    return int(ports.get(service_name, get_default_port(service_name)))  # 默认52110
 
 app = FastAPI(title="Signal Listener Service", version="1.0")
 app.include_router(router)
 
+@app.on_event("startup")
+async def start_dispatcher():
+    """启动交易提交后的后台调用队列"""
+    await signal_logic.DISPATCHER.start()
+    # 订阅配置服务推送的配置变化
+    CONFIG.start()
+
+@app.on_event("shutdown")
+async def shutdown_clients():
+    """排空后台队列并关闭到下游服务的长连接池"""
+    await signal_logic.DISPATCHER.stop()
+    await signal_logic.close_clients()
+    CONFIG.stop()
+
 if __name__ == "__main__":
     import uvicorn
     port = get_service_port("signal_listener")
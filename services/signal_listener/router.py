@@ -1,5 +1,6 @@
 # ATM/services/signal_listener/router.py
-from fastapi import APIRouter
+from typing import List
+from fastapi import APIRouter, HTTPException, WebSocket, WebSocketDisconnect, Body
 # 同时支持Docker环境和本地环境的导入
 try:
     from services.signal_listener.logic import signal_logic
@@ -10,10 +11,48 @@ except ImportError:
 router = APIRouter()
 
 @router.post("/signal")
-def receive_signal(signal: dict):
-    result = signal_logic.handle_signal(signal)
+async def receive_signal(signal: dict):
+    try:
+        result = await signal_logic.handle_signal(signal)
+    except signal_logic.AdmissionRejected as e:
+        # 准入队列已满，告知调用方稍后重试
+        raise HTTPException(status_code=429, detail=str(e), headers={"Retry-After": str(e.retry_after)})
     return {"result": result}
 
+@router.post("/signal/batch")
+async def receive_signal_batch(signals: List[dict] = Body(...)):
+    # 一次请求提交多个信号，返回与输入顺序一致的逐条结果
+    if len(signals) > signal_logic.MAX_BATCH_SIZE:
+        raise HTTPException(status_code=413, detail=f"At most {signal_logic.MAX_BATCH_SIZE} signals per batch")
+    return await signal_logic.handle_signal_batch(signals)
+
+@router.websocket("/signal/stream")
+async def signal_stream(websocket: WebSocket):
+    # 长连接接收换行分隔的 JSON 信号，并推送确认、处理结果和交易状态
+    await websocket.accept()
+    try:
+        await signal_logic.SignalStream(websocket).run()
+    except WebSocketDisconnect:
+        pass
+
+@router.get("/signal/dispatch/status")
+def get_dispatch_status():
+    # 返回后台调用队列的深度和统计信息
+    return signal_logic.DISPATCHER.stats()
+
+@router.get("/signal/admission/status")
+def get_admission_status():
+    # 返回准入队列各优先级的排队数和并发情况
+    return signal_logic.ADMISSION.stats()
+
+@router.get("/signal/history")
+def get_signal_history(pair: str = None, status: str = None, since: float = None, until: float = None,
+                       limit: int = 100):
+    # 按交易对（如 USDT/WBTC）、状态和时间范围查询最近的信号，最新的在前
+    limit = max(1, min(limit, 1000))
+    records = signal_logic.HISTORY.query(pair=pair, status=status, since=since, until=until, limit=limit)
+    return {"signals": records, "count": len(records), "stats": signal_logic.HISTORY.stats()}
+
 @router.get("/signal/latest")
 def get_latest_signal():
     latest = signal_logic.get_latest_signal()